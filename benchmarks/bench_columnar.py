@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+    Memory per series and scrape time of a gauge with many series, kept
+    as a SimpleMetric each ("objects") or in Columns ("columnar").
+
+    Each variant runs in its own process so peak RSS isn't shared.
+    Memory per series is measured with tracemalloc (Python 3), from the
+    RSS growth otherwise.
+
+    Usage: python benchmarks/bench_columnar.py [series] [scrapes]
+"""
+
+from __future__ import print_function
+
+import resource
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pytheus.meter
+
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.0
+
+
+def run(variant, series, scrapes):
+    if tracemalloc:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0] if tracemalloc else rss()
+
+    start = time.time()
+    gauge = pytheus.meter.Gauge("bench_gauge", "Benchmark", columnar=variant == "columnar")
+    for i in range(series):
+        gauge.set(float(i), instance=str(i), job="bench")
+    created = time.time() - start
+
+    after = tracemalloc.get_traced_memory()[0] if tracemalloc else rss()
+    if tracemalloc:
+        tracemalloc.stop()
+
+    child = gauge.labels(instance="0", job="bench")
+    start = time.time()
+    for i in range(series):
+        child.set(float(i))
+    updates = series / (time.time() - start)
+
+    start = time.time()
+    for i in range(scrapes):
+        gauge.set(float(i), instance=str(i % series), job="bench") # Something changed
+        gauge.to_string()
+    scrape = (time.time() - start) / scrapes * 1000
+
+    print("%-10s %14.1f %14.2f %14.0f %14.2f" % (
+        variant, (after - before) / series, created, updates, scrape))
+
+
+def main():
+    series = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    scrapes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    if len(sys.argv) > 3:
+        run(sys.argv[3], series, scrapes)
+        return
+
+    print("%d series, %d scrapes" % (series, scrapes))
+    print("%-10s %14s %14s %14s %14s" % (
+        "variant", "bytes/series", "create (s)", "updates/s", "ms/scrape"))
+    sys.stdout.flush()
+    for variant in ("objects", "columnar"):
+        subprocess.check_call([sys.executable, __file__, str(series), str(scrapes), variant])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+    Compressed scrapes under mixed traffic: scrapers asking for text and
+    OpenMetrics, gzip and deflate, in turn, while a metric changes every
+    few scrapes. "single" keeps one compressed body, which this traffic
+    thrashes as much as the former one per encoding did, "cached" keeps
+    Base.max_compressed of them.
+
+    Usage: python benchmarks/bench_compression.py [series] [scrapes]
+"""
+
+from __future__ import print_function
+
+import collections
+import sys
+import time
+
+import pytheus.collector
+import pytheus.exporter
+import pytheus.http.request
+import pytheus.meter
+
+
+SCRAPERS = [("Accept-Encoding: gzip",),
+            ("Accept-Encoding: deflate",),
+            ("Accept-Encoding: gzip", "Accept: application/openmetrics-text"),
+            ("Accept-Encoding: deflate", "Accept: application/openmetrics-text")]
+
+
+def request(headers):
+    raw = "\r\n".join(("GET /metrics HTTP/1.1",) + headers) + "\r\n\r\n"
+    return pytheus.http.request.Base(None, None, raw)
+
+
+def registry(series):
+    pytheus.collector.Base.decorators = collections.OrderedDict()
+    gauge = pytheus.meter.Gauge("bench_gauge", "Benchmark")
+    for i in range(series):
+        gauge.set(float(i), instance=str(i))
+    pytheus.collector.Base.register(gauge, lambda: (0.0, {}))
+    pytheus.collector.Base.decorators[gauge].collected = True
+    return gauge
+
+
+def run(variant, series, scrapes):
+    gauge = registry(series)
+    exporter = pytheus.exporter.Base("127.0.0.1", 0)
+    exporter.collector.scheduler.running = True # Nothing to collect, only to scrape
+    if variant == "single":
+        exporter.max_compressed = 1
+    requests = [request(headers) for headers in SCRAPERS]
+
+    start = time.time()
+    for i in range(scrapes):
+        if i % (len(requests) * 4) == 0:
+            gauge.set(float(i), instance="0") # Something changed
+        exporter.handle_request(requests[i % len(requests)])
+    elapsed = time.time() - start
+    exporter.server.sock.close()
+
+    lookups = exporter.compress_hits + exporter.compress_misses
+    print("%-8s %14.2f %10d %10d %9.1f%%" % (variant, elapsed / scrapes * 1000,
+                                             exporter.compress_hits, exporter.compress_misses,
+                                             100.0 * exporter.compress_hits / max(lookups, 1)))
+
+
+def main():
+    series = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    scrapes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    print("%d series, %d scrapes" % (series, scrapes))
+    print("%-8s %14s %10s %10s %10s" % ("variant", "ms/scrape", "hits", "misses", "hit rate"))
+    for variant in ("single", "cached"):
+        run(variant, series, scrapes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+    A latency histogram over many label sets, with classic buckets (the
+    Prometheus client defaults, and 40 of them for about the resolution
+    of schema 3 over the same range) or exponential ones: memory per
+    series, size of the text and protobuf expositions, observations/s.
+
+    Each variant runs in its own process. Memory per series is measured
+    with tracemalloc (Python 3), from the RSS growth otherwise.
+
+    Usage: python benchmarks/bench_exponential.py [series] [observations]
+"""
+
+from __future__ import print_function
+
+import random
+import resource
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pytheus.encoders
+import pytheus.meter
+
+
+VARIANTS = {
+    "classic": [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    "classic40": [0.001 * 1.25 ** i for i in range(40)],
+    "exponential": None,
+}
+
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024.0
+
+
+def run(variant, series, observations):
+    random.seed(1)
+    values = [random.lognormvariate(-3, 1) for _ in range(observations)]
+    if tracemalloc:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0] if tracemalloc else rss()
+
+    histogram = pytheus.meter.Histogram("bench_seconds", VARIANTS[variant])
+    start = time.time()
+    for i in range(series):
+        histogram.labels(instance=str(i)).observe_many(values)
+    rate = series * observations / (time.time() - start)
+
+    after = tracemalloc.get_traced_memory()[0] if tracemalloc else rss()
+    if tracemalloc:
+        tracemalloc.stop()
+
+    text = len(histogram.to_bytes())
+    protobuf = len(pytheus.encoders.Protobuf().encode([histogram]))
+    print("%-12s %14.0f %14d %14d %14.0f" % (
+        variant, (after - before) / series, text // series, protobuf // series, rate))
+
+
+def main():
+    series = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    observations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    if len(sys.argv) > 3:
+        run(sys.argv[3], series, observations)
+        return
+
+    print("%d series, %d observations each" % (series, observations))
+    print("%-12s %14s %14s %14s %14s" % (
+        "variant", "bytes/series", "text/series", "proto/series", "observe/s"))
+    sys.stdout.flush()
+    for variant in ("classic", "classic40", "exponential"):
+        subprocess.check_call([sys.executable, __file__, str(series), str(observations), variant])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+    Memory cost of serving a scrape of a large registry, from the meters
+    to the socket. "copying" builds the response the way it used to be
+    (joined strings, headers and body concatenated before sendall),
+    "zero-copy" sends the cached exposition as is, next to the headers.
+
+    Each variant runs in its own process so peak RSS isn't shared.
+    Allocations per scrape need tracemalloc (Python 3).
+
+    Usage: python benchmarks/bench_exposition.py [series] [scrapes]
+"""
+
+from __future__ import print_function
+
+import collections
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pytheus.collector
+import pytheus.http.response
+import pytheus.http.server
+import pytheus.meter
+
+
+def registry(series):
+    pytheus.collector.Base.decorators = collections.OrderedDict()
+    gauge = pytheus.meter.Gauge("bench_gauge", "Benchmark")
+    for i in range(series):
+        gauge.set(float(i), instance=str(i))
+    pytheus.collector.Base.register(gauge, lambda: (0.0, {}))
+    pytheus.collector.Base.decorators[gauge].collected = True
+    collector = pytheus.collector.Base()
+    collector.scheduler.running = True # Nothing to collect, only to scrape
+    return collector
+
+
+def copying(collector, sock):
+    content = "".join([metric.to_string() for metric in collector.collected()])
+    response = pytheus.http.response.Base(200)
+    response.content = content
+    sock.sendall(response.to_string())
+
+
+def zero_copy(collector, sock):
+    response = pytheus.http.response.Base(200)
+    response.content = collector.get_metrics()
+    pytheus.http.server.sendall(sock, response.buffers())
+
+
+def drain(sock):
+    while sock.recv(1 << 20):
+        pass
+
+
+def run(variant, series, scrapes):
+    collector = registry(series)
+    scrape = {"copying": copying, "zero-copy": zero_copy}[variant]
+    server, client = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(client,))
+    reader.daemon = True
+    reader.start()
+
+    scrape(collector, server) # Warm up the caches
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    peak = 0
+    for _ in range(scrapes):
+        if tracemalloc and hasattr(tracemalloc, "reset_peak"): # Python 3.9+
+            tracemalloc.reset_peak()
+        scrape(collector, server)
+        if tracemalloc:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+    elapsed = time.time() - start
+    server.close()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    allocated = "%.1f" % (peak / 1048576.0) if tracemalloc else "n/a"
+    print("%-10s %14.2f %18s %14.1f" % (variant, elapsed / scrapes * 1000, allocated, rss))
+
+
+def main():
+    series = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    scrapes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if len(sys.argv) > 3:
+        run(sys.argv[3], series, scrapes)
+        return
+
+    print("%d series, %d scrapes" % (series, scrapes))
+    print("%-10s %14s %18s %14s" % ("variant", "ms/scrape", "peak alloc (MB)", "max RSS (MB)"))
+    sys.stdout.flush()
+    for variant in ("copying", "zero-copy"):
+        subprocess.check_call([sys.executable, __file__, str(series), str(scrapes), variant])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+    Packets per second through pytheus.statsd: parsed and applied
+    ("feed", no sockets) and received over loopback UDP from a sender
+    process ("udp"). Packets are single lines, counters and timers over
+    a few hundred label sets.
+
+    Each variant runs in its own process. UDP drops what the receiver
+    can't keep up with, "received" is what made it.
+
+    Usage: python benchmarks/bench_statsd.py [packets]
+"""
+
+from __future__ import print_function
+
+import logging
+import socket
+import subprocess
+import sys
+import time
+
+import pytheus.statsd
+
+
+def packets(count):
+    lines = []
+    for i in range(500):
+        lines.append("api.requests:1|c|#route:/r%d,code:200" % (i % 100))
+        lines.append("api.latency:%d|ms|#route:/r%d" % (i, i % 100))
+    lines = [line.encode("ascii") for line in lines]
+    return [lines[i % len(lines)] for i in range(count)]
+
+
+def feed(count):
+    ingest = pytheus.statsd.Base(port=None)
+    data = packets(count)
+    batch = ingest.batch_size
+    start = time.time()
+    for i in range(0, count, batch):
+        ingest.feed(data[i:i + batch])
+    elapsed = time.time() - start
+    return count, count, elapsed
+
+
+def udp(count):
+    ingest = pytheus.statsd.Base("127.0.0.1", 0)
+    ingest.poll_interval = 0.1
+    thread = ingest.start()
+    sender = subprocess.Popen([sys.executable, __file__, str(count), "send", str(ingest.port)])
+    start = time.time()
+    sender.wait()
+    last = -1
+    while ingest.stats.packets != last: # Until the backlog is drained
+        last = ingest.stats.packets
+        time.sleep(0.2)
+    elapsed = time.time() - start - 0.2
+    ingest.stop()
+    thread.join()
+    return count, ingest.stats.packets, elapsed
+
+
+def send(count, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ("127.0.0.1", port)
+    for packet in packets(count):
+        sock.sendto(packet, address)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    if len(sys.argv) > 3:
+        send(count, int(sys.argv[3]))
+        return
+    if len(sys.argv) > 2:
+        sent, received, elapsed = globals()[sys.argv[2]](count)
+        print("%-10s %12d %12d %14.0f" % (sys.argv[2], sent, received, received / elapsed))
+        return
+
+    print("%-10s %12s %12s %14s" % ("variant", "sent", "received", "packets/s"))
+    sys.stdout.flush()
+    for variant in ("feed", "udp"):
+        subprocess.check_call([sys.executable, __file__, str(count), variant])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+    Throughput of pytheus.tail over a generated access log, read in
+    chunks ("chunked") or mapped ("mmap"), through a counter by status
+    code and a latency histogram.
+
+    Each variant runs in its own process, on a cold tail (from the start
+    of the file).
+
+    Usage: python benchmarks/bench_tail.py [megabytes]
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytheus.meter
+import pytheus.tail
+
+
+LINE = '10.0.0.%d - - [18/Oct/2026:10:00:00 +0000] "GET /api/%d HTTP/1.1" %s %d rt=%.3f\n'
+
+
+def generate(path, megabytes):
+    codes = ["200"] * 90 + ["404"] * 7 + ["500"] * 3
+    with open(path, "w") as fd:
+        written = 0
+        while written < megabytes << 20:
+            lines = "".join(LINE % (random.randint(1, 254), random.randint(1, 1000),
+                                    random.choice(codes), random.randint(100, 10000),
+                                    random.random()) for _ in range(10000))
+            fd.write(lines)
+            written += len(lines)
+
+
+def run(variant, path):
+    requests = pytheus.meter.Counter("requests_total")
+    latency = pytheus.meter.Histogram("request_seconds", [0.01, 0.05, 0.1, 0.5, 1])
+    tail = pytheus.tail.Base(path, [
+        pytheus.tail.Rule(r'" (?P<code>\d{3}) ', requests, labels=["code"]),
+        pytheus.tail.Rule(r" rt=(?P<value>[\d.]+)$", latency),
+    ], from_beginning=True)
+    if variant == "mmap":
+        tail.mmap_threshold = 0
+    else:
+        tail.mmap_threshold = float("inf")
+
+    start = time.time()
+    tail.collect()
+    elapsed = time.time() - start
+    size = os.path.getsize(path)
+    lines = sum(series.value for series in requests._series())
+    print("%-10s %14.1f %14.0f %14.2f" % (variant, size / elapsed / (1 << 20),
+                                           lines / elapsed, elapsed))
+
+
+def main():
+    if len(sys.argv) > 3:
+        run(sys.argv[2], sys.argv[3])
+        return
+
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        generate(path, megabytes)
+        print("%d MB of access log" % (megabytes))
+        print("%-10s %14s %14s %14s" % ("variant", "MB/s", "lines/s", "seconds"))
+        sys.stdout.flush()
+        for variant in ("chunked", "mmap"):
+            subprocess.check_call([sys.executable, __file__, str(megabytes), variant, path])
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+    Counter increments per second from several threads, each updating its
+    own series, with the striped locks versus a single global lock.
+
+    Usage: python benchmarks/bench_threads.py [increments per thread]
+"""
+
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+import pytheus.meter
+
+
+def run(threads, increments):
+    counter = pytheus.meter.Counter("bench_total")
+    children = [counter.labels(thread=str(i)) for i in range(threads)]
+
+    def work(child):
+        for _ in range(increments):
+            child.inc()
+
+    pool = [threading.Thread(target=work, args=(child,)) for child in children]
+    start = time.time()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.time() - start
+
+    total = sum(child.series.value for child in children)
+    assert total == threads * increments, "Lost increments: %s" % (total)
+    return total / elapsed
+
+
+def main():
+    increments = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    striped = list(pytheus.meter.LOCK_STRIPES)
+
+    print("%-8s %16s %16s" % ("threads", "striped ops/s", "global ops/s"))
+    for threads in (1, 2, 4, 8):
+        pytheus.meter.LOCK_STRIPES[:] = striped
+        with_stripes = run(threads, increments)
+        pytheus.meter.LOCK_STRIPES[:] = [threading.Lock()]
+        with_global = run(threads, increments)
+        print("%-8i %16.0f %16.0f" % (threads, with_stripes, with_global))
+    pytheus.meter.LOCK_STRIPES[:] = striped
+
+
+if __name__ == '__main__':
+    main()
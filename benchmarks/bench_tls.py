@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+    Server side cost of a scrape over a new TLS connection: with a context
+    built for every connection (what ssl.wrap_socket does), with the
+    shared pytheus.http.tls.Context, and with the client resuming its
+    session (Python 3.6+ clients only).
+
+    Usage: python benchmarks/bench_tls.py [scrapes] [certfile]
+"""
+
+from __future__ import print_function
+
+import os
+import socket
+import ssl
+import sys
+import threading
+import time
+
+import pytheus.http.tls
+
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+
+
+def serve(listener, scrapes, wrap, timings):
+    for _ in range(scrapes):
+        sock, _ = listener.accept()
+        start = time.time()
+        try:
+            sock = wrap(sock)
+            sock.recv(8192)
+            sock.sendall(RESPONSE)
+        finally:
+            sock.close()
+        timings.append(time.time() - start)
+
+
+def run(scrapes, wrap, resume=False):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    timings = []
+    server = threading.Thread(target=serve, args=(listener, scrapes, wrap, timings))
+    server.start()
+
+    client = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_CLIENT", ssl.PROTOCOL_SSLv23))
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+    session = None
+    resumed = 0
+    for _ in range(scrapes):
+        sock = socket.create_connection(listener.getsockname())
+        kwargs = {"session": session} if resume else {}
+        sock = client.wrap_socket(sock, **kwargs)
+        sock.sendall(b"GET /metrics HTTP/1.1\r\n\r\n")
+        sock.recv(8192)
+        if resume:
+            session = sock.session
+            resumed += sock.session_reused
+        sock.close()
+    server.join()
+    listener.close()
+    return sum(timings) / len(timings) * 1000000, resumed
+
+
+def main():
+    scrapes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    certfile = sys.argv[2] if len(sys.argv) > 2 else \
+        os.path.join(os.path.dirname(__file__), "..", "tests", "certs", "server.pem")
+    tls = pytheus.http.tls.Context(certfile)
+
+    def fresh(sock):
+        return tls.build().wrap_socket(sock, server_side=True)
+
+    def shared(sock):
+        return tls.wrap(sock)
+
+    print("%-24s %16s %10s" % ("server", "us/scrape", "resumed"))
+    for name, wrap, resume in (("context per connection", fresh, False),
+                               ("shared context", shared, False),
+                               ("shared context, resumed", shared, True)):
+        if resume and not hasattr(ssl.SSLSocket, "session"):
+            print("%-24s %16s" % (name, "needs Python 3.6+"))
+            continue
+        cost, resumed = run(scrapes, wrap, resume)
+        print("%-24s %16.0f %10i" % (name, cost, resumed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+    Benchmark suite: the meters, the collector and the HTTP path, as the
+    number of series, observations and concurrent scrapers grows.
+
+    Every case runs in its own process (peak RSS isn't shared) and reports:
+        ops/s: operations (updates, renders, scrapes) per second
+        p50, p99: latency of one operation, in microseconds
+        RSS: peak resident memory of the process, in MB
+
+    Results can be saved and compared against, a case regresses when its
+    ops/s drop or its p99 or memory grow by more than the tolerance; the
+    exit status is then 1:
+
+        python benchmarks/suite.py --save before.json
+        (upgrade)
+        python benchmarks/suite.py --compare before.json --tolerance 0.15
+
+    Usage: python benchmarks/suite.py [--quick] [--only PREFIX]
+                                      [--save FILE] [--compare FILE]
+                                      [--tolerance FRACTION]
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytheus.collector
+import pytheus.exporter
+import pytheus.meter
+
+
+# Each case is run once per parameter, --quick only keeps the first two
+CASES = collections.OrderedDict()
+
+
+def case(*params):
+    def decorator(function):
+        CASES[function.__name__] = (function, params)
+        return function
+    return decorator
+
+
+def batches(operation, total, size=1000):
+    """Runs operation(i) total times, returns [(operations, seconds)] per batch."""
+    samples = []
+    clock = time.time
+    for start in range(0, total, size):
+        stop = min(start + size, total)
+        began = clock()
+        for i in range(start, stop):
+            operation(i)
+        samples.append((stop - start, clock() - began))
+    return samples
+
+
+def labels(series):
+    return [{"instance": str(i), "job": "bench"} for i in range(series)]
+
+
+@case(100, 10000, 100000)
+def counter_inc(series):
+    counter = pytheus.meter.Counter("bench_total")
+    label_sets = labels(series)
+    for label_set in label_sets:
+        counter.inc(**label_set)
+    return batches(lambda i: counter.inc(**label_sets[i % series]), max(series, 100000))
+
+
+@case(1, 1000, 100000)
+def histogram_observe(observations):
+    histogram = pytheus.meter.Histogram("bench_seconds", [0.01, 0.05, 0.1, 0.5, 1, 5])
+    child = histogram.labels(job="bench")
+    values = [random.random() for _ in range(observations)]
+    return batches(lambda i: child.observe_many(values), 200, size=10)
+
+
+@case(1, 1000, 100000)
+def exponential_observe(observations):
+    histogram = pytheus.meter.Histogram("bench_seconds") # Exponential buckets
+    child = histogram.labels(job="bench")
+    values = [random.lognormvariate(-3, 1) for _ in range(observations)]
+    return batches(lambda i: child.observe_many(values), 200, size=10)
+
+
+@case(10, 1000, 10000)
+def summary_to_string(series):
+    summary = pytheus.meter.Summary("bench_seconds", [0.5, 0.9, 0.99])
+    label_sets = labels(series)
+    for label_set in label_sets:
+        for _ in range(10):
+            summary.observe(random.random(), **label_set)
+
+    def render(i):
+        summary.observe(random.random(), **label_sets[i % series]) # Something changed
+        summary.to_string()
+    return batches(render, 100, size=1)
+
+
+def registry(series, families=10):
+    pytheus.collector.Base.decorators = collections.OrderedDict()
+    for family in range(families):
+        gauge = pytheus.meter.Gauge("bench_gauge_%d" % (family))
+        for label_set in labels(series // families):
+            gauge.set(random.random(), **label_set)
+        pytheus.collector.Base.register(gauge, lambda: (0.0, {}))
+        pytheus.collector.Base.decorators[gauge].collected = True
+    return list(pytheus.collector.Base.decorators)
+
+
+@case(1000, 100000, 500000)
+def get_metrics(series):
+    gauges = registry(series)
+    collector = pytheus.collector.Base()
+    collector.scheduler.running = True # Nothing to collect, only to scrape
+
+    def scrape(i):
+        gauges[i % len(gauges)].set(float(i), instance="0", job="bench")
+        collector.get_metrics()
+    return batches(scrape, 100, size=1)
+
+
+def read_response(sock):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(65536)
+        assert chunk, "Connection closed"
+        data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+    while len(body) < length:
+        chunk = sock.recv(65536)
+        assert chunk, "Connection closed"
+        body += chunk
+
+
+@case(1, 4, 16)
+def http_scrape(scrapers, series=10000, scrapes=200):
+    registry(series)
+    exporter = pytheus.exporter.Base("127.0.0.1", 0, mode="threaded", workers=scrapers,
+                                     max_requests=scrapes + 1)
+    exporter.collector.scheduler.running = True
+    server = threading.Thread(target=exporter.server.serve_forever)
+    server.daemon = True
+    server.start()
+
+    request = b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    samples = []
+
+    def scraper():
+        sock = socket.create_connection(("127.0.0.1", exporter.server.port))
+        clock = time.time
+        for _ in range(scrapes):
+            began = clock()
+            sock.sendall(request)
+            read_response(sock)
+            samples.append((1, clock() - began))
+        sock.close()
+
+    threads = [threading.Thread(target=scraper) for _ in range(scrapers)]
+    began = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - began
+    exporter.server.stop()
+    # Concurrent scrapes overlap, the throughput is over the whole run
+    return samples, len(samples) / elapsed
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def summarize(samples, ops=None):
+    latencies = sorted(seconds / count for count, seconds in samples)
+    if ops is None:
+        ops = sum(count for count, _ in samples) / sum(seconds for _, seconds in samples)
+    return {
+        "ops": ops,
+        "p50": percentile(latencies, 0.5) * 1e6,
+        "p99": percentile(latencies, 0.99) * 1e6,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def run_case(name, param):
+    """Runs in a child process, prints the result as JSON."""
+    logging.basicConfig(level=logging.ERROR) # No warnings about plain http
+    function = CASES[name][0]
+    result = function(param)
+    if isinstance(result, tuple):
+        result = summarize(*result)
+    else:
+        result = summarize(result)
+    print(json.dumps(result))
+
+
+def case_ids(quick, only):
+    for name, (_, params) in CASES.items():
+        if only and not name.startswith(only):
+            continue
+        for param in params[:2] if quick else params:
+            yield "%s[%s]" % (name, param), name, param
+
+
+def regressions(result, baseline, tolerance):
+    """Returns what got worse than the baseline, beyond tolerance."""
+    worse = []
+    if result["ops"] < baseline["ops"] * (1 - tolerance):
+        worse.append("ops/s")
+    for key in ("p99", "rss"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            worse.append(key)
+    return worse
+
+
+def change(value, base):
+    return "%+.0f%%" % ((value / base - 1) * 100) if base else ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pytheus benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="Only the smaller parameters")
+    parser.add_argument("--only", help="Only the cases starting with this")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed change before it's a regression (default: 0.1)")
+    parser.add_argument("--case", nargs=2, help=argparse.SUPPRESS) # Child process
+    args = parser.parse_args()
+
+    if args.case:
+        name, param = args.case
+        run_case(name, int(param))
+        return 0
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+
+    print("%-28s %12s %12s %12s %10s  %s" % ("case", "ops/s", "p50 (us)", "p99 (us)",
+                                             "RSS (MB)", "vs baseline" if baseline else ""))
+    results = collections.OrderedDict()
+    failed = []
+    for case_id, name, param in case_ids(args.quick, args.only):
+        output = subprocess.check_output([sys.executable, __file__, "--case", name, str(param)])
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        results[case_id] = result
+
+        compared = ""
+        base = baseline.get(case_id)
+        if base:
+            compared = "ops %s, p99 %s, rss %s" % (change(result["ops"], base["ops"]),
+                                                   change(result["p99"], base["p99"]),
+                                                   change(result["rss"], base["rss"]))
+            worse = regressions(result, base, args.tolerance)
+            if worse:
+                failed.append(case_id)
+                compared += "  REGRESSION: " + ", ".join(worse)
+        print("%-28s %12.0f %12.1f %12.1f %10.1f  %s" % (
+            case_id, result["ops"], result["p50"], result["p99"], result["rss"], compared))
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, "w") as fd:
+            json.dump(results, fd, indent=2)
+    if failed:
+        print("%d regression(s): %s" % (len(failed), ", ".join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,8 @@
 # See: https://stackoverflow.com/a/50610630
+
+import sys
+
+# Coroutines (async def) don't even parse before Python 3.5
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append("tests/test_aio.py")
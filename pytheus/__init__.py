@@ -2,6 +2,10 @@
 
 import pytheus.exporter
 
-def start(address="0.0.0.0", port=8000):
-    exporter = pytheus.exporter.Base(address, port)
+def start(address="0.0.0.0", port=8000, **kwargs):
+    exporter = pytheus.exporter.Base(address, port, **kwargs)
+    exporter.start()
+
+def start_async(address="0.0.0.0", port=8000, **kwargs):
+    exporter = pytheus.exporter.AsyncBase(address, port, **kwargs)
     exporter.start()
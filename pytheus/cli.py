@@ -10,6 +10,8 @@ import argparse
 
 import pytheus.decorators
 import pytheus.exporter
+import pytheus.http.server
+import pytheus.http.tls
 
 def main(): # pragma: nocover
     desc = "Simple prometheus exporter."
@@ -23,6 +25,42 @@ def main(): # pragma: nocover
                         default=8000)
     parser.add_argument("-c", "--certfile",
                         help="The certificate (PEM). Optional, if you need https.")
+    parser.add_argument("--keyfile",
+                        help="The private key, if it isn't in the certificate file.")
+    parser.add_argument("--cafile",
+                        help="CA certificates to verify client certificates against.")
+    parser.add_argument("--verify-client",
+                        help="Require a valid client certificate (mutual TLS).",
+                        action="store_true")
+    parser.add_argument("--ciphers",
+                        help="OpenSSL cipher list.",
+                        default=pytheus.http.tls.DEFAULT_CIPHERS)
+    parser.add_argument("-m", "--mode",
+                        help="How connections are served.",
+                        choices=pytheus.http.server.MODES,
+                        default="select")
+    parser.add_argument("-w", "--workers",
+                        help="Worker threads when using the threaded mode.",
+                        type=int,
+                        default=8)
+    parser.add_argument("-b", "--backlog",
+                        help="Listen backlog for pending connections.",
+                        type=int,
+                        default=128)
+    parser.add_argument("--idle-timeout",
+                        help="Seconds a kept-alive connection may stay idle.",
+                        type=int,
+                        default=15)
+    parser.add_argument("--no-keep-alive",
+                        help="Close the connection after every response.",
+                        action="store_true")
+    parser.add_argument("--collector-workers",
+                        help="Threads running the collector functions.",
+                        type=int,
+                        default=4)
+    parser.add_argument("--instrumentation",
+                        help="Expose the exporter's own pytheus_* metrics.",
+                        action="store_true")
     parser.add_argument("-v", "--verbose",
                         help="Increase output verbosity",
                         action="store_true")
@@ -48,7 +86,25 @@ def main(): # pragma: nocover
         time.sleep(5)
         return time.time(), {"tag": "bye world!"}
 
-    exporter = pytheus.exporter.Base(args.address, args.port, args.certfile)
+    tls = None
+    if args.certfile:
+        tls = pytheus.http.tls.Context(args.certfile,
+                                       args.keyfile,
+                                       args.ciphers,
+                                       args.cafile,
+                                       args.verify_client)
+
+    exporter = pytheus.exporter.Base(args.address,
+                                     int(args.port),
+                                     args.certfile,
+                                     mode=args.mode,
+                                     workers=args.workers,
+                                     backlog=args.backlog,
+                                     keep_alive=not args.no_keep_alive,
+                                     idle_timeout=args.idle_timeout,
+                                     tls=tls,
+                                     collector_workers=args.collector_workers,
+                                     instrumentation=args.instrumentation)
     exporter.start()
 
 
@@ -1,65 +1,209 @@
 #!/usr/bin/env python
 
+import bisect
 import logging
 import collections
-import traceback
-import Queue
-import threading
+import re
 
+import pytheus.http.request
+import pytheus.meter
+import pytheus.scheduler
 
-# Inspired by: https://stackoverflow.com/questions/2829329
-class ExceptionThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
-        threading.Thread.__init__(self, *args, **kwargs)
 
-    def run(self):
+class UnknownFamilyError(Exception):
+    """When a collector returns samples for a metric it wasn't given."""
+    pass
+
+
+class Families(object):
+    """
+        Routes what a multi-family collector returns to its metrics, either
+        {name: samples} (a sample or an iterable of them, per metric) or
+        an iterable of (name, value, {labels}), consumed as it goes.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = collections.OrderedDict((metric.name, metric) for metric in metrics)
+
+    def _metric(self, name):
+        metric = self.metrics.get(name)
+        if metric is None:
+            raise UnknownFamilyError("Not one of this collector's metrics: %s" % (name))
+        return metric
+
+    def measure(self, value, **labels):
+        raise UnknownFamilyError("Samples must say which metric they're for.")
+
+    def measure_many(self, samples):
+        if isinstance(samples, dict):
+            for name, family in samples.items():
+                metric = self._metric(name)
+                if isinstance(family, tuple) and len(family) == 2 and isinstance(family[1], dict):
+                    family = [family]
+                metric.measure_many(family)
+            return self
+        for name, value, labels in samples:
+            metric = self._metric(name)
+            metric._update(metric._lookup(labels or {}), value)
+            metric.dirty = True
+        return self
+
+
+class Selector(object):
+    """
+        Which families a scrape asks for, from its query string:
+            name[]: exact names
+            name_prefix[]: names starting with
+            name_regex[]: names (fully) matching
+        Families matching any of them are selected. An invalid regex is a
+        bad request.
+    """
+
+    def __init__(self, names=(), prefixes=(), regexes=()):
+        self.names = set(names)
+        self.prefixes = tuple(prefixes)
         try:
-            self._Thread__target(*self._Thread__args, **self._Thread__kwargs)
-        except Exception:
-            logging.critical(traceback.format_exc())
+            # Anchors the whole regex, alternations included
+            self.regexes = [re.compile(r"(?:%s)\Z" % (regex)) for regex in regexes]
+        except re.error as error:
+            raise pytheus.http.request.BadRequestError("Invalid name_regex[]: %s" % (error))
+
+    @staticmethod
+    def from_query(query):
+        """Returns a Selector, None if the scrape asks for everything."""
+        names = query.get("name[]", [])
+        prefixes = query.get("name_prefix[]", [])
+        regexes = query.get("name_regex[]", [])
+        if not (names or prefixes or regexes):
+            return None
+        return Selector(names, prefixes, regexes)
+
+    def matches(self, name):
+        return name in self.names or name.startswith(self.prefixes) or \
+            any(regex.match(name) for regex in self.regexes)
+
+
+class Index(object):
+    """
+        The registered metrics by name, sorted so prefixes are a binary
+        search away.
+    """
+
+    def __init__(self, metrics):
+        self.by_name = collections.defaultdict(list)
+        for metric in metrics:
+            self.by_name[metric.name].append(metric)
+        self.names = sorted(self.by_name)
+
+    def select(self, selector):
+        """Returns the metrics selected, in name order."""
+        names = set(name for name in selector.names if name in self.by_name)
+        for prefix in selector.prefixes:
+            start = bisect.bisect_left(self.names, prefix)
+            for name in self.names[start:]:
+                if not name.startswith(prefix):
+                    break
+                names.add(name)
+        if selector.regexes:
+            names.update(name for name in self.names
+                         if any(regex.match(name) for regex in selector.regexes))
+        return [metric for name in sorted(names) for metric in self.by_name[name]]
 
 
 class Base(object):
 
     decorators = collections.OrderedDict()
 
+    def __init__(self, workers=4, processes=0, scheduler=None):
+        if scheduler is None:
+            scheduler = pytheus.scheduler.Base(workers, processes)
+        self.scheduler = scheduler
+        self._fragments = []
+        self._exposition = b""
+        self._index = None
+        self._indexed = None # What the index was built from
+        self.instrumentation = None # pytheus.instrumentation.Base, if enabled
+
     @staticmethod
-    def register(metric, function):
-        logging.info("Registering %s: %s", metric.__class__.__name__, function.__name__)
-        Base.decorators[metric] = {
-            "exec": function,
-            "thread": None,
-            "current_response": None,
-            "last_response": "",
-        }
+    def register(metric, function=None, interval=None, timeout=None, process=False):
+        """Without a function, the metric is only exposed (see scheduler.Job)."""
+        job = pytheus.scheduler.Job(metric, function, interval, timeout, process)
+        logging.info("Registering %s: %s", metric.__class__.__name__, job.name)
+        Base.decorators[metric] = job
+
+    @staticmethod
+    def register_families(metrics, function, interval=None, timeout=None, process=False):
+        """
+            A single function for several metrics: it runs once per
+            interval, each metric is registered with the same Job.
+        """
+        job = pytheus.scheduler.Job(Families(metrics), function, interval, timeout, process)
+        logging.info("Registering %s: %s", ", ".join(m.name for m in metrics), job.name)
+        for metric in metrics:
+            Base.decorators[metric] = job
+
+    def start(self):
+        """Starts running the collectors in the background."""
+        self.scheduler.start(Base.decorators)
+
+    def stop(self):
+        self.scheduler.stop()
+
+    def collected(self):
+        """
+            Collectors run in the background, returns the metrics they
+            measured at least once. Called once per scrape.
+        """
+        if not self.scheduler.running:
+            self.start()
+        metrics = [metric for metric, job in list(Base.decorators.items()) if job.collected]
+        return Base._scraped(metrics + self._internal())
+
+    @staticmethod
+    def _scraped(metrics):
+        """Advances the metrics' scrape count (see meter.Base.scraped)."""
+        for metric in metrics:
+            metric.scraped()
+        return metrics
+
+    def _internal(self):
+        """Our own metrics, the limit counters once a metric hit its limits."""
+        metrics = pytheus.meter.limit_counters()
+        if self.instrumentation is not None:
+            metrics += self.instrumentation.metrics()
+        return metrics
+
+    def index(self):
+        """The Index of the registered metrics, rebuilt when one is added."""
+        registered = (id(Base.decorators), len(Base.decorators))
+        if self._indexed != registered:
+            self._index = Index(list(Base.decorators))
+            self._indexed = registered
+        return self._index
+
+    def select(self, selector):
+        """Returns the collected metrics selected (see Selector)."""
+        if not self.scheduler.running:
+            self.start()
+        metrics = self.index().select(selector)
+        metrics = [metric for metric in metrics if Base.decorators[metric].collected]
+        return Base._scraped(metrics + [metric for metric in self._internal()
+                                        if selector.matches(metric.name)])
 
     def get_metrics(self):
+        """
+            The classic text exposition of the collected metrics, as bytes.
+            Metrics keep a pre-rendered copy of their exposition and only
+            format again what changed, so this is mostly a join of cached
+            fragments into a single buffer.
+            If no fragment changed, the very same object is returned: it's
+            sent as is, scrapes don't copy it.
+        """
+        fragments = [metric.to_bytes() for metric in self.collected()]
 
-        string = ""
-
-        for metric, properties in Base.decorators.items():
-            if not properties["thread"]:
-                logging.debug("Spawning new thread for %s: %s",
-                              metric.__class__.__name__,
-                              properties["exec"].__name__)
-                queue = Queue.Queue()
-                thread = ExceptionThread(target=lambda q: q.put(properties["exec"]()),
-                                         args=(queue,))
-                thread.start()
-                Base.decorators[metric]["thread"] = thread
-                Base.decorators[metric]["current_response"] = queue
-            elif properties["thread"].isAlive():
-                pass
-            else:
-                try:
-                    result = properties["current_response"].get_nowait()
-                    metric.measure(result[0], **result[1])
-                    Base.decorators[metric]["last_response"] = metric.to_string()
-                except Queue.Empty:
-                    logging.warning("Retrying failed collector...")
-                Base.decorators[metric]["thread"] = None
-
-            if Base.decorators[metric]["last_response"]:
-                string += Base.decorators[metric]["last_response"]
-
-        return string
+        unchanged = len(fragments) == len(self._fragments) and \
+            all(new is old for new, old in zip(fragments, self._fragments))
+        if not unchanged:
+            self._fragments = fragments
+            self._exposition = b"".join(fragments)
+        return self._exposition
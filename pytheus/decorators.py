@@ -5,27 +5,89 @@
     You decorate any function with the type of metric you want to collect,
     passing on to the decorator itself any relevant data regarding that
     specific metric.
+
+    Every decorator also takes:
+        interval: seconds between runs of the function.
+        timeout: seconds after which a run is given up on.
+        process: run it in a process pool, for CPU-bound functions.
+    and the cardinality limits of the metric (see pytheus.meter.Base):
+        max_series, overflow, ttl.
+
+    @collector takes several metrics (from pytheus.meter) for a single
+    function, run once per interval however many they are: it returns
+    samples for each of them by name (see pytheus.collector.Families).
+
+    Instead of collecting, the decorated function (or a with block, see
+    pytheus.instrument) may be instrumented, into the series of labels:
+        @histogram(..., timed=True), @summary(..., timed=True): its duration.
+        @counter(..., count_calls=True): how many times it's called.
+        @gauge(..., in_progress=True): how many calls are running.
+
+    @histogram without buckets has exponential ones, of schema and
+    max_buckets (see pytheus.meter.Histogram).
 """
 
-import pytheus.meter
 import pytheus.collector
+import pytheus.instrument
+import pytheus.meter
+
+
+LIMITS = ("max_series", "overflow", "ttl")
 
 
-def metric_decorator(metric):
+def _limits(options):
+    """Takes the cardinality limits out of the decorator's options."""
+    return dict((name, options.pop(name)) for name in LIMITS if name in options)
+
+
+def metric_decorator(metric, interval=None, timeout=None, process=False):
     def real_decorator(function):
-        pytheus.collector.Base.register(metric, function)
+        pytheus.collector.Base.register(metric, function, interval, timeout, process)
         return function
     return real_decorator
 
 
-def gauge(name, description=None):
-    return metric_decorator(pytheus.meter.Gauge(name, description))
+def instrument_decorator(instrument, metric, labels):
+    """Returns the instrument (a decorator and context manager, see measure())."""
+    pytheus.collector.Base.register(metric)
+    return instrument(metric, **(labels or {}))
+
+
+def gauge(name, description=None, multiprocess_mode="all", columnar=False,
+          in_progress=False, labels=None, **options):
+    limits = _limits(options)
+    metric = pytheus.meter.Gauge(name, description, multiprocess_mode, columnar, **limits)
+    if in_progress:
+        return instrument_decorator(pytheus.instrument.InProgress, metric, labels)
+    return metric_decorator(metric, **options)
 
-def counter(name, description=None):
-    return metric_decorator(pytheus.meter.Counter(name, description))
+def counter(name, description=None, columnar=False, count_calls=False, labels=None,
+            **options):
+    limits = _limits(options)
+    metric = pytheus.meter.Counter(name, description, columnar=columnar, **limits)
+    if count_calls:
+        return instrument_decorator(pytheus.instrument.CountCalls, metric, labels)
+    return metric_decorator(metric, **options)
 
-def summary(name, buckets, description=None):
-    return metric_decorator(pytheus.meter.Summary(name, buckets, description))
+def summary(name, buckets, description=None, error=0.01, max_age=None, age_buckets=5,
+            timed=False, labels=None, **options):
+    limits = _limits(options)
+    metric = pytheus.meter.Summary(name, buckets, description,
+                                   error, max_age, age_buckets, **limits)
+    if timed:
+        return instrument_decorator(pytheus.instrument.Timed, metric, labels)
+    return metric_decorator(metric, **options)
 
-def histogram(name, buckets, description=None):
-    return metric_decorator(pytheus.meter.Histogram(name, buckets, description))
+def histogram(name, buckets=None, description=None, timed=False, labels=None,
+              schema=3, max_buckets=160, **options):
+    limits = _limits(options)
+    metric = pytheus.meter.Histogram(name, buckets, description, schema, max_buckets, **limits)
+    if timed:
+        return instrument_decorator(pytheus.instrument.Timed, metric, labels)
+    return metric_decorator(metric, **options)
+
+def collector(*metrics, **schedule):
+    def real_decorator(function):
+        pytheus.collector.Base.register_families(metrics, function, **schedule)
+        return function
+    return real_decorator
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""
+    Exposition formats, picked from the Accept header of the scrape:
+
+        Text: the classic Prometheus text format (version 0.0.4).
+        OpenMetrics: OpenMetrics text (1.0.0), with _created series,
+                     exemplars and the closing # EOF.
+        Protobuf: length-delimited io.prometheus.client.MetricFamily
+                  messages, the cheapest for Prometheus to parse.
+
+    Each encoder writes every family into a single bytearray.
+"""
+
+import math
+import numbers
+import struct
+import time
+
+
+class Base(object):
+    """
+        Attributes:
+            media_type: what we match in the Accept header
+            content_type: what we answer with
+    """
+
+    media_type = None
+    content_type = None
+
+    def matches(self, media, parameters):
+        """Whether this encoder satisfies a media range of the Accept header."""
+        return media == self.media_type
+
+    def encode(self, metrics):
+        """Returns the exposition of metrics (an iterable of meter.Base)."""
+        out = bytearray()
+        for metric in metrics:
+            self.family(out, metric)
+        self.finish(out)
+        return bytes(out)
+
+    def family(self, out, metric):
+        raise NotImplementedError
+
+    def finish(self, out):
+        pass
+
+
+def _bytes(value):
+    """Label values might be unicode, everything else is ascii."""
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u"")):
+        value = str(value)
+    return value.encode("utf-8")
+
+
+def _metric_type(metric):
+    return metric.__class__.__name__.lower()
+
+
+def _series(metric):
+    with metric.lock:
+        return list(metric._series())
+
+
+class Text(Base):
+    """The classic text format, out of the meters' cached fragments."""
+
+    media_type = "text/plain"
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def family(self, out, metric):
+        out += metric.to_bytes()
+
+
+def _number(value):
+    """OpenMetrics spells out infinities and NaN."""
+    if isinstance(value, numbers.Integral):
+        return _bytes("%d" % (value))
+    value = float(value)
+    if math.isnan(value):
+        return b"NaN"
+    if math.isinf(value):
+        return b"+Inf" if value > 0 else b"-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return _bytes("%.1f" % (value))
+    return _bytes(repr(value))
+
+
+def _escape(value):
+    return _bytes(value).replace(b"\\", b"\\\\").replace(b"\n", b"\\n").replace(b'"', b'\\"')
+
+
+class OpenMetrics(Base):
+
+    media_type = "application/openmetrics-text"
+    content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def _labels(self, out, labels, extra=None):
+        if not labels and extra is None:
+            return
+        out += b"{"
+        first = True
+        for name, value in labels.items():
+            if not first:
+                out += b","
+            first = False
+            out += _bytes(name) + b'="' + _escape(value) + b'"'
+        if extra is not None:
+            if not first:
+                out += b","
+            out += extra
+        out += b"}"
+
+    def _sample(self, out, name, labels, value, extra=None, exemplar=None, timestamp=None):
+        out += name
+        self._labels(out, labels, extra)
+        out += b" " + _number(value)
+        if timestamp is not None:
+            out += b" " + _bytes("%d" % (timestamp))
+        if exemplar is not None:
+            exemplar_labels, exemplar_value, exemplar_time = exemplar
+            out += b" # "
+            if exemplar_labels:
+                self._labels(out, exemplar_labels)
+            else:
+                out += b"{}"
+            out += b" " + _number(exemplar_value) + b" " + _bytes("%.3f" % (exemplar_time))
+        out += b"\n"
+
+    def family(self, out, metric):
+        metric_type = _metric_type(metric)
+        name = _bytes(metric.name)
+        if metric_type == "counter" and name.endswith(b"_total"):
+            name = name[:-len(b"_total")]
+        out += b"# HELP " + name + b" " + _escape(metric.description) + b"\n"
+        out += b"# TYPE " + name + b" " + _bytes(metric_type) + b"\n"
+        for series in _series(metric):
+            with series.lock:
+                getattr(self, "_" + metric_type)(out, name, series)
+
+    def _gauge(self, out, name, series):
+        timestamp = None
+        if series.timestamp:
+            timestamp = int(time.time())
+        self._sample(out, name, series.labels, series.value, timestamp=timestamp)
+
+    def _counter(self, out, name, series):
+        self._sample(out, name + b"_total", series.labels, series.value,
+                     exemplar=series.exemplar)
+        self._sample(out, name + b"_created", series.labels, series.created)
+
+    def _summary(self, out, name, series):
+        for quantile in series.buckets:
+            self._sample(out, name, series.labels, series.estimator.query(quantile),
+                         b'quantile="' + _number(float(quantile)) + b'"')
+        self._sample(out, name + b"_sum", series.labels, series.sum)
+        self._sample(out, name + b"_count", series.labels, series.count)
+        self._sample(out, name + b"_created", series.labels, series.created)
+
+    def _histogram(self, out, name, series):
+        cumulative = 0
+        bounds, counts = series.classic()
+        exemplars = series.exemplars or [None] * len(counts)
+        for bound, count, exemplar in zip(bounds, counts, exemplars):
+            cumulative += int(count)
+            self._sample(out, name + b"_bucket", series.labels, cumulative,
+                         b'le="' + _number(float(bound)) + b'"', exemplar)
+        self._sample(out, name + b"_sum", series.labels, series.sum)
+        self._sample(out, name + b"_count", series.labels, series.count)
+        self._sample(out, name + b"_created", series.labels, series.created)
+
+    def finish(self, out):
+        out += b"# EOF\n"
+
+
+# Protocol buffers wire format, see io.prometheus.client (metrics.proto)
+VARINT = 0
+FIXED64 = 1
+DELIMITED = 2
+
+TYPES = {"counter": 0, "gauge": 1, "summary": 2, "histogram": 4}
+
+_double = struct.Struct("<d")
+
+
+def _varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _key(out, field, wire_type):
+    _varint(out, (field << 3) | wire_type)
+
+
+def _double_field(out, field, value):
+    _key(out, field, FIXED64)
+    out += _double.pack(float(value))
+
+
+def _varint_field(out, field, value):
+    _key(out, field, VARINT)
+    _varint(out, int(value))
+
+
+def _signed_field(out, field, value):
+    """sint32 and sint64, zigzag encoded."""
+    value = int(value)
+    _varint_field(out, field, (value << 1) ^ (value >> 63))
+
+
+def _delimited(out, field, body):
+    _key(out, field, DELIMITED)
+    _varint(out, len(body))
+    out += body
+
+
+def _timestamp(seconds):
+    """google.protobuf.Timestamp"""
+    body = bytearray()
+    _varint_field(body, 1, int(seconds))
+    _varint_field(body, 2, int((seconds % 1) * 1e9))
+    return body
+
+
+def _label_pairs(out, field, labels):
+    for name, value in labels.items():
+        pair = bytearray()
+        _delimited(pair, 1, _bytes(name))
+        _delimited(pair, 2, _bytes(value))
+        _delimited(out, field, pair)
+
+
+def _exemplar(exemplar):
+    labels, value, timestamp = exemplar
+    body = bytearray()
+    _label_pairs(body, 1, labels)
+    _double_field(body, 2, value)
+    _delimited(body, 3, _timestamp(timestamp))
+    return body
+
+
+class Protobuf(Base):
+
+    media_type = "application/vnd.google.protobuf"
+    content_type = ("application/vnd.google.protobuf; "
+                    "proto=io.prometheus.client.MetricFamily; encoding=delimited")
+
+    def matches(self, media, parameters):
+        return media == self.media_type and \
+            parameters.get("proto") == "io.prometheus.client.MetricFamily" and \
+            parameters.get("encoding") == "delimited"
+
+    def family(self, out, metric):
+        metric_type = _metric_type(metric)
+        family = bytearray()
+        _delimited(family, 1, _bytes(metric.name))
+        _delimited(family, 2, _bytes(metric.description))
+        _varint_field(family, 3, TYPES[metric_type])
+        encode = getattr(self, "_" + metric_type)
+        for series in _series(metric):
+            body = bytearray()
+            _label_pairs(body, 1, series.labels)
+            with series.lock:
+                encode(body, series)
+            _delimited(family, 4, body)
+        _varint(out, len(family))
+        out += family
+
+    def _gauge(self, out, series):
+        value = bytearray()
+        _double_field(value, 1, series.value)
+        _delimited(out, 2, value)
+        if series.timestamp:
+            _varint_field(out, 6, int(time.time() * 1000))
+
+    def _counter(self, out, series):
+        value = bytearray()
+        _double_field(value, 1, series.value)
+        if series.exemplar is not None:
+            _delimited(value, 2, _exemplar(series.exemplar))
+        _delimited(value, 3, _timestamp(series.created))
+        _delimited(out, 3, value)
+
+    def _summary(self, out, series):
+        value = bytearray()
+        _varint_field(value, 1, series.count)
+        _double_field(value, 2, series.sum)
+        for quantile in series.buckets:
+            body = bytearray()
+            _double_field(body, 1, quantile)
+            _double_field(body, 2, series.estimator.query(quantile))
+            _delimited(value, 3, body)
+        _delimited(value, 4, _timestamp(series.created))
+        _delimited(out, 4, value)
+
+    def _histogram(self, out, series):
+        value = bytearray()
+        _varint_field(value, 1, series.count)
+        _double_field(value, 2, series.sum)
+        if getattr(series, "schema", None) is not None:
+            self._native(value, series)
+            _delimited(out, 7, value)
+            return
+        cumulative = 0
+        exemplars = series.exemplars or [None] * len(series.counts)
+        # The +Inf bucket is implied by the sample count
+        for bound, count, exemplar in zip(series.buckets, series.counts, exemplars):
+            cumulative += int(count)
+            body = bytearray()
+            _varint_field(body, 1, cumulative)
+            _double_field(body, 2, bound)
+            if exemplar is not None:
+                _delimited(body, 3, _exemplar(exemplar))
+            _delimited(value, 3, body)
+        _delimited(value, 15, _timestamp(series.created))
+        _delimited(out, 7, value)
+
+
+    def _native(self, out, series):
+        """The fields of a native histogram, out of an ExponentialBucket."""
+        _signed_field(out, 5, series.schema)
+        _double_field(out, 6, series.zero_threshold)
+        _varint_field(out, 7, series.zero_count)
+        if series.negative:
+            _spans(out, 9, 10, series.negative)
+        if series.positive:
+            _spans(out, 12, 13, series.positive)
+        elif not series.negative:
+            _delimited(out, 12, b"") # No buckets yet, still a native histogram
+        _delimited(out, 15, _timestamp(series.created))
+
+
+def _spans(out, span_field, delta_field, buckets):
+    """
+        Buckets ({index: count}) as spans of consecutive indexes (offset
+        from the end of the previous span) and the deltas of their counts.
+    """
+    indexes = sorted(buckets)
+    start = previous = indexes[0]
+    end = None # Of the previous span
+    for index in indexes[1:] + [None]:
+        if index is not None and index == previous + 1:
+            previous = index
+            continue
+        span = bytearray()
+        _signed_field(span, 1, start if end is None else start - end)
+        _varint_field(span, 2, previous - start + 1)
+        _delimited(out, span_field, span)
+        end = previous + 1
+        start = previous = index
+    last = 0
+    for index in indexes:
+        _signed_field(out, delta_field, buckets[index] - last)
+        last = buckets[index]
+
+
+# In our order of preference, when the client likes several as much
+ENCODERS = (Protobuf, OpenMetrics, Text)
+
+
+def negotiate(media_ranges):
+    """
+        Returns the encoder for the media ranges of an Accept header
+        (see http.request.Base.media_ranges), the classic text format if
+        none of them is supported.
+    """
+    best = None
+    best_quality = 0.0
+    for encoder in ENCODERS:
+        encoder = encoder()
+        for media, parameters, quality in media_ranges:
+            if quality > best_quality and encoder.matches(media, parameters):
+                best, best_quality = encoder, quality
+    return best or Text()
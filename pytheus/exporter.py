@@ -1,26 +1,182 @@
 #!/usr/bin/env python
 
+import collections
 import logging
+import threading
+import time
+import zlib
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
 import pytheus.collector
+import pytheus.encoders
+import pytheus.instrumentation
+import pytheus.multiprocess
+import pytheus.scheduler
 import pytheus.http.server
 import pytheus.http.response
 
 
+class AsyncNotSupportedError(Exception):
+    """When asyncio isn't available (Python 2)."""
+    pass
+
+
 class Base(object):
+    """
+        With instrumentation, the exporter also exposes its own metrics,
+        see pytheus.instrumentation.
+    """
+
+    # Supported content codings, in order of preference
+    encodings = ("gzip", "deflate")
+    compression_level = 6
+    # Not worth compressing below this
+    min_compress_size = 1024
+    # Compressed bodies kept, text and protobuf, per encoding and selector
+    max_compressed = 8
+
+    def __init__(self, address="0.0.0.0", port=8000, certfile=None,
+                 mode="select", workers=8, backlog=128,
+                 collector_workers=4, collector_processes=0,
+                 keep_alive=True, idle_timeout=15, max_requests=100, tls=None,
+                 instrumentation=False):
+        self.server = self._build_server(address,
+                                         port,
+                                         certfile,
+                                         mode=mode,
+                                         workers=workers,
+                                         backlog=backlog,
+                                         keep_alive=keep_alive,
+                                         idle_timeout=idle_timeout,
+                                         max_requests=max_requests,
+                                         tls=tls)
+        scheduler = self._build_scheduler(collector_workers, collector_processes)
+        self.collector = pytheus.collector.Base(scheduler=scheduler)
+        self.multiprocess = pytheus.multiprocess.Collector()
+        # {(hash(exposition), encoding): (exposition, compressed)}, oldest first
+        self._compressed = collections.OrderedDict()
+        self.compress_hits = 0
+        self.compress_misses = 0
+        self._compress_lock = threading.Lock()
+        self._instrument(instrumentation)
 
-    def __init__(self, address="0.0.0.0", port=8000, certfile=None):
-        self.server = pytheus.http.server.Base(address,
-                                               port,
-                                               certfile,
-                                               self.handle_request)
-        self.collector = pytheus.collector.Base()
+    def _build_server(self, address, port, certfile, **options):
+        """The HTTP server, answering with handle_request."""
+        return pytheus.http.server.Base(address, port, certfile, self.handle_request, **options)
+
+    def _build_scheduler(self, workers, processes):
+        """What runs the collectors."""
+        return pytheus.scheduler.Base(workers, processes)
+
+    def _instrument(self, enabled):
+        self.instrumentation = None
+        if enabled:
+            self.instrumentation = pytheus.instrumentation.Base(self.collector, self.server)
+            self.collector.instrumentation = self.instrumentation
+
+    def compress(self, content, encoding):
+        """
+            Compressed bodies are cached until the exposition changes, so
+            concurrent scrapers only pay for compressing it once. A few are
+            kept, scrapers asking for other formats or families don't evict
+            each other's.
+        """
+        key = (hash(content), encoding) # Computed once per string, then cached
+        with self._compress_lock:
+            cached = self._compressed.pop(key, None)
+            # Identical objects compare in O(1), which is the common case
+            if cached is not None and cached[0] == content:
+                self._compressed[key] = cached # Most recently used
+                self.compress_hits += 1
+                return cached[1]
+            self.compress_misses += 1
+            if encoding == "gzip":
+                compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 31)
+                body = compressor.compress(content) + compressor.flush()
+            else:
+                body = zlib.compress(content, self.compression_level)
+            self._compressed[key] = (content, body)
+            while len(self._compressed) > self.max_compressed:
+                self._compressed.popitem(last=False)
+            return body
 
     def handle_request(self, request):
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            started = time.time()
         response = pytheus.http.response.Base(200)
-        response.content_type = "text/plain"
-        response.content = self.collector.get_metrics()
+        encoder = pytheus.encoders.negotiate(request.media_ranges())
+        selector = pytheus.collector.Selector.from_query(request.query)
+        if pytheus.multiprocess.directory is not None:
+            # Our own metrics are in there too, along with every worker's.
+            # Merged samples only exist as text.
+            encoder = pytheus.encoders.Text()
+            response.content = self.multiprocess.to_bytes(selector)
+        elif selector is not None:
+            # Only the families asked for are rendered
+            response.content = encoder.encode(self.collector.select(selector))
+        elif isinstance(encoder, pytheus.encoders.Text):
+            # Cached, the very same string as long as nothing changed
+            response.content = self.collector.get_metrics()
+        else:
+            response.content = encoder.encode(self.collector.collected())
+        response.content_type = encoder.content_type
+        if instrumentation is not None:
+            instrumentation.scraped(started, len(response.content), encoder)
+
+        if len(response.content) >= self.min_compress_size:
+            encoding = request.preferred_encoding(self.encodings)
+            if encoding:
+                response.content = self.compress(response.content, encoding)
+                response.content_encoding = encoding
         return response
 
     def start(self):
+        self.collector.start()
         self.server.serve_forever()
+
+
+class AsyncBase(Base):
+    """
+        Serves HTTP and runs every collector on a single asyncio event
+        loop. Coroutine collectors (async def) need no thread at all, plain
+        functions run on a pool of collector_workers threads.
+    """
+
+    def __init__(self, address="0.0.0.0", port=8000, certfile=None,
+                 backlog=128, collector_workers=4, loop=None,
+                 keep_alive=True, idle_timeout=15, max_requests=100, tls=None,
+                 instrumentation=False):
+        if asyncio is None:
+            raise AsyncNotSupportedError("asyncio is required, use pytheus.exporter.Base.")
+        self.loop = loop or asyncio.new_event_loop()
+        super(AsyncBase, self).__init__(address, port, certfile,
+                                        backlog=backlog,
+                                        collector_workers=collector_workers,
+                                        keep_alive=keep_alive,
+                                        idle_timeout=idle_timeout,
+                                        max_requests=max_requests,
+                                        tls=tls,
+                                        instrumentation=instrumentation)
+
+    def _build_server(self, address, port, certfile, mode=None, workers=None, **options):
+        """Served from the loop, mode and workers don't apply."""
+        return pytheus.http.server.AsyncBase(address, port, certfile, self.handle_request,
+                                             **options)
+
+    def _build_scheduler(self, workers, processes):
+        return pytheus.scheduler.AsyncBase(self.loop, workers)
+
+    def start(self):
+        asyncio.set_event_loop(self.loop)
+        self.collector.start()
+        self.loop.run_until_complete(self.server.serve(self.loop))
+        self.loop.run_forever()
+
+    def stop(self):
+        self.collector.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -8,12 +8,65 @@
 
 import logging
 import email
+import re
+
+try:
+    import urlparse
+except ImportError: # Python 3
+    import urllib.parse as urlparse
 
 
 class BadRequestError(Exception):
     """Unable to properly parse the request."""
     pass
 
+class RequestTooLargeError(BadRequestError):
+    """The request headers exceed Parser.max_head_size, or its body max_body_size."""
+    pass
+
+
+class Parser(object):
+    """
+        Incremental request parser. Feed it whatever was read from the
+        socket: it returns every complete request (several if pipelined)
+        and keeps any partial one for the next read.
+    """
+
+    max_head_size = 65536
+    max_body_size = 65536 # Scrapes have none, nothing else is served
+    content_length = re.compile(r'^content-length:\s*(\d+)\s*$', re.I | re.M)
+
+    def __init__(self):
+        self.buffer = ""
+
+    def _end_of_head(self):
+        """Returns (end of the head, separator length), lenient about CRLF."""
+        ends = [(self.buffer.find(sep), len(sep)) for sep in ("\r\n\r\n", "\n\n")]
+        ends = [end for end in ends if end[0] >= 0]
+        return min(ends) if ends else (-1, 0)
+
+    def feed(self, data):
+        if not isinstance(data, str): # Python 3: bytes
+            data = data.decode("latin-1")
+        self.buffer += data
+        requests = []
+        while self.buffer:
+            end, separator = self._end_of_head()
+            if end < 0:
+                if len(self.buffer) > Parser.max_head_size:
+                    raise RequestTooLargeError
+                break
+            match = Parser.content_length.search(self.buffer, 0, end)
+            length = int(match.group(1)) if match else 0
+            if length > Parser.max_body_size:
+                raise RequestTooLargeError
+            total = end + separator + length
+            if len(self.buffer) < total:
+                break
+            requests.append(self.buffer[:total])
+            self.buffer = self.buffer[total:]
+        return requests
+
 
 class Base(object):
 
@@ -21,6 +74,7 @@ class Base(object):
         Attributes:
             method: GET, POST
             path: /, /metrics
+            query: {name[]: [foo, bar]}
             protocol: HTTP/1.0
             headers: {
                 host: localhost:5000
@@ -32,6 +86,7 @@ class Base(object):
 
         self.socket = socket
         self.address = address
+        self.protocol = "HTTP/1.0"
         raw_string = raw_string.strip()
         if not raw_string:
             logging.error("Empty request from: %s", address)
@@ -43,7 +98,8 @@ class Base(object):
 
             first_line = lines[0].split(' ')
             self.method = first_line[0]
-            self.path = first_line[1]
+            self.path, _, query = first_line[1].partition("?")
+            self.query = urlparse.parse_qs(query)
             if len(first_line) == 3:
                 self.protocol = first_line[2]
 
@@ -51,3 +107,66 @@ class Base(object):
         except Exception:
             logging.error("Unable to parse request: [%s]", raw_string, exc_info=True)
             raise BadRequestError
+
+    @property
+    def keep_alive(self):
+        """Whether the client wants the connection to persist."""
+        connection = (self.headers.get("Connection") or "").lower()
+        if self.protocol == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
+
+    @staticmethod
+    def _parameters(parts):
+        """Returns ({name: value}, q-value) from the ;-separated parameters."""
+        parameters = {}
+        quality = 1.0
+        for param in parts:
+            name, _, value = param.strip().partition("=")
+            name = name.strip().lower()
+            value = value.strip().strip('"')
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+            elif name:
+                parameters[name] = value
+        return parameters, quality
+
+    def preferred_encoding(self, supported):
+        """
+            Returns the content coding (from supported, in our order of
+            preference) the client accepts with the highest q-value, None
+            if it only accepts identity.
+        """
+        header = self.headers.get("Accept-Encoding", "")
+        accepted = {}
+        for item in header.split(","):
+            parts = item.strip().split(";")
+            coding = parts[0].strip().lower()
+            if not coding:
+                continue
+            accepted[coding] = Base._parameters(parts[1:])[1]
+
+        best = None
+        best_quality = 0.0
+        for coding in supported:
+            quality = accepted.get(coding, accepted.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = coding, quality
+        return best
+
+    def media_ranges(self):
+        """
+            Returns the Accept header as a list of
+            (media type, {parameter: value}, q-value).
+        """
+        ranges = []
+        for item in (self.headers.get("Accept") or "").split(","):
+            parts = item.strip().split(";")
+            media = parts[0].strip().lower()
+            if media:
+                parameters, quality = Base._parameters(parts[1:])
+                ranges.append((media, parameters, quality))
+        return ranges
@@ -8,6 +8,46 @@
 
 import logging
 import datetime
+import mmap
+import os
+
+
+try:
+    view = buffer # Python 2, unlike memoryview it also takes mmaps
+except NameError:
+    view = memoryview
+
+
+def tail(data, offset):
+    """What's left of data past offset, without copying it."""
+    if view is memoryview:
+        return memoryview(data)[offset:]
+    return view(data, offset)
+
+
+class File(object):
+    """
+        A body sent straight from a file: with sendfile() where the socket
+        allows it, out of a read-only mmap otherwise.
+    """
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.size = os.fstat(fileobj.fileno()).st_size
+        self.offset = 0
+        self._map = None
+
+    def __len__(self):
+        return self.size - self.offset
+
+    def view(self):
+        """The part that's left to send."""
+        if self._map is None:
+            self._map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return tail(self._map, self.offset)
+
+    def close(self):
+        self.file.close()
 
 
 class Base(object):
@@ -58,10 +98,14 @@ class Base(object):
     def __init__(self, code=200):
         self.content = ''
         self.code = code
-        self.protocol = 'HTTP/1.0'
+        self.protocol = 'HTTP/1.1'
         self.server = "Promenade/0.1 (noarch)"
         self.last_modified = ''
         self.content_type = 'text/html'
+        self.content_encoding = None
+        # An open file to send instead of content, see File
+        self.file = None
+        self.keep_alive = False
         self._redirect = None
         self._last_modified = None
 
@@ -81,7 +125,9 @@ class Base(object):
 
     @property
     def content_length(self):
-        return str(len(self.content))
+        if self.file is not None:
+            return str(os.fstat(self.file.fileno()).st_size)
+        return str(len(self.body()))
 
     @property
     def last_modified(self):
@@ -102,7 +148,8 @@ class Base(object):
     def last_modified(self, value):
         self._last_modified = value
 
-    def to_string(self):
+    def head(self):
+        """The status line and headers, as bytes."""
         header = ' '.join([self.protocol, str(self.code), Base.codes[self.code]])
         logging.debug("RESPONSE: %s", header)
         out = [
@@ -112,9 +159,33 @@ class Base(object):
             'Last-Modified: ' + self.last_modified,
             'Content-Length: ' + self.content_length,
             'Content-Type: ' + self.content_type,
-            'Connection: close',
-            '\r\n',
-            self.content,
         ]
+        if self.content_encoding:
+            out.append('Content-Encoding: ' + self.content_encoding)
+            out.append('Vary: Accept-Encoding')
+        out.append('Connection: ' + ('keep-alive' if self.keep_alive else 'close'))
+
+        head = '\r\n'.join(out) + '\r\n\r\n'
+        if not isinstance(head, bytes):
+            head = head.encode('latin-1')
+        return head
 
-        return '\n'.join(out)
+    def body(self):
+        """The content as bytes (or any buffer), never copied if it already is."""
+        if isinstance(self.content, (bytes, bytearray, memoryview)):
+            return self.content
+        return self.content.encode('utf-8')
+
+    def buffers(self):
+        """What to send, in order: the head and the body, as they are."""
+        if self.file is not None:
+            return [self.head(), File(self.file)]
+        return [self.head(), self.body()]
+
+    def to_string(self):
+        if self.file is not None:
+            return self.head() + self.file.read()
+        body = self.body()
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        return self.head() + bytes(body)
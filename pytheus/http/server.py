@@ -4,15 +4,44 @@
     Barebones HTTP server.
 
     Do NOT use this for anything else other than Prometheus exporting.
+
+    Three serving modes are available:
+        blocking: accept and handle one connection at a time (legacy).
+        select: single threaded, non-blocking event loop. Slow clients
+                (or slow TLS handshakes) never stall other scrapers.
+        threaded: accept loop feeding a bounded pool of worker threads.
+
+    Connections are persistent (HTTP/1.1 keep-alive) unless the client
+    asks otherwise, so frequent scrapes don't pay for a new TCP connection
+    and TLS handshake every time. They're closed after idle_timeout
+    seconds without a request, or once they served max_requests. The
+    blocking mode always closes them, it can only serve one at a time.
+    In threaded mode idle ones are also closed as soon as connections
+    wait for a worker, so kept alive scrapers don't starve the others.
 """
 
 import logging
 import os
+import select
 import socket
 import ssl
+import threading
+import time
+
+try:
+    import Queue
+except ImportError: # Python 3
+    import queue as Queue
 
 import pytheus.http.request
 import pytheus.http.response
+import pytheus.http.tls
+
+
+MODES = ("blocking", "select", "threaded")
+
+sendfile = getattr(os, "sendfile", None) # Python 3 only
+sendmsg_supported = hasattr(socket.socket, "sendmsg")
 
 
 class CertNotFoundError(Exception):
@@ -23,25 +52,158 @@ class InvalidHandlerImplementation(Exception):
     """When the response handler returns an incorrect response object."""
     pass
 
+class InvalidModeError(Exception):
+    """When the requested serving mode isn't one of MODES."""
+    pass
+
+
+def send(sock, buffers):
+    """
+        Sends what it can of buffers without copying them, returns how
+        many bytes were sent. Scatter/gather with sendmsg() on Python 3,
+        files go through sendfile().
+    """
+    first = buffers[0]
+    plain = not isinstance(sock, ssl.SSLSocket)
+    if isinstance(first, pytheus.http.response.File):
+        if sendfile is not None and plain:
+            return sendfile(sock.fileno(), first.file.fileno(), first.offset, len(first))
+        return sock.send(first.view())
+    if sendmsg_supported and plain and len(buffers) > 1:
+        batch = []
+        for buf in buffers:
+            if isinstance(buf, pytheus.http.response.File):
+                break
+            batch.append(buf)
+        return sock.sendmsg(batch)
+    return sock.send(first)
+
+
+def consume(buffers, sent):
+    """
+        Returns the buffers left after sent bytes went out, closing the
+        files that were completely sent (all of them when sent is None).
+    """
+    left = []
+    for buf in buffers:
+        is_file = isinstance(buf, pytheus.http.response.File)
+        if sent is None or sent >= len(buf):
+            if sent is not None:
+                sent -= len(buf)
+            if is_file:
+                buf.close()
+            continue
+        if sent and is_file:
+            buf.offset += sent
+        elif sent:
+            buf = pytheus.http.response.tail(buf, sent)
+        sent = 0
+        left.append(buf)
+    return left
+
+
+def sendall(sock, buffers):
+    try:
+        while buffers:
+            buffers = consume(buffers, send(sock, buffers))
+    finally:
+        consume(buffers, None)
+
+
+class Connection(object):
+    """State of a single client connection in the select event loop."""
+
+    def __init__(self, sock, address, handshaking=False):
+        self.sock = sock
+        self.address = address
+        self.handshaking = handshaking
+        self.want_write = False
+        self.outbuf = [] # Buffers left to send, see send()
+        self.parser = pytheus.http.request.Parser()
+        self.served = 0
+        self.closing = False # Once outbuf is sent
+        self.last_active = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class Stats(object):
+    """Connection counts of a server, see pytheus.instrumentation."""
+
+    def __init__(self):
+        self.accepted = 0
+        self.closed = 0
+        self.pending = None # Queue of the threaded mode
+        self.lock = threading.Lock()
+
+    def opened(self):
+        with self.lock:
+            self.accepted += 1
+
+    def close(self):
+        with self.lock:
+            self.closed += 1
+
+    @property
+    def open(self):
+        return self.accepted - self.closed
+
+    @property
+    def queued(self):
+        """Connections waiting for a worker."""
+        return self.pending.qsize() if self.pending is not None else 0
+
 
 class Base(object):
 
+    # How often (seconds) the serving loops wake up to check for stop()
+    poll_interval = 2
+    # How often (seconds) idle threaded connections check for waiting ones
+    idle_check = 0.1
+
     def __init__(self,
                  address="0.0.0.0",
                  port=7777,
                  certfile=None,
-                 response_handler=None):
+                 response_handler=None,
+                 mode="select",
+                 workers=8,
+                 backlog=128,
+                 timeout=10,
+                 keep_alive=True,
+                 idle_timeout=15,
+                 max_requests=100,
+                 tls=None):
 
         self.address = address
         self.port = port
         self.certfile = certfile
         self.request_handler = pytheus.http.request.Base
         self.response_handler = response_handler
+        self.mode = mode
+        self.workers = workers
+        self.backlog = backlog
+        self.timeout = timeout
+        self.keep_alive = keep_alive and mode != "blocking"
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.running = False
+        self.stats = Stats()
+
+        if self.mode not in MODES:
+            raise InvalidModeError("Mode must be one of: %s" % (", ".join(MODES)))
 
-        if not self.certfile:
+        # A pytheus.http.tls.Context, for more than just a certificate
+        self.tls = tls
+        if self.tls:
+            self.certfile = self.tls.certfile
+        elif not self.certfile:
             logging.warning("No certificate specified, using bare http.")
         elif not os.path.isfile(self.certfile):
             raise CertNotFoundError("Unable to find certificate in: %s" % (self.certfile))
+        else:
+            self.tls = pytheus.http.tls.Context(self.certfile)
 
         if not self.response_handler:
             logging.error("No response handler defined, httpd will be useless!")
@@ -52,17 +214,32 @@ class Base(object):
         # Disable nagle algorithm, makes us look better in benchmarks
         self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.bind((self.address, self.port))
-        self.sock.listen(10)
+        self.port = self.sock.getsockname()[1] # In case we bound to port 0
+        self.sock.listen(self.backlog)
 
     def serve_forever(self):
-        logging.info("Starting http server: %s:%i", self.address, self.port)
-        while True:
+        logging.info("Starting http server (%s): %s:%i", self.mode, self.address, self.port)
+        self.running = True
+        try:
+            getattr(self, "_serve_" + self.mode)()
+        finally:
+            self.running = False
+
+    def stop(self):
+        """Ask serve_forever to return, takes at most poll_interval seconds."""
+        self.running = False
+
+    def _wrap(self, sock, **kwargs):
+        return self.tls.wrap(sock, **kwargs)
+
+    def _serve_blocking(self):
+        self.sock.settimeout(self.poll_interval)
+        while self.running:
             try:
-                self.sock.settimeout(2)
                 sock, addr = self.sock.accept()
-
-                if self.certfile:
-                    sock = ssl.wrap_socket(sock, certfile=self.certfile, server_side=True)
+                sock.settimeout(self.timeout)
+                if self.tls:
+                    sock = self._wrap(sock)
 
                 logging.debug("Received connection: %s %s", sock, addr)
                 self.handle_connection(sock, addr)
@@ -70,21 +247,276 @@ class Base(object):
             except socket.error: # Timeout
                 logging.debug("No connections received, recycling.")
 
-    def handle_connection(self, sock, address):
+    def _serve_threaded(self):
+        # Bounded, so a flood of connections applies backpressure to accept()
+        # instead of growing the queue without limit.
+        pending = Queue.Queue(self.workers * 4)
+        self.stats.pending = pending
+        pool = []
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(pending,))
+            thread.daemon = True
+            thread.start()
+            pool.append(thread)
+
+        self.sock.settimeout(self.poll_interval)
+        try:
+            while self.running:
+                try:
+                    sock, addr = self.sock.accept()
+                except socket.error: # Timeout
+                    logging.debug("No connections received, recycling.")
+                    continue
+                logging.debug("Received connection: %s %s", sock, addr)
+                pending.put((sock, addr))
+        finally:
+            for _ in pool:
+                pending.put(None)
+
+    def _worker(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            sock, addr = item
+            try:
+                sock.settimeout(self.timeout)
+                # Handshake happens here, off the accept loop
+                if self.tls:
+                    sock = self._wrap(sock)
+                self.handle_connection(sock, addr)
+            except (socket.error, ssl.SSLError):
+                logging.debug("Connection from %s failed.", addr, exc_info=True)
+                sock.close()
+            except Exception:
+                logging.exception("Unexpected error handling %s", addr)
+                sock.close()
+
+    def _serve_select(self):
+        self.sock.setblocking(0)
+        connections = {}
+
+        while self.running:
+            readers = [self.sock]
+            writers = []
+            for conn in connections.values():
+                if conn.want_write:
+                    writers.append(conn)
+                else:
+                    readers.append(conn)
+
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  self.poll_interval)
+
+            for conn in readable:
+                if conn is self.sock:
+                    self._accept(connections)
+                else:
+                    self._on_readable(conn, connections)
+            for conn in writable:
+                if conn.fileno() in connections:
+                    self._on_writable(conn, connections)
+            self._sweep(connections)
+
+        for conn in list(connections.values()):
+            self._close(conn, connections)
+
+    def _accept(self, connections):
+        # Drain the accept queue, there may be more than one pending
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                return
+            logging.debug("Received connection: %s %s", sock, addr)
+            sock.setblocking(0)
+            handshaking = False
+            if self.tls:
+                sock = self._wrap(sock, do_handshake_on_connect=False)
+                handshaking = True
+            conn = Connection(sock, addr, handshaking)
+            connections[conn.fileno()] = conn
+            self.stats.opened()
+
+    def _sweep(self, connections):
+        """Closes connections idle for too long, or too slow to send a request."""
+        now = time.time()
+        for conn in list(connections.values()):
+            if conn.want_write:
+                continue
+            idle = conn.served and not conn.parser.buffer and not conn.handshaking
+            limit = self.idle_timeout if idle else self.timeout
+            if now - conn.last_active > limit:
+                logging.debug("Closing idle connection from %s", conn.address)
+                self._close(conn, connections)
+
+    def _close(self, conn, connections):
+        if connections.pop(conn.fileno(), None) is not None:
+            self.stats.close()
+        consume(conn.outbuf, None) # Closes any file left
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+
+    def _handshake(self, conn, connections):
+        try:
+            conn.sock.do_handshake()
+            conn.handshaking = False
+            conn.want_write = False
+        except ssl.SSLWantReadError:
+            conn.want_write = False
+        except ssl.SSLWantWriteError:
+            conn.want_write = True
+        except (socket.error, ssl.SSLError):
+            logging.debug("Handshake with %s failed.", conn.address, exc_info=True)
+            self._close(conn, connections)
+
+    def _on_readable(self, conn, connections):
+        if conn.handshaking:
+            self._handshake(conn, connections)
+            if conn.handshaking:
+                return
+
+        try:
+            data = conn.sock.recv(8192)
+            # TLS may hold decrypted bytes that select() can't see
+            while data and getattr(conn.sock, "pending", lambda: 0)():
+                data += conn.sock.recv(8192)
+        except ssl.SSLWantReadError:
+            return
+        except socket.error:
+            self._close(conn, connections)
+            return
+
+        if not data:
+            self._close(conn, connections)
+            return
+
+        conn.last_active = time.time()
+        responses, keep = self.respond(conn.parser, conn.served, conn.sock,
+                                       conn.address, data)
+        conn.served += len(responses)
+        conn.closing = not keep
+        if responses:
+            for response in responses:
+                conn.outbuf.extend(response.buffers())
+            conn.want_write = True
+            self._on_writable(conn, connections)
+
+    def _on_writable(self, conn, connections):
+        if conn.handshaking:
+            self._handshake(conn, connections)
+            return
+        try:
+            conn.outbuf = consume(conn.outbuf, send(conn.sock, conn.outbuf))
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error:
+            self._close(conn, connections)
+            return
+        if not conn.outbuf:
+            if conn.closing:
+                self._close(conn, connections)
+            else:
+                # Wait for the next request
+                conn.want_write = False
+                conn.last_active = time.time()
 
-        data = sock.recv(8192) # Should be enough for everybody
+    def build_response(self, sock, address, data, keep_alive=False):
+        """
+            Returns the response (pytheus.http.response.Base) to a single
+            request, and whether the connection can be kept open afterwards
+            (only if keep_alive and the client wants it).
+        """
         response = pytheus.http.response.Base(500)
 
         try:
-            request = pytheus.http.request.Base(sock, address, data)
+            request = self.request_handler(sock, address, data)
             response = self.response_handler(request)
             if not isinstance(response, pytheus.http.response.Base):
                 raise InvalidHandlerImplementation("Must return a pytheus.http.response.Base object.")
+            keep_alive = keep_alive and request.keep_alive
         except pytheus.http.request.BadRequestError:
             response = pytheus.http.response.Base(400)
+            keep_alive = False
+        except Exception:
+            logging.exception("Response handler failed.")
+            response = pytheus.http.response.Base(500)
+            keep_alive = False
+
+        response.keep_alive = keep_alive
+        return response, keep_alive
+
+    def respond(self, parser, served, sock, address, data):
+        """
+            Feeds what was read from a connection (which already served
+            that many requests) to its parser. Returns the responses to
+            every complete request, and whether to keep the connection open.
+        """
+        try:
+            requests = parser.feed(data)
+        except pytheus.http.request.RequestTooLargeError:
+            logging.warning("Request from %s too large, closing.", address)
+            return [pytheus.http.response.Base(413)], False
+
+        responses = []
+        for raw in requests:
+            served += 1
+            allowed = self.keep_alive and served < self.max_requests
+            response, keep = self.build_response(sock, address, raw, allowed)
+            responses.append(response)
+            if not keep:
+                return responses, False
+        return responses, True
+
+    def handle_connection(self, sock, address):
+        parser = pytheus.http.request.Parser()
+        served = 0
+        self.stats.opened()
+        try:
+            while True:
+                try:
+                    data = sock.recv(8192)
+                except socket.timeout:
+                    logging.debug("Connection from %s timed out.", address)
+                    return
+                if not data:
+                    return
+                responses, keep = self.respond(parser, served, sock, address, data)
+                served += len(responses)
+                buffers = []
+                for response in responses:
+                    buffers.extend(response.buffers())
+                sendall(sock, buffers)
+                if not keep:
+                    return
+                # Between requests the client may stay quiet for longer
+                if not parser.buffer and not self._idle(sock):
+                    logging.debug("Closing idle connection from %s", address)
+                    return
         finally:
-            sock.sendall(response.to_string())
             sock.close()
+            self.stats.close()
+
+    def _idle(self, sock):
+        """
+            Waits for the next request on a kept alive connection. False
+            if none came within idle_timeout, or once other connections
+            wait for a worker (threaded mode).
+        """
+        deadline = time.time() + self.idle_timeout
+        while not self.stats.queued:
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            # TLS may hold decrypted bytes that select() can't see
+            if getattr(sock, "pending", lambda: 0)():
+                return True
+            readable, _, _ = select.select([sock], [], [], min(left, self.idle_check))
+            if readable:
+                return True
+        return False
 
     @staticmethod
     def _debug_response_handler(request):
@@ -93,3 +525,85 @@ class Base(object):
         response.content_type = "text/html"
         response.content = "<html><h1>Well done!</h1></html>"
         return response
+
+
+class AsyncConnection(object):
+    """
+        asyncio protocol (duck-typed, asyncio isn't there on Python 2)
+        handling a single client of AsyncBase.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.parser = pytheus.http.request.Parser()
+        self.served = 0
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.stats.opened()
+        self._wait(self.server.timeout)
+
+    def _wait(self, delay):
+        """(Re)arms the timer closing the connection if nothing comes in."""
+        if self.timer:
+            self.timer.cancel()
+        self.timer = self.server.loop.call_later(delay, self._expired)
+
+    def _expired(self):
+        if self.transport:
+            logging.debug("Closing idle connection.")
+            self.transport.close()
+
+    def data_received(self, data):
+        address = self.transport.get_extra_info("peername")
+        responses, keep = self.server.respond(self.parser, self.served, None,
+                                              address, data)
+        self.served += len(responses)
+        for response in responses:
+            for buf in response.buffers():
+                if isinstance(buf, pytheus.http.response.File):
+                    buf = buf.view()
+                self.transport.write(buf)
+        if not keep:
+            self.transport.close()
+        elif responses:
+            self._wait(self.server.timeout if self.parser.buffer else self.server.idle_timeout)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if self.timer:
+            self.timer.cancel()
+        self.transport = None
+        self.server.stats.close()
+
+
+class AsyncBase(Base):
+    """
+        Serves from an asyncio event loop (Python 3 only), alongside
+        whatever else runs on it. See pytheus.exporter.AsyncBase.
+    """
+
+    def __init__(self, address="0.0.0.0", port=7777, certfile=None,
+                 response_handler=None, backlog=128, timeout=10,
+                 keep_alive=True, idle_timeout=15, max_requests=100, tls=None):
+        super(AsyncBase, self).__init__(address, port, certfile, response_handler,
+                                        backlog=backlog,
+                                        timeout=timeout,
+                                        keep_alive=keep_alive,
+                                        idle_timeout=idle_timeout,
+                                        max_requests=max_requests,
+                                        tls=tls)
+        self.loop = None
+
+    def serve(self, loop):
+        """Returns the coroutine that starts serving on loop."""
+        logging.info("Starting http server (asyncio): %s:%i", self.address, self.port)
+        self.loop = loop
+        context = self.tls.server_context() if self.tls else None
+        self.sock.setblocking(0)
+        return loop.create_server(lambda: AsyncConnection(self), sock=self.sock,
+                                  ssl=context, backlog=self.backlog)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+    TLS settings of the HTTP server.
+
+    A single SSLContext is built at startup and shared by every
+    connection: the certificate is only loaded once and clients can resume
+    their sessions (session IDs cached by OpenSSL, or session tickets)
+    instead of going through a full handshake on every scrape. When the
+    files change a new one replaces it, new connections get that one.
+"""
+
+import logging
+import os
+import ssl
+import threading
+import time
+
+
+# Forward secrecy with AEAD ciphers only, TLS 1.3 suites aren't affected
+DEFAULT_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:!aNULL:!eNULL:!MD5:!DSS"
+
+# Not exported by the ssl module before Python 3.6
+OP_NO_TICKET = getattr(ssl, "OP_NO_TICKET", 0x4000)
+PROTOCOL = getattr(ssl, "PROTOCOL_TLS_SERVER", ssl.PROTOCOL_SSLv23)
+
+
+class Context(object):
+    """
+        Attributes:
+            certfile: PEM with the certificate chain (and the key, unless
+                      keyfile is given)
+            cafile: CA certificates to verify the clients against
+            verify_client: require a client certificate (mutual TLS),
+                           otherwise it's only verified when sent
+            session_tickets: issue stateless session tickets, the session
+                             cache is used either way
+            reload_interval: how often (seconds) to look for a new
+                             certificate on disk, 0 to never reload
+    """
+
+    def __init__(self, certfile, keyfile=None, ciphers=DEFAULT_CIPHERS,
+                 cafile=None, verify_client=False, session_tickets=True,
+                 reload_interval=60):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.ciphers = ciphers
+        self.cafile = cafile
+        self.verify_client = verify_client
+        self.session_tickets = session_tickets
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self._checked = time.time()
+        self._mtimes = self._stat()
+        self.context = self.build()
+        self._server_contexts = [] # Handed out by server_context()
+
+    def _stat(self):
+        return [os.stat(path).st_mtime
+                for path in (self.certfile, self.keyfile, self.cafile) if path]
+
+    def build(self):
+        """Returns a new server SSLContext from our settings."""
+        context = ssl.SSLContext(PROTOCOL)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION
+        context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_SINGLE_ECDH_USE
+        if not self.session_tickets:
+            context.options |= OP_NO_TICKET
+        if self.ciphers:
+            context.set_ciphers(self.ciphers)
+        context.load_cert_chain(self.certfile, self.keyfile)
+        if self.cafile:
+            context.load_verify_locations(self.cafile)
+            context.verify_mode = ssl.CERT_REQUIRED if self.verify_client else ssl.CERT_OPTIONAL
+        elif self.verify_client:
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.load_default_certs(ssl.Purpose.CLIENT_AUTH)
+        return context
+
+    def reload(self):
+        """
+            Builds a new context from the files and swaps it in, CAs
+            removed from cafile are no longer trusted. Open connections
+            keep the previous one, sessions cached by it aren't resumed.
+            A broken or half-written certificate is ignored, we keep
+            serving the previous one.
+        """
+        try:
+            context = self.build()
+        except (IOError, OSError, ssl.SSLError):
+            logging.error("Unable to reload certificate %s, keeping the current one.",
+                          self.certfile, exc_info=True)
+            return False
+        self.context = context
+        logging.info("Reloaded certificate %s", self.certfile)
+        return True
+
+    def server_context(self):
+        """
+            An SSLContext for servers that only take one, when they start
+            (asyncio): each handshake switches to the current context, so
+            they get the reloaded ones too.
+        """
+        context = self.build()
+        if hasattr(context, "sni_callback"):
+            context.sni_callback = self._switch
+        else: # Before Python 3.7
+            context.set_servername_callback(self._switch)
+        self._server_contexts.append(context)
+        return context
+
+    def _switch(self, sslobj, server_name, context):
+        """Called early in every handshake, with or without SNI."""
+        self.check()
+        sslobj.context = self.context
+
+    def check(self):
+        """Reloads the certificate if it changed on disk, at most every reload_interval."""
+        now = time.time()
+        if not self.reload_interval or now - self._checked < self.reload_interval:
+            return
+        with self.lock:
+            if now - self._checked < self.reload_interval:
+                return
+            self._checked = now
+            try:
+                mtimes = self._stat()
+            except OSError: # Being replaced, try again later
+                return
+            if mtimes != self._mtimes and self.reload():
+                self._mtimes = mtimes
+
+    def wrap(self, sock, **kwargs):
+        self.check()
+        return self.context.wrap_socket(sock, server_side=True, **kwargs)
+
+    def stats(self):
+        """
+            OpenSSL's session statistics: hits are resumed handshakes.
+            Those of server_context() are counted too, they start them.
+        """
+        stats = self.context.session_stats()
+        for context in self._server_contexts:
+            for name, value in context.session_stats().items():
+                stats[name] = stats.get(name, 0) + value
+        return stats
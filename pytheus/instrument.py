@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+    Instruments application code inline, rather than polling a collector
+    function: wraps functions (async def ones too) or blocks of code and
+    records into a series of a metric as they run.
+
+        Timed: the duration, into a summary or histogram.
+        CountCalls: the number of calls, into a counter.
+        InProgress: how many are running right now, into a gauge.
+
+    The series is resolved once, when the instrument is made, so a call
+    only pays for two clock reads and an update:
+
+        latency = Timed(histogram, handler="index")
+
+        @latency
+        def index(request):
+            ...
+
+        with latency.measure():
+            ...
+"""
+
+import functools
+import inspect
+import time
+
+import pytheus.scheduler
+
+
+# Monotonic and precise, Python 3.3+
+clock = getattr(time, "perf_counter", time.time)
+
+# Python 3.12+, so frameworks still see the wrapper of an async def as one
+mark_coroutine = getattr(inspect, "markcoroutinefunction", None)
+
+
+class Base(object):
+
+    def __init__(self, metric, **labels):
+        self.metric = metric
+        self.child = metric.labels(**labels)
+
+    def enter(self):
+        """Called before the code runs, returns what exit gets."""
+        raise NotImplementedError
+
+    def exit(self, token):
+        raise NotImplementedError
+
+    def __call__(self, function):
+        enter = self.enter
+        exit = self.exit
+
+        if pytheus.scheduler.iscoroutinefunction(function):
+            @functools.wraps(function)
+            def coroutine_wrapper(*args, **kwargs):
+                return Coroutine(function(*args, **kwargs), enter, exit)
+            if mark_coroutine:
+                coroutine_wrapper = mark_coroutine(coroutine_wrapper)
+            return coroutine_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            token = enter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                exit(token)
+        return wrapper
+
+    def measure(self):
+        """Returns a context manager measuring the block it wraps."""
+        return Measurement(self.enter, self.exit)
+
+
+class Timed(Base):
+
+    def enter(self):
+        return clock()
+
+    def exit(self, started):
+        self.child.observe(clock() - started)
+
+
+class CountCalls(Base):
+
+    def enter(self):
+        self.child.inc(1.0)
+
+    def exit(self, token):
+        pass
+
+
+class InProgress(Base):
+
+    def enter(self):
+        self.child.inc(1.0)
+
+    def exit(self, token):
+        self.child.inc(-1.0)
+
+
+class Measurement(object):
+    """Context manager, one per block measured (blocks may overlap)."""
+
+    __slots__ = ('enter', 'exit', 'token')
+
+    def __init__(self, enter, exit):
+        self.enter = enter
+        self.exit = exit
+
+    def __enter__(self):
+        self.token = self.enter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.exit(self.token)
+        return False
+
+
+class Coroutine(object):
+    """
+        What the wrapper of an async def returns: a coroutine (by duck
+        typing, see collections.abc.Coroutine) driving the original one,
+        measuring from its first step until it returns or raises.
+        Written without async/await syntax, this module is imported on
+        Python 2 too.
+    """
+
+    __slots__ = ('coroutine', 'enter', 'exit', 'token', 'state')
+
+    # States
+    CREATED, RUNNING, DONE = range(3)
+
+    def __init__(self, coroutine, enter, exit):
+        self.coroutine = coroutine
+        self.enter = enter
+        self.exit = exit
+        self.token = None
+        self.state = Coroutine.CREATED
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    next = __next__
+
+    def _start(self):
+        if self.state == Coroutine.CREATED:
+            self.state = Coroutine.RUNNING
+            self.token = self.enter()
+
+    def _finish(self):
+        if self.state == Coroutine.RUNNING:
+            self.exit(self.token)
+        self.state = Coroutine.DONE
+
+    def send(self, value):
+        self._start()
+        try:
+            return self.coroutine.send(value)
+        except BaseException: # StopIteration too: it returned
+            self._finish()
+            raise
+
+    def throw(self, *exc_info):
+        self._start()
+        try:
+            return self.coroutine.throw(*exc_info)
+        except BaseException:
+            self._finish()
+            raise
+
+    def close(self):
+        try:
+            self.coroutine.close()
+        finally:
+            self._finish()
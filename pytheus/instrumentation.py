@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+    The exporter's own metrics (pytheus_*), to tell why scrapes are slow:
+
+        pytheus_scrape_duration_seconds, pytheus_scrape_size_bytes and
+        pytheus_scrape_bytes_total: per exposition format.
+        pytheus_family_series: series of every registered metric.
+        pytheus_collector_*: last run duration, last success, failures and
+        whether it's running, for every collector (scheduler.Job).
+        pytheus_http_*: open and accepted connections, connections waiting
+        for a worker (threaded mode).
+
+    Off unless the exporter is started with instrumentation=True, it then
+    costs two clock reads per scrape. Everything else is read, at scrape
+    time, from what the scheduler and the server keep track of anyway.
+    Not served in multiprocess mode.
+"""
+
+import time
+
+import pytheus.collector
+import pytheus.meter
+
+
+SCRAPE_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+
+class Base(object):
+
+    def __init__(self, collector, server):
+        self.collector = collector
+        self.server = server
+        meter = pytheus.meter
+
+        self.scrape_duration = meter.Histogram(
+            "pytheus_scrape_duration_seconds", SCRAPE_BUCKETS,
+            "Time spent building the exposition of a scrape.")
+        self.scrape_size = meter.Gauge(
+            "pytheus_scrape_size_bytes", "Size of the last exposition, uncompressed.")
+        self.scrape_bytes = meter.Counter(
+            "pytheus_scrape_bytes_total", "Bytes of exposition served, uncompressed.")
+        self.family_series = meter.Gauge(
+            "pytheus_family_series", "Series in each registered metric.")
+        self.collector_duration = meter.Gauge(
+            "pytheus_collector_last_duration_seconds", "Duration of the collector's last run.")
+        self.collector_success = meter.Gauge(
+            "pytheus_collector_last_success_timestamp_seconds",
+            "When the collector last succeeded.")
+        self.collector_failures = meter.Counter(
+            "pytheus_collector_failures_total", "Runs of the collector that failed or timed out.")
+        self.collector_running = meter.Gauge(
+            "pytheus_collector_running", "Whether the collector is running.")
+        self.connections = meter.Gauge(
+            "pytheus_http_connections", "Connections open.")
+        self.connections_accepted = meter.Counter(
+            "pytheus_http_connections_total", "Connections accepted.")
+        self.queue_depth = meter.Gauge(
+            "pytheus_http_queue_depth", "Connections accepted, waiting for a worker.")
+
+    def scraped(self, started, size, encoder):
+        """Records a scrape that started at started (time.time())."""
+        labels = {"format": encoder.__class__.__name__.lower()}
+        self.scrape_duration.observe(time.time() - started, **labels)
+        self.scrape_size.set(size, **labels)
+        self.scrape_bytes.inc(size, **labels)
+
+    def refresh(self):
+        """Reads the current state of the collectors and the server."""
+        for metric, job in list(pytheus.collector.Base.decorators.items()):
+            self.family_series.set(len(metric._store()), family=metric.name)
+            if job.function is None: # Not a collector
+                continue
+            labels = {"collector": job.name, "metric": metric.name}
+            if job.last_duration is not None:
+                self.collector_duration.set(job.last_duration, **labels)
+            if job.last_success is not None:
+                self.collector_success.set(job.last_success, **labels)
+            self.collector_failures.set(job.failures, **labels)
+            self.collector_running.set(1 if job.running else 0, **labels)
+
+        stats = self.server.stats
+        self.connections.set(stats.open)
+        self.connections_accepted.set(stats.accepted)
+        self.queue_depth.set(stats.queued)
+
+    def metrics(self):
+        self.refresh()
+        return [self.scrape_duration, self.scrape_size, self.scrape_bytes,
+                self.family_series, self.collector_duration, self.collector_success,
+                self.collector_failures, self.collector_running,
+                self.connections, self.connections_accepted, self.queue_depth]
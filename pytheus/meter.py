@@ -1,9 +1,22 @@
 
 #!/usr/bin/env python
 
+import array
+import bisect
+import math
 import time
 import collections
 import re
+import sys
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import pytheus.multiprocess
+import pytheus.quantile
 
 
 class InvalidLabelError(Exception):
@@ -14,9 +27,85 @@ class InvalidQuantileError(Exception):
     """When the buckets for a Summary exceed 1."""
     pass
 
+class InvalidOverflowError(Exception):
+    """When the overflow policy isn't one of OVERFLOW_POLICIES."""
+    pass
+
+class InvalidSchemaError(Exception):
+    """When the schema of exponential buckets is out of range."""
+    pass
+
+
+OVERFLOW_POLICIES = (
+    "drop",     # New series are discarded
+    "catchall", # New series all go to a single one, labelled OVERFLOW_VALUE
+    "evict",    # The least recently updated series makes room
+)
+
+OVERFLOW_VALUE = "__overflow__"
+
+
+# Exponential buckets: from schema -4 (each bucket 65536 times wider than
+# the previous) to 8 (0.27% wider), as Prometheus' native histograms
+MIN_SCHEMA = -4
+MAX_SCHEMA = 8
+ZERO_THRESHOLD = 2.0 ** -128
+
+# Bucket boundaries within [0.5, 1) for the positive schemas
+_SCHEMA_BOUNDS = dict((schema, [2 ** (float(j) / (1 << schema) - 1) for j in range(1 << schema)])
+                      for schema in range(1, MAX_SCHEMA + 1))
+
+
+def exponential_index(value, schema):
+    """
+        The bucket of value (positive and finite): bucket i holds
+        (base^(i-1), base^i], base being 2^(2^-schema).
+    """
+    fraction, exponent = math.frexp(value)
+    if schema > 0:
+        bounds = _SCHEMA_BOUNDS[schema]
+        return bisect.bisect_left(bounds, fraction) + (exponent - 1) * len(bounds)
+    index = exponent - 1 if fraction == 0.5 else exponent
+    return (index + (1 << -schema) - 1) >> -schema
+
+
+def exponential_bound(index, schema):
+    """The upper bound of bucket index, inf past the largest float."""
+    try:
+        if schema > 0:
+            bounds = _SCHEMA_BOUNDS[schema]
+            quotient, remainder = divmod(index, len(bounds))
+            return math.ldexp(bounds[remainder], quotient + 1)
+        return math.ldexp(1.0, index << -schema)
+    except OverflowError:
+        return float("inf")
+
+
+# Series don't get a lock each, they share one of these (picked by hash).
+# Cheaper than a lock per series, barely more contention.
+LOCK_STRIPES = [threading.Lock() for _ in range(64)]
+
+def stripe(key):
+    """Returns the lock protecting the series identified by key."""
+    return LOCK_STRIPES[hash(key) % len(LOCK_STRIPES)]
+
+
+def _sample_prefix(name, labels):
+    """Formats name{label="value",...}, what precedes the value of a sample."""
+    out = "{0}".format(name)
+    if labels:
+        labels = ['{0}="{1}"'.format(str(k), str(v)) for k, v in labels.items()]
+        out += "{{{labels}}}".format(labels=','.join(labels))
+    return out
+
 
 class SimpleMetric(object):
 
+    __slots__ = ('name', 'value', 'labels', 'timestamp', 'dirty', 'updated', 'lock',
+                 'shared', 'created', 'exemplar', '_prefix', '_rendered')
+
+    label_regex = re.compile('[a-zA-Z_][a-zA-Z0-9_]*$')
+
     @staticmethod
     def _validate_labels(labels):
         """According to the docs:
@@ -25,115 +114,708 @@ class SimpleMetric(object):
             Label names beginning with __ are reserved for internal use.
         """
         for label in labels:
-            if not re.match('[a-zA-Z_][a-zA-Z0-9_]*.', label):
+            if not SimpleMetric.label_regex.match(label):
                 raise InvalidLabelError("Doesn't match the regex: %s" % (label))
 
-    def __init__(self, name, value="NaN", labels=None, timestamp=False):
+    def __init__(self, name, value="NaN", labels=None, timestamp=False, shared=None):
         self.name = name
         self.value = value
         if labels is None:
             labels = {}
         self.labels = labels
         self.timestamp = timestamp
+        # Written through on updates in multiprocess mode
+        self.shared = shared
+        self.created = time.time()
+        self.exemplar = None
+        self.dirty = True
+        self.updated = True # Since the last scrape, see Base
+        self._rendered = None
         SimpleMetric._validate_labels(self.labels)
 
+        # Labels never change once created, only the value does
+        self._prefix = _sample_prefix(self.name, self.labels)
+        self.lock = stripe(self._prefix)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+            self.dirty = True
+            self.updated = True
+            if self.shared is not None:
+                self.shared.set(value)
+
+    def inc(self, amount, exemplar=None):
+        if exemplar is not None:
+            exemplar = _exemplar(exemplar, amount)
+        with self.lock:
+            self.value += amount
+            self.dirty = True
+            self.updated = True
+            if exemplar is not None:
+                self.exemplar = exemplar
+            if self.shared is not None:
+                self.shared.inc(amount)
+
     def to_string(self):
-        out = "{0}".format(self.name)
-        if self.labels:
-            labels = ['{0}="{1}"'.format(str(k), str(v)) for k, v in self.labels.items()]
-            out += "{{{labels}}}".format(labels=','.join(labels))
-        out += " {value}".format(value=self.value)
+        # Timestamped samples must be rendered every time
+        # Not rendered yet if another thread only just cleared dirty
+        if not self.dirty and not self.timestamp and self._rendered is not None:
+            return self._rendered
+        with self.lock:
+            return self.render(self.value)
+
+    def render(self, value):
+        """Sets the value and formats the sample, the caller handles locking."""
+        self.value = value
+        self.dirty = False
+        out = self._prefix + " {value}".format(value=self.value)
         if self.timestamp:
             out += " {0}".format(str(int(time.time()))) # timestamp
-        return out + "\n"
+        self._rendered = out + "\n"
+        return self._rendered
 
 
 class QuantileBucket(object):
 
+    __slots__ = ('name', 'buckets', 'labels', 'count', 'sum', 'windowed', 'created',
+                 'estimator', 'dirty', 'updated', 'lock', 'shared', '_rendered', '_samples')
+
     @staticmethod
     def _validate_buckets(buckets):
         if max(buckets) > 1:
             raise InvalidQuantileError("Summary buckets shouldn't exceed value 1 (0 < Q < 1).")
 
-    def __init__(self, name, buckets, labels):
+    def __init__(self, name, targets, labels, max_age=None, age_buckets=5, shared=None):
+        """
+            Targets is a dictionary of {quantile: allowed error}. Given a
+            max_age (seconds) quantiles only reflect recent observations,
+            the sum and count are cumulative as usual.
+            Shared returns the multiprocess storage of a sample (only the
+            sum and count are shared).
+        """
         self.name = name
-        self.buckets = dict.fromkeys(buckets, 0.0)
+        self.buckets = sorted(targets)
         self.labels = labels
-        self.values = []
+        self.count = 0
+        self.sum = 0
+        self.windowed = max_age is not None
+        self.created = time.time()
+        self.dirty = True
+        self.updated = True
+        self._rendered = None
         QuantileBucket._validate_buckets(self.buckets)
+        if self.windowed:
+            self.estimator = pytheus.quantile.Window(targets, max_age, age_buckets)
+        else:
+            self.estimator = pytheus.quantile.Estimator(targets)
+
+        self._samples = []
+        for quantile in self.buckets:
+            labels = collections.OrderedDict(self.labels, quantile=quantile)
+            self._samples.append(SimpleMetric(self.name, 0, labels))
+        self._samples.append(SimpleMetric(self.name + "_sum", 0, self.labels))
+        self._samples.append(SimpleMetric(self.name + "_count", 0, self.labels))
+        self.lock = self._samples[-1].lock
+        self.shared = _shared_samples(shared, self._samples[-2:])
+
+    def add(self, value, exemplar=None):
+        """Summaries have no buckets to attach exemplars to, they're ignored."""
+        with self.lock:
+            self.estimator.insert(value)
+            self.count += 1
+            self.sum += value
+            self.dirty = True
+            self.updated = True
+            if self.shared is not None:
+                self.shared[0].inc(value)
+                self.shared[1].inc(1)
 
-    def add(self, value):
-        self.values.append(value)
+    def add_many(self, values):
+        with self.lock:
+            total = 0
+            count = 0
+            for value in values:
+                self.estimator.insert(value)
+                total += value
+                count += 1
+            self.count += count
+            self.sum += total
+            self.dirty = True
+            self.updated = True
+            if self.shared is not None:
+                self.shared[0].inc(total)
+                self.shared[1].inc(count)
 
     def to_string(self):
-        out = ""
-        maximum = max(self.values)
-        self.values = sorted(self.values)
-
-        # Organize all values into their buckets
-        for value in self.values:
-            percentile = float(value) * 100 / maximum / 100
-            for quantile in sorted(self.buckets):
-                if percentile <= quantile:
-                    self.buckets[quantile] += value
-                    break
-
-        for quantile in sorted(self.buckets):
-            value = self.buckets[quantile]
-            labels = collections.OrderedDict(self.labels, quantile=quantile)
-            out += SimpleMetric(self.name, value, labels).to_string()
-        out += SimpleMetric(self.name + "_sum", sum(self.values), self.labels).to_string()
-        out += SimpleMetric(self.name + "_count", len(self.values), self.labels).to_string()
-        return out
+        # Windowed quantiles change as time goes by, even without updates
+        if not self.dirty and not self.windowed and self._rendered is not None:
+            return self._rendered
+        with self.lock:
+            self.dirty = False
+            out = []
+            for quantile, sample in zip(self.buckets, self._samples):
+                out.append(sample.render(self.estimator.query(quantile)))
+            out.append(self._samples[-2].render(self.sum))
+            out.append(self._samples[-1].render(self.count))
+            self._rendered = "".join(out)
+            return self._rendered
 
 
 class LessOrEqualBucket(object):
+    """
+        Observations are counted in the first bucket they fit in (found by
+        binary search), cumulative totals are only built when exposing.
+        The last slot of counts holds whatever didn't fit (+Inf).
+        Exemplars, if any, are kept per bucket (the last one observed).
+    """
+
+    __slots__ = ('name', 'buckets', 'labels', 'counts', 'count', 'sum', 'created',
+                 'exemplars', 'dirty', 'updated', 'lock', 'shared', '_rendered', '_samples')
 
-    def __init__(self, name, buckets, labels):
+    def __init__(self, name, buckets, labels, shared=None):
         self.name = name
-        self.buckets = dict.fromkeys(buckets, 0.0)
+        self.buckets = sorted(buckets)
         self.labels = labels
+        self.counts = array.array('d', [0.0]) * (len(self.buckets) + 1)
         self.count = 0
         self.sum = 0
+        self.created = time.time()
+        self.exemplars = None # Only allocated once one is observed
+        self.dirty = True
+        self.updated = True
+        self._rendered = None
 
-    def add(self, value):
+        # Label sets never change, build (and format) the samples only once
+        self._samples = []
+        for bound in self.buckets + ['+Inf']:
+            labels = collections.OrderedDict(self.labels)
+            labels.update({'le': bound}) # LE means less or equal
+            self._samples.append(SimpleMetric(self.name + "_bucket", 0, labels))
+        self._samples.append(SimpleMetric(self.name + "_sum", 0, self.labels))
+        self._samples.append(SimpleMetric(self.name + "_count", 0, self.labels))
+        self.lock = self._samples[-1].lock
+        # Shared buckets hold per bucket counts, like self.counts
+        self.shared = _shared_samples(shared, self._samples)
 
-        added = False
-        for bucket in sorted(self.buckets):
-            # Histograms are cummulative. We add the value to all possible
-            # buckets.
-            if value <= bucket:
-                self.buckets[bucket] += value
-                added = True
+    def add(self, value, exemplar=None):
+        index = bisect.bisect_left(self.buckets, value)
+        if value != value: # NaN fits no bucket but +Inf (where numpy sorts it)
+            index = len(self.buckets)
+        if exemplar is not None:
+            exemplar = _exemplar(exemplar, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.dirty = True
+            self.updated = True
+            if exemplar is not None:
+                if self.exemplars is None:
+                    self.exemplars = [None] * len(self.counts)
+                self.exemplars[index] = exemplar
+            if self.shared is not None:
+                self.shared[index].inc(1)
+                self.shared[-2].inc(value)
+                self.shared[-1].inc(1)
 
-        if added:
+    def add_many(self, values):
+        if numpy is not None:
+            if hasattr(values, "__len__"):
+                values = numpy.asarray(values, dtype=float)
+            else: # Generators and other iterators
+                values = numpy.fromiter(values, float)
+            indexes = numpy.searchsorted(self.buckets, values, side='left')
+            per_bucket = numpy.bincount(indexes, minlength=len(self.counts))
+            total = float(values.sum())
+            with self.lock:
+                for i, amount in enumerate(per_bucket.tolist()):
+                    self.counts[i] += amount
+                self.count += len(values)
+                self.sum += total
+                self.dirty = True
+                self.updated = True
+                self._share_many(per_bucket.tolist(), total, len(values))
+            return
+
+        buckets = self.buckets
+        overflow = len(buckets)
+        find = bisect.bisect_left
+        with self.lock:
+            # Shared buckets need what this call added, count it apart then
+            counts = self.counts if self.shared is None else [0] * len(self.counts)
+            total = 0
+            count = 0
+            for value in values:
+                if value == value:
+                    counts[find(buckets, value)] += 1
+                else: # NaN, see add()
+                    counts[overflow] += 1
+                total += value
+                count += 1
+            self.sum += total
+            self.count += count
+            self.dirty = True
+            self.updated = True
+            if counts is not self.counts:
+                for i, amount in enumerate(counts):
+                    self.counts[i] += amount
+                self._share_many(counts, total, count)
+
+    def classic(self):
+        """([upper bounds], [counts]), the last one +Inf. Caller holds the lock."""
+        return self.buckets + [float("inf")], self.counts
+
+    def _share_many(self, per_bucket, total, count):
+        if self.shared is None:
+            return
+        for shared, amount in zip(self.shared, per_bucket):
+            if amount:
+                shared.inc(amount)
+        self.shared[-2].inc(total)
+        self.shared[-1].inc(count)
+
+    def to_string(self):
+        if not self.dirty and self._rendered is not None:
+            return self._rendered
+        with self.lock:
+            self.dirty = False
+            cumulative = 0
+            out = []
+            for sample, count in zip(self._samples, self.counts):
+                cumulative += int(count)
+                out.append(sample.render(cumulative))
+            out.append(self._samples[-2].render(self.sum))
+            out.append(self._samples[-1].render(self.count))
+            self._rendered = "".join(out)
+            return self._rendered
+
+
+class ExponentialBucket(object):
+    """
+        Sparse exponential buckets: {index: count} of the buckets holding
+        observations (see exponential_index), for positive and negative
+        values, plus those within zero_threshold of zero.
+        Past max_buckets, the schema is decremented: every two buckets
+        merge into one, twice as wide.
+        Exposed as the classic le buckets of the populated ones, or
+        natively (see encoders.Protobuf). Not shared in multiprocess mode.
+    """
+
+    __slots__ = ('name', 'labels', 'schema', 'max_buckets', 'zero_threshold', 'positive',
+                 'negative', 'zero_count', 'count', 'sum', 'created', 'exemplars', 'dirty',
+                 'updated', 'lock', '_bucket_prefix', '_samples', '_rendered')
+
+    def __init__(self, name, labels, schema=3, max_buckets=160, zero_threshold=ZERO_THRESHOLD):
+        self.name = name
+        self.labels = labels
+        self.schema = schema
+        self.max_buckets = max_buckets
+        self.zero_threshold = zero_threshold
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.created = time.time()
+        self.exemplars = None # Not kept, the buckets come and go
+        self.dirty = True
+        self.updated = True
+        self._rendered = None
+
+        # Buckets are formatted as they come, the rest only once
+        SimpleMetric._validate_labels(labels)
+        pairs = "".join('{0}="{1}",'.format(k, v) for k, v in labels.items())
+        self._bucket_prefix = '%s_bucket{%sle="' % (name, pairs)
+        self._samples = [SimpleMetric(self.name + "_sum", 0, self.labels),
+                         SimpleMetric(self.name + "_count", 0, self.labels)]
+        self.lock = self._samples[-1].lock
+
+    def _insert(self, value):
+        """Counts value in its bucket, the caller holds the lock."""
+        if value > self.zero_threshold:
+            buckets = self.positive
+        elif value < -self.zero_threshold:
+            buckets = self.negative
+            value = -value
+        elif value == value: # Not NaN
+            self.zero_count += 1
+            return
+        else:
+            return
+        if value == float("inf"):
+            if buckets is self.positive:
+                return # Only in the count (and +Inf)
+            value = sys.float_info.max # -Inf, in the lowest bucket there is
+        index = exponential_index(value, self.schema)
+        buckets[index] = buckets.get(index, 0) + 1
+        if len(self.positive) + len(self.negative) > self.max_buckets:
+            self._reduce()
+
+    def _reduce(self):
+        while len(self.positive) + len(self.negative) > self.max_buckets and \
+                self.schema > MIN_SCHEMA:
+            self.positive = _merge_buckets(self.positive)
+            self.negative = _merge_buckets(self.negative)
+            self.schema -= 1
+
+    def add(self, value, exemplar=None):
+        with self.lock:
+            self._insert(value)
             self.count += 1
             self.sum += value
+            self.dirty = True
+            self.updated = True
+
+    def add_many(self, values):
+        with self.lock:
+            insert = self._insert
+            total = 0
+            count = 0
+            for value in values:
+                insert(value)
+                total += value
+                count += 1
+            self.count += count
+            self.sum += total
+            self.dirty = True
+            self.updated = True
+
+    def classic(self):
+        """
+            ([upper bounds], [counts]) of the populated buckets in order,
+            the last one +Inf. Counts aren't cumulative. Caller holds the lock.
+        """
+        schema = self.schema
+        bounds = []
+        counts = []
+        for index in sorted(self.negative, reverse=True):
+            bounds.append(-exponential_bound(index - 1, schema))
+            counts.append(self.negative[index])
+        if self.zero_count:
+            bounds.append(self.zero_threshold)
+            counts.append(self.zero_count)
+        for index in sorted(self.positive):
+            bound = exponential_bound(index, schema)
+            if bound == float("inf"):
+                break # Those left only count in +Inf
+            bounds.append(bound)
+            counts.append(self.positive[index])
+        bounds.append(float("inf"))
+        counts.append(self.count - sum(counts))
+        return bounds, counts
 
     def to_string(self):
-        out = ""
-        for quantile in sorted(self.buckets.keys()):
-            value = self.buckets[quantile]
-            labels = collections.OrderedDict(self.labels)
-            labels.update({'le': quantile}) # LE means less or equal
-            out += SimpleMetric(self.name + "_bucket", value, labels).to_string()
-        labels = collections.OrderedDict(self.labels)
-        labels.update({'le': '+Inf'})
-        out += SimpleMetric(self.name + "_bucket", self.count, labels).to_string()
-        out += SimpleMetric(self.name + "_sum", self.sum, self.labels).to_string()
-        out += SimpleMetric(self.name + "_count", self.count, self.labels).to_string()
-        return out
+        if not self.dirty and self._rendered is not None:
+            return self._rendered
+        with self.lock:
+            self.dirty = False
+            prefix = self._bucket_prefix
+            cumulative = 0
+            out = []
+            bounds, counts = self.classic()
+            for bound, count in zip(bounds[:-1], counts):
+                cumulative += count
+                out.append('{0}{1}"}} {2}\n'.format(prefix, bound, cumulative))
+            out.append('{0}+Inf"}} {1}\n'.format(prefix, self.count))
+            out.append(self._samples[0].render(self.sum))
+            out.append(self._samples[1].render(self.count))
+            self._rendered = "".join(out)
+            return self._rendered
+
+
+def _merge_buckets(buckets):
+    """The buckets of the schema below: i and i + 1 (i odd) merge into (i + 1) / 2."""
+    merged = {}
+    for index, count in buckets.items():
+        index = (index + 1) >> 1
+        merged[index] = merged.get(index, 0) + count
+    return merged
+
+
+class Columns(object):
+    """
+        Compact storage for the series of a gauge or counter, instead of a
+        SimpleMetric each: every series is a slot (an index) in parallel
+        columns, values in an array of doubles. Label names are interned,
+        each series only keeps its label values and its formatted prefix.
+        Slots of removed series are reused.
+
+        Used like the {key: series} dictionary of the metric, lookups
+        return a Slot, a throwaway handle to the series.
+        Structural changes happen under the metric's lock, updates under
+        the striped lock of the series' key.
+    """
+
+    def __init__(self, name, shared=None):
+        self.name = name
+        self.shared = shared # Multiprocess storage, see Base._shared
+        self.slots = {} # {key: index}
+        self.keys = [] # None once removed
+        self.label_names = []
+        self.label_values = []
+        self.prefixes = []
+        self.value_column = array.array('d')
+        self.created = array.array('d')
+        self.updated = bytearray()
+        # Bumped when a slot is freed, handles only update their generation
+        self.generations = array.array('L')
+        # Sparse, few series have these
+        self.exemplars = {}
+        self.shares = {}
+        self._free = []
+        self._names = {} # Interned label names
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def get(self, key, default=None):
+        index = self.slots.get(key)
+        if index is None:
+            return default
+        return Slot(self, index, self.keys[index], self.generations[index])
+
+    def __setitem__(self, key, slot):
+        """Gives a new series (a detached Slot, see Slot.labels) its slot."""
+        labels = slot.labels
+        names = tuple(labels.keys())
+        names = self._names.setdefault(names, names)
+        values = tuple(labels.values())
+        prefix = _sample_prefix(self.name, labels)
+        shared = self.shared(self.name, labels) if self.shared else None
+
+        if self._free:
+            index = self._free.pop()
+            self.keys[index] = key
+            self.label_names[index] = names
+            self.label_values[index] = values
+            self.prefixes[index] = prefix
+            self.value_column[index] = 0.0
+            self.created[index] = time.time()
+            self.updated[index] = 1
+        else:
+            index = len(self.keys)
+            self.keys.append(key)
+            self.label_names.append(names)
+            self.label_values.append(values)
+            self.prefixes.append(prefix)
+            self.value_column.append(0.0)
+            self.created.append(time.time())
+            self.updated.append(1)
+            self.generations.append(0)
+        if shared is not None:
+            self.shares[index] = shared
+        self.slots[key] = index
+        slot.index = index
+        slot.key = key
+        slot.generation = self.generations[index]
+
+    def pop(self, key, default=None):
+        index = self.slots.pop(key, None)
+        if index is None:
+            return default
+        # Handles still around check the generation before updating the slot
+        with stripe(key):
+            self.keys[index] = None
+            self.generations[index] += 1
+        self.label_names[index] = None
+        self.label_values[index] = None
+        self.prefixes[index] = None
+        self.exemplars.pop(index, None)
+        self.shares.pop(index, None)
+        self._free.append(index)
+        return index
+
+    def items(self):
+        generations = self.generations
+        return [(key, Slot(self, index, key, generations[index]))
+                for key, index in self.slots.items()]
+
+    def values(self):
+        return [slot for _, slot in self.items()]
+
+    def render(self):
+        """The samples, straight out of the columns."""
+        return ["%s %s\n" % (prefix, value)
+                for prefix, value in zip(self.prefixes, self.value_column) if prefix is not None]
+
+
+class Slot(object):
+    """
+        Handle to a series of Columns, standing in for a SimpleMetric.
+        Detached (index None) until Columns gives it a slot: updates to a
+        detached or removed series are ignored, even once its slot went to
+        another series (or the same labels again), see Columns.generations.
+    """
+
+    __slots__ = ('columns', 'index', 'key', 'generation', '_labels')
+
+    timestamp = False
+
+    def __init__(self, columns, index=None, key=None, generation=None, labels=None):
+        self.columns = columns
+        self.index = index
+        self.key = key
+        self.generation = generation
+        self._labels = labels
+
+    @property
+    def name(self):
+        return self.columns.name
+
+    @property
+    def lock(self):
+        return stripe(self.key)
+
+    @property
+    def labels(self):
+        if self.index is None:
+            return self._labels
+        columns = self.columns
+        return collections.OrderedDict(zip(columns.label_names[self.index],
+                                           columns.label_values[self.index]))
+
+    @property
+    def value(self):
+        return self.columns.value_column[self.index]
+
+    @property
+    def created(self):
+        return self.columns.created[self.index]
+
+    @property
+    def exemplar(self):
+        return self.columns.exemplars.get(self.index)
+
+    @property
+    def updated(self):
+        return bool(self.columns.updated[self.index])
+
+    @updated.setter
+    def updated(self, updated):
+        self.columns.updated[self.index] = updated
+
+    def set(self, value):
+        columns = self.columns
+        index = self.index
+        with stripe(self.key):
+            if index is None or columns.generations[index] != self.generation:
+                return
+            columns.value_column[index] = value
+            columns.updated[index] = 1
+            if columns.shares:
+                shared = columns.shares.get(index)
+                if shared is not None:
+                    shared.set(value)
+
+    def inc(self, amount, exemplar=None):
+        if exemplar is not None:
+            exemplar = _exemplar(exemplar, amount)
+        columns = self.columns
+        index = self.index
+        with stripe(self.key):
+            if index is None or columns.generations[index] != self.generation:
+                return
+            columns.value_column[index] += amount
+            columns.updated[index] = 1
+            if exemplar is not None:
+                columns.exemplars[index] = exemplar
+            if columns.shares:
+                shared = columns.shares.get(index)
+                if shared is not None:
+                    shared.inc(amount)
+
+
+def _exemplar(labels, value):
+    """
+        Exemplars link a sample to an example of what was measured,
+        typically a trace: {"trace_id": "..."}. Kept as (labels, value,
+        timestamp), only exposed in the OpenMetrics and protobuf formats.
+    """
+    SimpleMetric._validate_labels(labels)
+    return (collections.OrderedDict(sorted(labels.items())), value, time.time())
+
+
+def _shared_samples(shared, samples):
+    """Multiprocess storage of each sample, or None when not enabled."""
+    if shared is None:
+        return None
+    values = [shared(sample.name, sample.labels) for sample in samples]
+    if values[0] is None:
+        return None
+    return values
+
+
+class Child(object):
+    """
+        Handle to a single series of a metric, see Base.labels.
+        Only the methods matching the metric type make sense: set and inc
+        for gauges and counters, observe for summaries and histograms.
+        Counters and histograms take an exemplar, a dictionary of labels.
+    """
+
+    __slots__ = ('metric', 'series')
+
+    def __init__(self, metric, series):
+        self.metric = metric
+        self.series = series
+
+    def set(self, value):
+        self.series.set(value)
+        self.metric.dirty = True
+
+    def inc(self, amount=1.0, exemplar=None):
+        self.series.inc(float(amount), exemplar)
+        self.metric.dirty = True
+
+    def observe(self, value, exemplar=None):
+        """Exemplars (a dictionary of labels) are only kept by histograms."""
+        self.series.add(value, exemplar)
+        self.metric.dirty = True
+
+    def observe_many(self, values):
+        self.series.add_many(values)
+        self.metric.dirty = True
 
 
 class Base(object):
+    """
+        Cardinality limits, for labels taking unbounded values:
+            max_series: how many series (label sets) at most, what happens
+                        to the others depends on overflow (see
+                        OVERFLOW_POLICIES).
+            ttl: series not updated within that many scrapes are removed.
+        Recency is only tracked when scraped, updates don't pay for it.
+        Handles (Child) of a removed series are detached: their updates are
+        lost. Series refused or removed are counted, see LIMIT_COUNTERS.
+        In multiprocess mode removed series stay in the shared files.
+    """
 
-    def __init__(self, name, description=None):
+    def __init__(self, name, description=None, max_series=None, overflow="drop", ttl=None):
         if not description:
             description = name
+        if overflow not in OVERFLOW_POLICIES:
+            raise InvalidOverflowError("Overflow must be one of: %s" % (", ".join(OVERFLOW_POLICIES)))
 
         self.name = name
         self.description = description
         self.metric_type = None
+        self.max_series = max_series
+        self.overflow = overflow
+        self.ttl = ttl
+        # Set on every update, cleared when the exposition is re-rendered
+        self.dirty = True
+        self._rendered = None
+        self._encoded = (None, b"") # (rendered, as bytes)
+        self._children = {}
+        # Guards creating series, updates are protected by the series' lock
+        self.lock = threading.Lock()
+        # {key: scrape it was last updated in}, least recently updated first
+        self._recency = collections.OrderedDict()
+        self._scrapes = 0
 
     def _encode(self, labels):
         encoded = ','.join(["{0}={1}".format(k, v) for k, v in labels.items()])
@@ -155,6 +837,131 @@ class Base(object):
             sorted_dict[key] = unordered[key]
         return sorted_dict
 
+    def _store(self):
+        """The {key: series} dictionary."""
+        raise NotImplementedError
+
+    def _new_series(self, labels, shared=True):
+        """Returns a new series, shared is False for those we won't keep."""
+        raise NotImplementedError
+
+    def _get_series(self, labels, key):
+        """Returns the series for these (sorted) labels, creating it if needed."""
+        store = self._store()
+        series = store.get(key)
+        if series is None:
+            with self.lock:
+                series = store.get(key)
+                if series is None:
+                    series = self._admit(labels, key, store)
+        return series
+
+    def _admit(self, labels, key, store):
+        """Creates a series within max_series, the caller holds the lock."""
+        limit = self.max_series
+        if limit is not None and self.overflow == "catchall":
+            catchall = collections.OrderedDict((k, OVERFLOW_VALUE) for k in labels)
+            # The catch-all is one of the max_series, keep room for it
+            if self._encode(catchall) not in store:
+                limit -= 1
+        if limit is not None and len(store) >= limit:
+            if self.overflow == "evict" and self._recency:
+                self._remove(next(iter(self._recency)), store)
+                _count_limited("evicted", self)
+            elif self.overflow == "catchall":
+                _count_limited("dropped", self)
+                labels = catchall
+                key = self._encode(labels)
+                series = store.get(key)
+                if series is not None:
+                    return series
+            else:
+                _count_limited("dropped", self)
+                return self._new_series(labels, shared=False)
+        series = self._new_series(labels)
+        store[key] = series
+        self._recency[key] = self._scrapes
+        return series
+
+    def _remove(self, key, store):
+        store.pop(key, None)
+        self._children.pop(key, None)
+        self._recency.pop(key, None)
+        self.dirty = True
+
+    def scraped(self):
+        """
+            Called once per scrape (see collector.Base.collected), tracks
+            which series were updated since the last one. Only needed for
+            max_series and ttl.
+        """
+        if self.max_series is None and self.ttl is None:
+            return
+        with self.lock:
+            self._scrapes += 1
+            store = self._store()
+            recency = self._recency
+            for key, series in store.items():
+                if series.updated:
+                    series.updated = False
+                    # Most recent last
+                    recency.pop(key, None)
+                    recency[key] = self._scrapes
+            if self.ttl is None:
+                return
+            expired = [key for key, scrape in recency.items()
+                       if self._scrapes - scrape >= self.ttl]
+            for key in expired:
+                self._remove(key, store)
+            if expired:
+                _count_limited("expired", self, len(expired))
+
+    def _shared(self, sample_name, labels):
+        """Multiprocess storage for a sample, None when not enabled."""
+        return pytheus.multiprocess.shared_value(self, sample_name, labels)
+
+    def _lookup(self, labels):
+        labels = self._sorted_dict(labels)
+        return self._get_series(labels, self._encode(labels))
+
+    def _update(self, series, value):
+        """What measure does to a series."""
+        raise NotImplementedError
+
+    def measure_many(self, samples):
+        """
+            Measures every (value, {labels}) of samples, an iterable
+            consumed as it goes: a generator never has to be materialized.
+            Labels are used as they are, not expanded as keyword arguments.
+        """
+        lookup = self._lookup
+        update = self._update
+        for value, labels in samples:
+            update(lookup(labels or {}), value)
+            self.dirty = True
+        return self
+
+    def labels(self, **labels):
+        """
+            Returns a handle (Child) to the series with these labels.
+            Keep it around, updating through it skips sorting, encoding
+            and validating the labels on every call:
+
+                requests = counter.labels(path="/", code="200")
+                requests.inc()
+        """
+        labels = self._sorted_dict(labels)
+        key = self._encode(labels)
+        child = self._children.get(key)
+        if child is None:
+            series = self._get_series(labels, key)
+            child = Child(self, series)
+            with self.lock:
+                # Not kept if over max_series, they'd pile up
+                if key in self._store():
+                    child = self._children.setdefault(key, child)
+        return child
+
     def _help(self):
         return "# HELP {name} {desc}".format(name=self.name, desc=self.description)
 
@@ -164,47 +971,112 @@ class Base(object):
             metric_type=self.__class__.__name__.lower()
         )
 
+    def _series(self):
+        """All the series (SimpleMetric or buckets) in this metric."""
+        return []
+
+    def _samples(self):
+        """The formatted samples of every series."""
+        with self.lock:
+            all_series = list(self._series())
+        return [series.to_string() for series in all_series]
+
     def to_string(self):
-        out = self._help() + "\n"
-        out += self._type() + "\n"
-        return out
+        """
+            Only series flagged as dirty are formatted again, everything
+            else is served from their cached fragment.
+        """
+        if not self.dirty and self._rendered is not None:
+            return self._rendered
+        # Clear before rendering: updates racing with us will flag it again
+        self.dirty = False
+        out = [self._help() + "\n", self._type() + "\n"]
+        out.extend(self._samples())
+        self._rendered = "".join(out)
+        return self._rendered
+
+    def to_bytes(self):
+        """
+            Same as to_string, encoded. Only encoded again when it changed,
+            on Python 2 it's the very same object.
+        """
+        rendered = self.to_string()
+        encoded = self._encoded
+        if encoded[0] is not rendered:
+            if isinstance(rendered, bytes):
+                encoded = (rendered, rendered)
+            else:
+                encoded = (rendered, rendered.encode("utf-8"))
+            self._encoded = encoded
+        return encoded[1]
 
 
 class Gauge(Base):
+    """
+        In multiprocess mode, multiprocess_mode says how the values of all
+        processes are merged: see pytheus.multiprocess.GAUGE_MODES.
+        With columnar, series are kept in Columns: far less memory per
+        series (for hundreds of thousands of them), values are always
+        floats and the whole exposition is formatted on every change.
+    """
+
+    def __init__(self, name, description=None, multiprocess_mode="all", columnar=False,
+                 **limits):
+        super(Gauge, self).__init__(name, description, **limits)
+        if multiprocess_mode not in pytheus.multiprocess.GAUGE_MODES:
+            raise pytheus.multiprocess.InvalidModeError(
+                "Mode must be one of: %s" % (", ".join(pytheus.multiprocess.GAUGE_MODES)))
+        self.multiprocess_mode = multiprocess_mode
+        self.columnar = columnar
+        if columnar:
+            self.label_metric = Columns(name, self._shared)
+        else:
+            self.label_metric = collections.OrderedDict()
 
-    def __init__(self, name, description=None):
-        super(Gauge, self).__init__(name, description)
-        self.label_metric = collections.OrderedDict()
+    def _store(self):
+        return self.label_metric
+
+    def _new_series(self, labels, shared=True):
+        if self.columnar:
+            SimpleMetric._validate_labels(labels)
+            return Slot(self.label_metric, labels=labels)
+        return SimpleMetric(self.name, 0.0, labels,
+                            shared=self._shared(self.name, labels) if shared else None)
+
+    def _samples(self):
+        if not self.columnar:
+            return super(Gauge, self)._samples()
+        with self.lock:
+            return self.label_metric.render()
 
     def set(self, value, **labels):
-        labels = self._sorted_dict(labels)
-        key = self._encode(labels)
-        self.label_metric[key] = SimpleMetric(self.name, value, labels)
+        self._lookup(labels).set(value)
+        self.dirty = True
 
     def measure(self, value, **labels):
         self.set(value, **labels)
         return self
 
-    def to_string(self):
-        out = super(Gauge, self).to_string()
-        for metric in self.label_metric.values():
-            out += metric.to_string()
-        return out
+    def _update(self, series, value):
+        series.set(value)
+
+    def _series(self):
+        return self.label_metric.values()
 
 
 class Counter(Gauge):
 
     def inc(self, amount=1.0, **labels):
-        labels = self._sorted_dict(labels)
-        key = self._encode(labels)
-        if key not in self.label_metric:
-            self.set(0.0, **labels)
-        self.label_metric[key].value += float(amount)
+        self._lookup(labels).inc(float(amount))
+        self.dirty = True
 
     def measure(self, value, **labels):
         self.inc(value, **labels)
         return self
 
+    def _update(self, series, value):
+        series.inc(float(value))
+
 
 class Summary(Base):
     """
@@ -215,29 +1087,51 @@ class Summary(Base):
             correct: [0.001, 0.1, 0.2, 0.5, 1.0]
             incorrect: [10, 15, 20]
         If the "incorrect" example is what you're looking for, use a histogram.
+
+        Quantiles are estimated over a stream, with bounded memory. Each
+        one is accurate up to `error` (in rank), buckets may also be a
+        dictionary of {quantile: error} to set them individually.
+        With max_age (seconds) only the recent observations count, the
+        window slides in age_buckets steps.
     """
 
-    def __init__(self, name, buckets, description=None):
-        super(Summary, self).__init__(name, description)
-        self.buckets = sorted(buckets)
+    def __init__(self, name, buckets, description=None,
+                 error=0.01, max_age=None, age_buckets=5, **limits):
+        super(Summary, self).__init__(name, description, **limits)
+        if isinstance(buckets, dict):
+            self.targets = dict(buckets)
+        else:
+            self.targets = dict.fromkeys(buckets, error)
+        self.buckets = sorted(self.targets)
+        self.max_age = max_age
+        self.age_buckets = age_buckets
         self.label_bucket = collections.OrderedDict()
 
+    def _store(self):
+        return self.label_bucket
+
+    def _new_series(self, labels, shared=True):
+        return QuantileBucket(self.name, self.targets, labels, self.max_age,
+                              self.age_buckets, self._shared if shared else None)
+
     def observe(self, value, **labels):
-        labels = self._sorted_dict(labels)
-        key = self._encode(labels)
-        if not key in self.label_bucket:
-            self.label_bucket[key] = QuantileBucket(self.name, self.buckets, labels)
-        return self.label_bucket[key].add(value)
+        self._lookup(labels).add(value)
+        self.dirty = True
 
     def measure(self, value, **labels):
         self.observe(value, **labels)
         return self
 
+    def _update(self, series, value):
+        series.add(value)
+
+    def _series(self):
+        return self.label_bucket.values()
+
     def to_string(self):
-        out = super(Summary, self).to_string()
-        for bucket in self.label_bucket.values():
-            out += bucket.to_string()
-        return out
+        if self.max_age is not None:
+            self.dirty = True
+        return super(Summary, self).to_string()
 
 
 class Histogram(Summary):
@@ -249,15 +1143,71 @@ class Histogram(Summary):
             10: 0
             20: 1
             30: 2
+
+        Without buckets they're exponential (see ExponentialBucket): each
+        bucket is 2^(2^-schema) times wider than the previous one
+        (schema 3: about 9%), only populated ones are kept, up to
+        max_buckets per series. Observations within zero_threshold of
+        zero have a bucket of their own.
     """
 
-    def observe(self, value, **labels):
-        labels = self._sorted_dict(labels)
-        key = self._encode(labels)
-        if not key in self.label_bucket:
-            self.label_bucket[key] = LessOrEqualBucket(self.name, self.buckets, labels)
-        return self.label_bucket[key].add(value)
+    def __init__(self, name, buckets=None, description=None, schema=3, max_buckets=160,
+                 zero_threshold=ZERO_THRESHOLD, **options):
+        super(Histogram, self).__init__(name, buckets or [], description, **options)
+        if buckets is None:
+            if not MIN_SCHEMA <= schema <= MAX_SCHEMA:
+                raise InvalidSchemaError("Schema must be within %d and %d" % (MIN_SCHEMA, MAX_SCHEMA))
+            self.buckets = None
+        self.schema = schema
+        self.max_buckets = max_buckets
+        self.zero_threshold = zero_threshold
+
+    def _new_series(self, labels, shared=True):
+        if self.buckets is None:
+            return ExponentialBucket(self.name, labels, self.schema, self.max_buckets,
+                                     self.zero_threshold)
+        return LessOrEqualBucket(self.name, self.buckets, labels,
+                                 self._shared if shared else None)
+
+    def observe_many(self, values, **labels):
+        """
+            Observe a whole batch (list, generator or NumPy array) at once.
+            Uses NumPy if available.
+        """
+        self._lookup(labels).add_many(values)
+        self.dirty = True
 
     def measure(self, value, **labels):
         self.observe(value, **labels)
         return self
+
+
+# Counted by the cardinality limits of every metric, see Base
+LIMIT_COUNTERS = collections.OrderedDict([
+    ("dropped", ("pytheus_series_dropped_total",
+                 "Series not created, the metric reached max_series.")),
+    ("evicted", ("pytheus_series_evicted_total",
+                 "Series removed to make room for a new one.")),
+    ("expired", ("pytheus_series_expired_total",
+                 "Series removed, not updated within the ttl.")),
+])
+
+# Created on first use: importing this module can't build meters yet
+_limit_counters = collections.OrderedDict()
+_limit_lock = threading.Lock()
+
+
+def _count_limited(kind, metric, amount=1.0):
+    counter = _limit_counters.get(kind)
+    if counter is None:
+        with _limit_lock:
+            counter = _limit_counters.get(kind)
+            if counter is None:
+                counter = Counter(*LIMIT_COUNTERS[kind])
+                _limit_counters[kind] = counter
+    counter.inc(amount, metric=metric.name)
+
+
+def limit_counters():
+    """Returns the series_* counters, once a metric has hit a limit."""
+    return list(_limit_counters.values())
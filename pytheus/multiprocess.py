@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+
+"""
+    Multiprocess mode, for pre-fork servers.
+
+    Each process writes its samples into its own mmap-backed files inside
+    a shared directory (one file per metric type, named after its pid).
+    When scraped, the exporter reads and merges every file instead of its
+    in-memory meters.
+
+    Enable it before creating any metric, either by exporting
+    PYTHEUS_MULTIPROC_DIR or with:
+
+        pytheus.multiprocess.enable("/run/pytheus")
+
+    Gauges need to know how to merge their values across processes, see
+    GAUGE_MODES. Summaries only expose _sum and _count, quantiles can't be
+    merged.
+"""
+
+import collections
+import errno
+import fcntl
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import pytheus.meter
+
+
+GAUGE_MODES = (
+    "all",      # One series per process, labelled with its pid
+    "liveall",  # Same, dropped once the process is dead
+    "sum",      # Sum of all processes
+    "livesum",  # Sum of the live processes
+    "min",
+    "max",
+)
+
+directory = os.environ.get("PYTHEUS_MULTIPROC_DIR")
+
+# Files of the current process, reopened after a fork
+_files = {}
+_files_pid = None
+_files_lock = threading.Lock()
+
+
+class InvalidModeError(Exception):
+    """When a gauge's multiprocess mode isn't one of GAUGE_MODES."""
+    pass
+
+
+def enable(path):
+    """Turns on multiprocess mode, files are written into path."""
+    global directory
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    directory = path
+    _files.clear()
+
+
+def disable():
+    global directory
+    directory = None
+    _files.clear()
+
+
+class MmapedDict(object):
+    """
+        A {key: float} dictionary backed by an mmap'ed file.
+
+        Layout: 8 bytes header (used bytes), followed by entries of
+            4 bytes key length, the key (padded to 8 bytes), 8 bytes value.
+        Entries are only ever appended, so readers in other processes can
+        safely walk the file up to the used size. Our own reads and writes
+        hold the lock: the mapping is replaced (and the old one closed)
+        when the file grows.
+    """
+
+    initial_size = 1024 * 1024
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.positions = {}
+        if readonly:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self.capacity = os.fstat(fd).st_size
+                self.m = mmap.mmap(fd, self.capacity, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+            # Grown by its writer since we looked at its size: we only
+            # see what was mapped, entries() skips one cut at the end
+            self.used = min(struct.unpack_from('<i', self.m, 0)[0], self.capacity)
+            return
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        self.capacity = os.fstat(self.fd).st_size
+        if self.capacity == 0:
+            os.ftruncate(self.fd, MmapedDict.initial_size)
+            self.capacity = MmapedDict.initial_size
+        self.m = mmap.mmap(self.fd, self.capacity)
+        self.used = struct.unpack_from('<i', self.m, 0)[0]
+        if self.used == 0:
+            self.used = 8
+            struct.pack_into('<i', self.m, 0, self.used)
+        for key, _, position in self.entries():
+            self.positions[key] = position
+
+    def entries(self):
+        """Yields (key, value, position) for every entry."""
+        position = 8
+        while position + 4 <= self.used:
+            length = struct.unpack_from('<i', self.m, position)[0]
+            key_end = position + 4 + length
+            value = key_end + (8 - (4 + length) % 8) % 8
+            if value + 8 > self.used:
+                return
+            yield self.m[position + 4:key_end], struct.unpack_from('<d', self.m, value)[0], value
+            position = value + 8
+
+    def _init_value(self, key):
+        with self.lock:
+            if key in self.positions:
+                return self.positions[key]
+            padding = (8 - (4 + len(key)) % 8) % 8
+            entry = struct.pack('<i', len(key)) + key + b' ' * padding + struct.pack('<d', 0.0)
+            if self.used + len(entry) > self.capacity:
+                while self.used + len(entry) > self.capacity:
+                    self.capacity *= 2
+                os.ftruncate(self.fd, self.capacity)
+                old, self.m = self.m, mmap.mmap(self.fd, self.capacity)
+                old.close()
+            self.m[self.used:self.used + len(entry)] = entry
+            self.used += len(entry)
+            # Only publish the entry once it's complete
+            struct.pack_into('<i', self.m, 0, self.used)
+            self.positions[key] = self.used - 8
+            return self.positions[key]
+
+    def read_value(self, key):
+        position = self.positions.get(key)
+        if position is None:
+            return 0.0
+        with self.lock:
+            return struct.unpack_from('<d', self.m, position)[0]
+
+    def write_value(self, key, value):
+        position = self.positions.get(key)
+        if position is None:
+            position = self._init_value(key)
+        with self.lock:
+            struct.pack_into('<d', self.m, position, value)
+
+    def close(self):
+        self.m.close()
+        if hasattr(self, "fd"):
+            os.close(self.fd)
+
+
+def _file(prefix):
+    global _files_pid
+    pid = os.getpid()
+    if pid != _files_pid:
+        with _files_lock:
+            if pid != _files_pid:
+                # Inherited from our parent, don't close: it still uses them
+                _files.clear()
+                _files_pid = pid
+    store = _files.get(prefix)
+    if store is None:
+        with _files_lock:
+            store = _files.get(prefix)
+            if store is None:
+                path = os.path.join(directory, "%s_%i.db" % (prefix, pid))
+                store = _files[prefix] = MmapedDict(path)
+    return store
+
+
+class SharedValue(object):
+    """
+        The shared counterpart of a sample, written through on every update.
+        Always starts at 0 in a new process, even if the in-memory sample
+        was inherited from the parent with a value.
+    """
+
+    __slots__ = ('prefix', 'key')
+
+    def __init__(self, prefix, key):
+        self.prefix = prefix
+        self.key = key
+
+    def set(self, value):
+        _file(self.prefix).write_value(self.key, value)
+
+    def inc(self, amount):
+        store = _file(self.prefix)
+        store.write_value(self.key, store.read_value(self.key) + amount)
+
+
+def shared_value(metric, sample_name, labels):
+    """Returns a SharedValue for the sample, None outside multiprocess mode."""
+    if directory is None:
+        return None
+    prefix = metric.__class__.__name__.lower()
+    if prefix == "gauge":
+        prefix += "_" + metric.multiprocess_mode
+    key = json.dumps([metric.name, sample_name,
+                      [[str(k), str(v)] for k, v in labels.items()],
+                      metric.description])
+    return SharedValue(prefix, key.encode("utf-8"))
+
+
+def _parse_filename(path):
+    prefix, pid = os.path.basename(path)[:-len(".db")].rsplit("_", 1)
+    return prefix, pid
+
+
+def _is_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except OSError as error:
+        return error.errno != errno.ESRCH
+    return True
+
+
+class Collector(object):
+    """Merges the files written by every process into one exposition."""
+
+    # Keys decoded, it's emptied when full
+    max_keys = 100000
+
+    def __init__(self, path=None):
+        self.path = path
+        # Keys are json, only decode each one once
+        self._keys = {}
+
+    def _decode(self, key):
+        decoded = self._keys.get(key)
+        if decoded is None:
+            if len(self._keys) >= self.max_keys:
+                self._keys.clear()
+            name, sample_name, labels, description = json.loads(key.decode("utf-8"))
+            decoded = (name, sample_name, tuple(tuple(pair) for pair in labels), description)
+            self._keys[key] = decoded
+        return decoded
+
+    def merge(self, selector=None):
+        """
+            Returns {name: (type, description, {(sample, labels): value})},
+            only the families matching selector if given. The live gauge
+            modes skip the files of dead processes, not cleaned up yet.
+        """
+        families = {}
+        selected = {}
+        for path in sorted(glob.glob(os.path.join(self.path or directory, "*.db"))):
+            prefix, pid = _parse_filename(path)
+            metric_type, _, mode = prefix.partition("_")
+            if mode.startswith("live") and pid != "aggregate" and not _is_alive(pid):
+                continue
+            try:
+                store = MmapedDict(path, readonly=True)
+            except (IOError, OSError, ValueError):
+                continue # Deleted (or still empty) while we were listing
+            try:
+                for key, value, _ in store.entries():
+                    name, sample_name, labels, description = self._decode(key)
+                    if selector is not None:
+                        if name not in selected:
+                            selected[name] = selector.matches(name)
+                        if not selected[name]:
+                            continue
+                    family = families.setdefault(name, (metric_type, description, {}))
+                    samples = family[2]
+                    if mode in ("all", "liveall") and pid != "aggregate":
+                        labels = labels + (("pid", pid),)
+                    sample = (sample_name, labels)
+                    if sample not in samples:
+                        samples[sample] = value
+                    elif mode == "min":
+                        samples[sample] = min(samples[sample], value)
+                    elif mode == "max":
+                        samples[sample] = max(samples[sample], value)
+                    else:
+                        samples[sample] += value
+            finally:
+                store.close()
+        return families
+
+    def to_string(self, selector=None):
+        """Only the families matching selector (pytheus.collector.Selector), if any."""
+        out = []
+        families = self.merge(selector)
+        for name in sorted(families):
+            metric_type, description, samples = families[name]
+            out.append("# HELP {0} {1}\n".format(name, description))
+            out.append("# TYPE {0} {1}\n".format(name, metric_type))
+            if metric_type == "histogram":
+                samples = _cumulative(samples)
+            for (sample_name, labels), value in sorted(samples.items(), key=_sort_key):
+                if sample_name.endswith("_count"):
+                    value = int(value)
+                out.append(pytheus.meter.SimpleMetric(
+                    sample_name, value, collections.OrderedDict(labels)).to_string())
+        return "".join(out)
+
+    def to_bytes(self, selector=None):
+        """Same as to_string, encoded: what's sent."""
+        rendered = self.to_string(selector)
+        if isinstance(rendered, bytes): # Python 2
+            return rendered
+        return rendered.encode("utf-8")
+
+
+def _bound(le):
+    return float("inf") if le == "+Inf" else float(le)
+
+
+def _sort_key(item):
+    """Groups the samples by series, buckets in ascending order."""
+    (sample_name, labels), _ = item
+    others = tuple(pair for pair in labels if pair[0] != "le")
+    le = dict(labels).get("le")
+    return others, sample_name, _bound(le) if le is not None else 0
+
+
+def _cumulative(samples):
+    """Buckets are stored per bucket, they're exposed cumulatively."""
+    series = {}
+    out = {}
+    for (sample_name, labels), value in samples.items():
+        if not sample_name.endswith("_bucket"):
+            out[(sample_name, labels)] = value
+            continue
+        others = tuple(pair for pair in labels if pair[0] != "le")
+        bound = _bound(dict(labels)["le"])
+        series.setdefault((sample_name, others), []).append((bound, labels, value))
+    for (sample_name, _), buckets in series.items():
+        total = 0
+        for _, labels, value in sorted(buckets):
+            total += value
+            out[(sample_name, labels)] = int(total)
+    return out
+
+
+def mark_process_dead(pid, path=None):
+    """
+        Call it when a worker exits (for instance from gunicorn's
+        child_exit hook). Its live gauges are removed and everything else
+        is folded into the aggregate files, the samples of "all" gauges
+        with their pid label.
+    """
+    path = path or directory
+    for filename in glob.glob(os.path.join(path, "*_%s.db" % (pid))):
+        _compact_file(filename, path)
+
+
+def cleanup(path=None):
+    """Compacts the files of every process which is no longer running."""
+    path = path or directory
+    for filename in glob.glob(os.path.join(path, "*.db")):
+        _, pid = _parse_filename(filename)
+        if pid != "aggregate" and pid != str(os.getpid()) and not _is_alive(pid):
+            _compact_file(filename, path)
+
+
+def _compact_file(filename, path):
+    prefix, pid = _parse_filename(filename)
+    if pid == "aggregate":
+        return
+    mode = prefix.partition("_")[2]
+    if mode in ("liveall", "livesum"):
+        os.unlink(filename)
+        return
+
+    # Several workers might be compacting at the same time
+    with open(os.path.join(path, ".compact.lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(filename):
+                return
+            dead = MmapedDict(filename, readonly=True)
+            aggregate = MmapedDict(os.path.join(path, "%s_aggregate.db" % (prefix)))
+            try:
+                for key, value, _ in dead.entries():
+                    if mode == "all":
+                        key = _with_pid(key, pid)
+                    if key not in aggregate.positions:
+                        aggregate.write_value(key, value)
+                    elif mode == "min":
+                        aggregate.write_value(key, min(aggregate.read_value(key), value))
+                    elif mode == "max":
+                        aggregate.write_value(key, max(aggregate.read_value(key), value))
+                    else:
+                        aggregate.write_value(key, aggregate.read_value(key) + value)
+            finally:
+                dead.close()
+                aggregate.close()
+            os.unlink(filename)
+            logging.debug("Compacted %s", filename)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _with_pid(key, pid):
+    """The key of a sample of the "all" mode, its pid label included."""
+    name, sample_name, labels, description = json.loads(key.decode("utf-8"))
+    labels.append(["pid", pid])
+    return json.dumps([name, sample_name, labels, description]).encode("utf-8")
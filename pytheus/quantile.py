@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+    Streaming quantile estimation for summaries.
+
+    Implements the targeted quantiles algorithm from Cormode, Korn,
+    Muthukrishnan and Srivastava (CKMS): "Effective Computation of Biased
+    Quantiles over Data Streams". Only a compressed set of samples is kept,
+    enough to answer the requested quantiles within their error targets,
+    so memory stays bounded no matter how many observations come in.
+
+    Heavily inspired by https://github.com/beorn7/perks (used by the
+    official golang client).
+"""
+
+import math
+import time
+
+
+class Estimator(object):
+    """
+        Targets is a dictionary of {quantile: allowed error}, for instance
+        {0.5: 0.05, 0.99: 0.001} means the median may be off by 5% in rank
+        and the 99th percentile by 0.1%.
+    """
+
+    # Observations are buffered and merged in batches, keeps insert O(1)
+    buffer_size = 500
+
+    def __init__(self, targets):
+        self.targets = sorted(targets.items())
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.samples = [] # [value, width, delta], ordered by value
+        self.buffer = []
+        self.min = float("NaN")
+        self.max = float("NaN")
+
+    def _invariant(self, rank):
+        """Maximum allowed (width + delta) for a sample at this rank."""
+        allowed = float("inf")
+        for quantile, epsilon in self.targets:
+            if quantile * self.n <= rank:
+                if quantile > 0:
+                    allowed = min(allowed, 2 * epsilon * rank / quantile)
+            elif quantile < 1:
+                allowed = min(allowed, 2 * epsilon * (self.n - rank) / (1 - quantile))
+        return allowed
+
+    def insert(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= Estimator.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.buffer.sort()
+        if not self.n:
+            self.min = self.buffer[0]
+            self.max = self.buffer[-1]
+        else:
+            self.min = min(self.min, self.buffer[0])
+            self.max = max(self.max, self.buffer[-1])
+
+        merged = []
+        samples = self.samples
+        i = 0
+        rank = 0.0
+        for value in self.buffer:
+            while i < len(samples) and samples[i][0] <= value:
+                merged.append(samples[i])
+                rank += samples[i][1]
+                i += 1
+            delta = 0
+            if i < len(samples):
+                delta = max(0, math.floor(self._invariant(rank)) - 1)
+            merged.append([value, 1, delta])
+            self.n += 1
+            rank += 1
+        merged.extend(samples[i:])
+
+        self.buffer = []
+        self.samples = merged
+        self._compress()
+
+    def _compress(self):
+        if len(self.samples) < 2:
+            return
+        last = self.samples[-1]
+        kept = [last]
+        rank = self.n - 1 - last[1]
+        for sample in reversed(self.samples[:-1]):
+            if sample[1] + last[1] + last[2] <= self._invariant(rank):
+                last[1] += sample[1]
+            else:
+                kept.append(sample)
+                last = sample
+            rank -= sample[1]
+        kept.reverse()
+        self.samples = kept
+
+    def query(self, quantile):
+        self.flush()
+        if not self.n:
+            return float("NaN")
+        if quantile <= 0:
+            return self.min
+        if quantile >= 1:
+            return self.max
+
+        target = math.ceil(quantile * self.n)
+        bound = target + self._invariant(target) / 2
+        rank = 0
+        previous = self.samples[0]
+        for sample in self.samples[1:]:
+            rank += previous[1]
+            if rank + sample[1] + sample[2] > bound:
+                return previous[0]
+            previous = sample
+        return previous[0]
+
+
+class Window(object):
+    """
+        Sliding time window over Estimators.
+
+        Observations go into age_buckets estimators, one of them is reset
+        every max_age / age_buckets seconds. Queries are answered by the
+        oldest one, which holds (roughly) the last max_age seconds.
+    """
+
+    def __init__(self, targets, max_age, age_buckets=5):
+        self.max_age = float(max_age)
+        self.streams = [Estimator(targets) for _ in range(age_buckets)]
+        self.head = 0
+        self.rotate_every = self.max_age / age_buckets
+        self.next_rotation = time.time() + self.rotate_every
+
+    def _rotate(self):
+        now = time.time()
+        if now < self.next_rotation:
+            return
+        if now - self.next_rotation > self.max_age:
+            # Idle for longer than the window, everything is stale
+            for stream in self.streams:
+                stream.reset()
+            self.next_rotation = now + self.rotate_every
+            return
+        while now >= self.next_rotation:
+            self.streams[self.head].reset()
+            self.head = (self.head + 1) % len(self.streams)
+            self.next_rotation += self.rotate_every
+
+    def insert(self, value):
+        self._rotate()
+        for stream in self.streams:
+            stream.insert(value)
+
+    def query(self, quantile):
+        self._rotate()
+        return self.streams[self.head].query(quantile)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+"""
+    Runs the collector functions in the background, each at its own
+    interval, on a fixed pool of worker threads (optionally handing
+    CPU-bound ones to a pool of processes).
+
+    Scrapes never wait for a collector: they only read the latest result
+    that was measured into the metric.
+
+    AsyncBase does the same on an asyncio event loop (Python 3 only),
+    collector functions may then be coroutines (async def).
+"""
+
+import inspect
+import logging
+import multiprocessing
+import random
+import threading
+import time
+
+try:
+    import Queue
+except ImportError: # Python 3
+    import queue as Queue
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None
+
+
+def iscoroutinefunction(function):
+    """True for async def functions, always False before Python 3.5."""
+    check = getattr(inspect, "iscoroutinefunction", None)
+    return bool(check and check(function))
+
+
+class Job(object):
+    """
+        A collector function and its schedule. Timeout defaults to the
+        interval, a run taking longer than that is abandoned: its result
+        (if it ever comes back) is discarded.
+        Metrics updated inline (see pytheus.instrument) have no function:
+        they're never run, only exposed.
+    """
+
+    default_interval = 15
+
+    def __init__(self, metric, function, interval=None, timeout=None, process=False):
+        self.metric = metric
+        self.function = function
+        self.interval = interval or Job.default_interval
+        self.timeout = timeout or self.interval
+        self.process = process
+        self.next_run = None
+        self.started = None
+        self.running = False
+        self.timed_out = False
+        self.collected = function is None
+        self.last_duration = None
+        self.last_success = None
+        self.failures = 0
+
+    @property
+    def name(self):
+        if self.function is None:
+            return self.metric.name
+        return self.function.__name__
+
+    def measure(self, result):
+        """
+            Result is a single (value, {labels}) sample or an iterable of
+            them, generators are consumed as they go (see measure_many).
+        """
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], dict):
+            self.metric.measure(result[0], **result[1])
+        else:
+            self.metric.measure_many(result)
+
+    def collect(self):
+        """Runs the function and measures its result, unless it timed out meanwhile."""
+        result = self.function()
+        if not self.timed_out:
+            self.measure(result)
+
+
+class Base(object):
+
+    # Hung workers replaced at most at once, past that the pool shrinks
+    max_spares = 8
+
+    def __init__(self, workers=4, processes=0, jitter=0.1):
+        """
+            Each run is rescheduled interval * (1 +- jitter) after it
+            started, the first one within interval * jitter of starting,
+            so collectors sharing an interval don't all fire together.
+        """
+        self.workers = workers
+        self.processes = processes
+        self.jitter = jitter
+        self.jobs = {}
+        self.pool = None
+        self.running = False
+        self.lock = threading.Lock()
+        self._pending = Queue.Queue()
+        self._wakeup = threading.Event()
+        self._spares = 0 # Workers started to replace hung ones
+        self.abandoned = 0 # Runs that timed out, left running
+
+    def start(self, jobs):
+        """Jobs is a dictionary of {metric: Job}, watched for new entries."""
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.jobs = jobs
+        for _ in range(self.workers):
+            self._spawn()
+        thread = threading.Thread(target=self._loop, name="pytheus-scheduler")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+        for _ in range(self.workers + self._spares):
+            self._pending.put(None)
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    def _spawn(self):
+        thread = threading.Thread(target=self._worker, name="pytheus-collector")
+        thread.daemon = True
+        thread.start()
+
+    def _jitter(self):
+        return random.uniform(-self.jitter, self.jitter)
+
+    def _loop(self):
+        while self.running:
+            now = time.time()
+            wake_at = now + 1
+            for job in list(self.jobs.values()):
+                if job.function is None:
+                    continue
+                if job.next_run is None:
+                    job.next_run = now + job.interval * random.uniform(0, self.jitter)
+                if job.running:
+                    if not job.timed_out and not job.process and now > job.started + job.timeout:
+                        self._abandon(job)
+                    continue
+                if now >= job.next_run:
+                    job.running = True
+                    job.timed_out = False
+                    job.started = now
+                    self._pending.put(job)
+                    continue
+                wake_at = min(wake_at, job.next_run)
+            self._wakeup.wait(max(0, wake_at - time.time()))
+            self._wakeup.clear()
+
+    def _abandon(self, job):
+        logging.warning("Collector %s timed out after %is, abandoning it.",
+                        job.name, job.timeout)
+        job.timed_out = True
+        job.failures += 1
+        # Its worker is stuck, keep the pool at full strength
+        with self.lock:
+            self.abandoned += 1
+            if self._spares >= self.max_spares:
+                logging.error("%i collectors hung already, not replacing the worker of %s.",
+                              self._spares, job.name)
+                return
+            self._spares += 1
+        self._spawn()
+
+    def _process_pool(self):
+        """The pool of processes, started when the first process job runs."""
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes or None)
+            return self.pool
+
+    def _run(self, job):
+        if job.process:
+            return self._process_pool().apply_async(job.function).get(job.timeout)
+        if iscoroutinefunction(job.function):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(asyncio.wait_for(job.function(), job.timeout))
+            finally:
+                loop.close()
+        return job.function()
+
+    def _worker(self):
+        while True:
+            job = self._pending.get()
+            if job is None:
+                return
+
+            success = False
+            try:
+                result = self._run(job)
+                if not job.timed_out:
+                    job.measure(result)
+                    job.collected = True
+                    success = True
+            except multiprocessing.TimeoutError:
+                # Its process is left running, it may never come back
+                logging.warning("Collector %s timed out after %is.", job.name, job.timeout)
+                with self.lock:
+                    self.abandoned += 1
+            except Exception:
+                logging.exception("Collector %s failed.", job.name)
+
+            finished = time.time()
+            job.last_duration = finished - job.started
+            if success:
+                job.last_success = finished
+            elif not job.timed_out:
+                job.failures += 1
+            job.next_run = max(finished, job.started + job.interval * (1 + self._jitter()))
+            abandoned = job.timed_out
+            job.running = False
+            self._wakeup.set()
+
+            if abandoned:
+                with self.lock:
+                    # Replaced while we were stuck, the pool is full already
+                    if self._spares > 0:
+                        self._spares -= 1
+                        return
+
+
+class AsyncBase(object):
+    """
+        Runs the collectors on an asyncio event loop: coroutine functions
+        run on the loop itself (cancelled if they time out), plain ones on
+        a bounded thread pool. Thousands of async collectors only cost one
+        thread.
+    """
+
+    def __init__(self, loop, workers=4, jitter=0.1):
+        self.loop = loop
+        self.workers = workers
+        self.jitter = jitter
+        self.jobs = {}
+        self.executor = None
+        self.running = False
+        self._scheduled = set()
+
+    def start(self, jobs):
+        """Jobs is a dictionary of {metric: Job}, watched for new entries."""
+        if self.running:
+            return
+        self.running = True
+        self.jobs = jobs
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.loop.call_soon_threadsafe(self._watch)
+
+    def stop(self):
+        self.running = False
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def _watch(self):
+        """Schedules the first run of jobs we haven't seen yet."""
+        if not self.running:
+            return
+        for job in list(self.jobs.values()):
+            if job.function is not None and job not in self._scheduled:
+                self._scheduled.add(job)
+                self.loop.call_later(job.interval * random.uniform(0, self.jitter),
+                                     self._run, job)
+        self.loop.call_later(1, self._watch)
+
+    def _run(self, job):
+        if not self.running:
+            return
+        job.running = True
+        job.timed_out = False
+        job.started = time.time()
+        coroutine = iscoroutinefunction(job.function)
+        if coroutine:
+            awaitable = job.function()
+        else:
+            # Measured in the thread too, generators aren't consumed on the loop
+            awaitable = self.loop.run_in_executor(self.executor, job.collect)
+        task = self.loop.create_task(asyncio.wait_for(awaitable, job.timeout))
+        task.add_done_callback(lambda task: self._done(job, task, coroutine))
+
+    def _done(self, job, task, coroutine=True):
+        finished = time.time()
+        try:
+            result = task.result()
+            if coroutine:
+                job.measure(result)
+            job.collected = True
+            job.last_success = finished
+        except asyncio.TimeoutError:
+            logging.warning("Collector %s timed out after %is.", job.name, job.timeout)
+            job.timed_out = True
+            job.failures += 1
+        except Exception:
+            logging.exception("Collector %s failed.", job.name)
+            job.failures += 1
+        job.last_duration = finished - job.started
+        job.running = False
+
+        interval = job.interval * (1 + random.uniform(-self.jitter, self.jitter))
+        job.next_run = max(finished, job.started + interval)
+        self.loop.call_later(job.next_run - finished, self._run, job)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+"""
+    StatsD (and DogStatsD) ingestion, for processes that aren't Python:
+    they send lines over UDP or a Unix datagram socket,
+
+        name:value|type[|@sample_rate][|#tag:value,...]
+
+    aggregated into pytheus meters and exposed with everything else.
+
+        c: counter, incremented (by value / sample_rate).
+        g: gauge, set; +N and -N add to it.
+        ms, h, d: timer, histogram, distribution: observed by summaries
+                  and histograms. Timers are in milliseconds, converted
+                  to seconds unless the mapping has a scale.
+    Sets (s) aren't supported. A packet may hold several lines, a line
+    several values (name:1:2:3|ms).
+
+    Names are mapped to meters by Mapping, tags become labels. Names no
+    mapping matches get a meter of their own (dots turned into
+    underscores), unless auto is False.
+
+    Packets are drained in batches and aggregated by series before
+    touching the meters, once per series per batch. What a line resolves
+    to (meter and labels) is cached: known lines cost a couple of splits
+    and dictionary lookups, no metric objects are created for them.
+"""
+
+import errno
+import logging
+import os
+import re
+import select
+import socket
+import stat
+import threading
+
+import pytheus.collector
+import pytheus.meter
+
+
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+DEFAULT_QUANTILES = [0.5, 0.9, 0.99]
+
+OBSERVED_TYPES = (b"ms", b"h", b"d")
+TYPES = (b"c", b"g") + OBSERVED_TYPES
+
+# Not a valid metric or label name character
+_INVALID = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class InvalidLineError(Exception):
+    """When a line isn't name:value|type[|...]."""
+    pass
+
+
+def _text(value):
+    """Names and tags come out of bytes."""
+    if isinstance(value, bytes) and not isinstance(value, str): # Python 3
+        return value.decode("utf-8", "replace")
+    return value
+
+
+def sanitize(name):
+    """A valid Prometheus name out of a StatsD one."""
+    name = _INVALID.sub("_", name)
+    if not name or name[0].isdigit():
+        name = "_" + name
+    return name
+
+
+def _accepts(metric, kind):
+    """Whether lines of that type fit metric."""
+    if kind == b"c":
+        return isinstance(metric, pytheus.meter.Counter)
+    if kind == b"g":
+        return isinstance(metric, pytheus.meter.Gauge) and \
+            not isinstance(metric, pytheus.meter.Counter)
+    return isinstance(metric, pytheus.meter.Summary)
+
+
+class Mapping(object):
+    """
+        Maps the StatsD names matching pattern to metric. Pattern is a
+        dotted name, * matching any one component; labels are fixed values
+        or refer to the components * matched, in order ($1, $2...):
+
+            Mapping("api.*.requests", requests, labels={"service": "$1"})
+
+        Scale multiplies the values (by default timers in milliseconds
+        are turned into seconds, see the module). Lines of a type metric
+        doesn't take (a gauge line for a counter) are invalid.
+    """
+
+    def __init__(self, pattern, metric, labels=None, scale=None):
+        parts = ["([^.]+)" if part == "*" else re.escape(part)
+                 for part in pattern.split(".")]
+        self.regex = re.compile(r"\.".join(parts) + "$")
+        self.metric = metric
+        self.labels = labels or {}
+        self.scale = scale
+
+    def match(self, name):
+        """Returns the labels of name, None if it doesn't match."""
+        match = self.regex.match(name)
+        if match is None:
+            return None
+        groups = match.groups()
+        return dict((label, re.sub(r"\$(\d+)", lambda ref: groups[int(ref.group(1)) - 1], value))
+                    for label, value in self.labels.items())
+
+
+class Target(object):
+    """A series lines resolve to, and what the current batch did to it."""
+
+    __slots__ = ('metric', 'labels', 'key', 'kind', 'scale',
+                 'total', 'value', 'values', 'pending')
+
+    # Kinds
+    COUNTER, GAUGE, OBSERVED = range(3)
+
+    def __init__(self, metric, labels, scale):
+        self.metric = metric
+        self.labels = metric._sorted_dict(labels)
+        self.key = metric._encode(self.labels)
+        if isinstance(metric, pytheus.meter.Counter):
+            self.kind = Target.COUNTER
+        elif isinstance(metric, pytheus.meter.Gauge):
+            self.kind = Target.GAUGE
+        else:
+            self.kind = Target.OBSERVED
+        self.scale = scale
+        self.total = 0.0
+        self.value = None
+        self.values = []
+        self.pending = False
+
+    def flush(self):
+        """Applies the batch to the series (looked up again: it may have been removed)."""
+        metric = self.metric
+        series = metric._get_series(self.labels, self.key)
+        if self.kind == Target.OBSERVED:
+            series.add_many(self.values)
+            self.values = []
+        else:
+            if self.value is not None:
+                series.set(self.value)
+            if self.total:
+                series.inc(self.total)
+            self.total = 0.0
+            self.value = None
+        metric.dirty = True
+        self.pending = False
+
+
+class Stats(object):
+    """What was received, and what couldn't be used."""
+
+    def __init__(self):
+        self.packets = 0
+        self.lines = 0
+        self.invalid = 0 # Lines we couldn't parse
+        self.unmapped = 0 # Lines not matching a mapping, with auto off
+
+
+class Base(object):
+    """
+        Listens on UDP (address, port) and/or a Unix datagram socket at
+        path; port None for no UDP. Meters of the mappings are registered
+        (exposed) if they aren't already, so are the automatic ones: timers
+        become histograms of buckets, or summaries of quantiles with
+        timer="summary". Limits (max_series, overflow, ttl) apply to the
+        automatic meters.
+
+        Up to batch_size packets are read before they're applied.
+    """
+
+    # How often (seconds) serve_forever wakes up to check for stop()
+    poll_interval = 2
+    batch_size = 1024
+    packet_size = 65535
+    receive_buffer = 4 << 20
+    # Lines cached, it's emptied when full
+    max_cache = 100000
+
+    def __init__(self, address="0.0.0.0", port=8125, path=None, mappings=(),
+                 auto=True, timer="histogram", buckets=None, quantiles=None, **limits):
+        self.address = address
+        self.port = port
+        self.path = path
+        self.mappings = list(mappings)
+        self.auto = auto
+        self.timer = timer
+        self.buckets = buckets or DEFAULT_BUCKETS
+        self.quantiles = quantiles or DEFAULT_QUANTILES
+        self.limits = limits
+        self.running = False
+        self.stats = Stats()
+        self.metrics = {} # {name: automatic metric}
+        self._cache = {} # {name: {rest of the line: (Target, sample rate)}}
+        self._cached = 0 # Lines in _cache, across names
+        self._targets = {} # {(metric, key): Target}
+        self._pending = []
+
+        for mapping in self.mappings:
+            self._register(mapping.metric)
+
+        self.socks = []
+        if port is not None:
+            family = socket.AF_INET6 if ":" in address else socket.AF_INET
+            sock = self._socket(family)
+            sock.bind((address, port))
+            self.port = sock.getsockname()[1] # In case we bound to port 0
+        if path is not None:
+            self._remove_stale(path)
+            self._socket(socket.AF_UNIX).bind(path)
+
+    def _socket(self, family):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            # Room for bursts while we're busy applying a batch
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+        except socket.error:
+            logging.debug("Unable to set the receive buffer.", exc_info=True)
+        sock.setblocking(0)
+        self.socks.append(sock)
+        return sock
+
+    @staticmethod
+    def _remove_stale(path):
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    @staticmethod
+    def _register(metric):
+        if metric not in pytheus.collector.Base.decorators:
+            pytheus.collector.Base.register(metric)
+
+    def start(self):
+        """Serves in a background thread."""
+        thread = threading.Thread(target=self.serve_forever, name="pytheus-statsd")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve_forever(self):
+        logging.info("Starting statsd server: %s:%s %s", self.address, self.port, self.path or "")
+        self.running = True
+        try:
+            while self.running:
+                readable, _, _ = select.select(self.socks, [], [], self.poll_interval)
+                for sock in readable:
+                    self.feed(self._drain(sock))
+        finally:
+            self.running = False
+
+    def stop(self):
+        """Ask serve_forever to return, takes at most poll_interval seconds."""
+        self.running = False
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+        if self.path is not None:
+            self._remove_stale(self.path)
+
+    def _drain(self, sock):
+        """Up to batch_size packets waiting on sock."""
+        packets = []
+        recv = sock.recv
+        size = self.packet_size
+        for _ in range(self.batch_size):
+            try:
+                packets.append(recv(size))
+            except socket.error as error:
+                if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.warning("Unable to receive: %s", error)
+                break
+        return packets
+
+    def feed(self, packets):
+        """Parses packets (bytes) and applies them to the meters."""
+        stats = self.stats
+        stats.packets += len(packets)
+        parse = self._parse
+        for packet in packets:
+            for line in packet.split(b"\n"):
+                if not line:
+                    continue
+                stats.lines += 1
+                try:
+                    parse(line)
+                except (InvalidLineError, ValueError):
+                    stats.invalid += 1
+                    logging.debug("Invalid statsd line: %r", line)
+        self._flush()
+
+    def _parse(self, line):
+        name, _, rest = line.partition(b":")
+        values, _, rest = rest.partition(b"|")
+        if not name or not rest:
+            raise InvalidLineError("Not name:value|type")
+
+        known = self._cache.get(name)
+        resolved = known.get(rest) if known is not None else None
+        if resolved is None:
+            resolved = self._resolve(name, rest)
+        target, rate = resolved
+        if target is None:
+            self.stats.unmapped += 1
+            return
+
+        kind = target.kind
+        for value in values.split(b":"):
+            if kind == Target.COUNTER:
+                target.total += float(value) / rate
+            elif kind == Target.GAUGE:
+                if value[:1] in (b"+", b"-"):
+                    if target.value is None:
+                        target.total += float(value)
+                    else:
+                        target.value += float(value)
+                else:
+                    target.value = float(value)
+                    target.total = 0.0
+            else:
+                value = float(value) * target.scale
+                if rate < 1:
+                    target.values.extend([value] * int(round(1 / rate)))
+                else:
+                    target.values.append(value)
+        if not target.pending:
+            target.pending = True
+            self._pending.append(target)
+
+    def _resolve(self, name, rest):
+        """
+            Finds (and caches) the Target and sample rate of a line, the
+            Target is None when it isn't mapped.
+        """
+        fields = rest.split(b"|")
+        kind = fields[0]
+        if kind not in TYPES:
+            raise InvalidLineError("Unsupported type")
+        rate = 1.0
+        labels = {}
+        for field in fields[1:]:
+            if field[:1] == b"@":
+                rate = float(field[1:])
+                if not 0 < rate <= 1:
+                    raise InvalidLineError("Sample rate out of range")
+            elif field[:1] == b"#":
+                for tag in field[1:].split(b","):
+                    if tag:
+                        label, _, value = tag.partition(b":")
+                        labels[sanitize(_text(label))] = _text(value)
+            # Anything else (container id, timestamp) is ignored
+
+        text = _text(name)
+        scale = None
+        for mapping in self.mappings:
+            mapped = mapping.match(text)
+            if mapped is not None:
+                metric = mapping.metric
+                if not _accepts(metric, kind):
+                    raise InvalidLineError("%s is a %s" % (text, metric.__class__.__name__.lower()))
+                scale = mapping.scale
+                labels.update(mapped)
+                break
+        else:
+            if not self.auto:
+                return self._remember(name, rest, (None, rate))
+            metric = self._auto(sanitize(text), kind)
+        if scale is None:
+            scale = 0.001 if kind == b"ms" else 1.0
+
+        if len(self._targets) >= self.max_cache:
+            self._clear()
+        target = self._targets.get((metric, metric._encode(metric._sorted_dict(labels))))
+        if target is None:
+            target = Target(metric, labels, scale)
+            self._targets[(metric, target.key)] = target
+        return self._remember(name, rest, (target, rate))
+
+    def _remember(self, name, rest, resolved):
+        if self._cached >= self.max_cache:
+            self._clear()
+        self._cache.setdefault(name, {})[rest] = resolved
+        self._cached += 1
+        return resolved
+
+    def _auto(self, name, kind):
+        """The automatic meter for name, created on first use."""
+        metric = self.metrics.get(name)
+        if metric is not None:
+            if not _accepts(metric, kind):
+                raise InvalidLineError("%s is a %s" % (name, metric.__class__.__name__.lower()))
+            return metric
+        if kind == b"c":
+            metric = pytheus.meter.Counter(name, **self.limits)
+        elif kind == b"g":
+            metric = pytheus.meter.Gauge(name, **self.limits)
+        elif self.timer == "summary":
+            metric = pytheus.meter.Summary(name, self.quantiles, **self.limits)
+        else:
+            metric = pytheus.meter.Histogram(name, self.buckets, **self.limits)
+        self.metrics[name] = metric
+        self._register(metric)
+        return metric
+
+    def _clear(self):
+        """Forgets the cached lines, keeping what the batch did so far."""
+        self._cache = {}
+        self._cached = 0
+        self._targets = dict(((target.metric, target.key), target) for target in self._pending)
+
+    def _flush(self):
+        for target in self._pending:
+            try:
+                target.flush()
+            except Exception:
+                logging.exception("Unable to apply statsd samples to %s", target.metric.name)
+                target.pending = False
+        self._pending = []
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+r"""
+    Follows log files and turns their lines into metrics, only reading
+    what was appended since the last run:
+
+        tail = pytheus.tail.Base(["/var/log/nginx/access.log"], [
+            pytheus.tail.Rule(r'" (?P<code>\d{3}) ', requests, labels=["code"]),
+            pytheus.tail.Rule(r' rt=(?P<value>[\d.]+)$', latency),
+        ], offsets="/var/lib/pytheus/offsets.json")
+        tail.register(interval=5)
+
+    Files are followed by device and inode: a rotated file is read to its
+    end before moving on to the new one (and followed on under its new
+    name, if the paths match it too), a truncated file is read again
+    from its start. Offsets are saved (if given a path) so a restart picks
+    up where it left off; files seen for the first time are read from
+    their end unless from_beginning.
+
+    New data is read in large chunks, backlogs bigger than mmap_threshold
+    are mapped instead. Rules run their regex over the whole chunk and
+    aggregate by label set before touching the metrics, once per chunk.
+"""
+
+import errno
+import glob
+import json
+import logging
+import mmap
+import os
+import re
+
+import pytheus.collector
+
+
+class InvalidRuleError(Exception):
+    """When a rule can't feed its metric."""
+    pass
+
+
+class Rule(object):
+    """
+        A regex (bytes or text, matching within a line: every match counts)
+        feeding a metric. Labels name groups of the regex. The group named
+        value is what's measured: counters are incremented by it (by 1
+        without it), gauges set to it, summaries and histograms observe it.
+    """
+
+    def __init__(self, pattern, metric, labels=(), value="value"):
+        if not isinstance(pattern, bytes):
+            pattern = pattern.encode("utf-8")
+        self.regex = re.compile(pattern, re.MULTILINE)
+        self.metric = metric
+        self.labels = tuple(labels)
+        self.kind = metric.__class__.__name__.lower()
+        groups = self.regex.groupindex
+        missing = [label for label in self.labels if label not in groups]
+        if missing:
+            raise InvalidRuleError("No such group in the regex: %s" % (", ".join(missing)))
+        self._label_groups = [groups[label] for label in self.labels]
+        self._value_group = groups.get(value)
+        if self._value_group is None and self.kind in ("summary", "histogram"):
+            raise InvalidRuleError("Observing needs a group named %s" % (value))
+
+    def _key(self, match):
+        """The label values of a match, as a tuple."""
+        if not self._label_groups:
+            return ()
+        if len(self._label_groups) == 1:
+            return (match.group(self._label_groups[0]),)
+        return match.group(*self._label_groups)
+
+    def scan(self, buffer, start=0, end=None):
+        """Returns {label values: aggregate} of the matches in buffer[start:end]."""
+        if end is None:
+            end = len(buffer)
+        found = {}
+        key = self._key
+        value_group = self._value_group
+        matches = self.regex.finditer(buffer, start, end)
+
+        if value_group is None:
+            # Counting matches, the common case
+            for match in matches:
+                labels = key(match)
+                found[labels] = found.get(labels, 0) + 1
+        elif self.kind in ("counter", "gauge"):
+            add = self.kind == "counter"
+            for match in matches:
+                labels = key(match)
+                value = float(match.group(value_group))
+                found[labels] = found.get(labels, 0) + value if add else value
+        else:
+            for match in matches:
+                found.setdefault(key(match), []).append(float(match.group(value_group)))
+        return found
+
+    def apply(self, found):
+        """Updates the metric with what scan found, one update per label set."""
+        metric = self.metric
+        for values, aggregate in found.items():
+            labels = dict(zip(self.labels, [_text(value) for value in values]))
+            series = metric._lookup(labels)
+            if isinstance(aggregate, list):
+                series.add_many(aggregate)
+            else:
+                metric._update(series, aggregate)
+            metric.dirty = True
+
+    def feed(self, buffer, start=0, end=None):
+        self.apply(self.scan(buffer, start, end))
+
+
+def _text(value):
+    """Label values come out of bytes."""
+    if isinstance(value, bytes) and not isinstance(value, str): # Python 3
+        return value.decode("utf-8", "replace")
+    return value
+
+
+class Offsets(object):
+    """
+        Where we are in every file, {path: (device, inode, offset)}, saved
+        as JSON (atomically: written aside, then renamed).
+        Lookups see the offsets as of the last save: while a run updates
+        them, a path may already hold a new file when its old one is
+        looked up under the name it was renamed to.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.positions = {}
+        self.saved = {}
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fd:
+                self.positions = dict((path, tuple(position))
+                                      for path, position in json.load(fd).items())
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logging.warning("Ignoring corrupt offsets file: %s", self.path)
+        self.saved = dict(self.positions)
+
+    def save(self):
+        self.saved = dict(self.positions)
+        if not self.path:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as fd:
+            json.dump(self.positions, fd)
+        os.rename(temporary, self.path)
+
+    def get(self, path, device, inode):
+        """The saved offset of path, if it's still the same file."""
+        position = self.saved.get(path)
+        if position and tuple(position[:2]) == (device, inode):
+            return position[2]
+        return None
+
+    def known(self, path):
+        """Whether path was followed (whichever file it was) as of the last save."""
+        return path in self.saved
+
+    def find(self, device, inode):
+        """The saved offset of a file (renamed since), by device and inode."""
+        for position in self.saved.values():
+            if tuple(position[:2]) == (device, inode):
+                return position[2]
+        return None
+
+    def set(self, path, device, inode, offset):
+        self.positions[path] = (device, inode, offset)
+
+    def keep(self, paths):
+        """Forgets the files no longer followed, their inodes may be reused."""
+        self.positions = dict((path, position) for path, position in self.positions.items()
+                              if path in paths)
+
+
+class File(object):
+    """An open log file, and how far it was read."""
+
+    def __init__(self, path, fileobj, device, inode, offset):
+        self.path = path
+        self.fileobj = fileobj
+        self.device = device
+        self.inode = inode
+        self.offset = offset
+
+    def size(self):
+        return os.fstat(self.fileobj.fileno()).st_size
+
+    def close(self):
+        self.fileobj.close()
+
+
+class Base(object):
+    """
+        Tails paths (glob patterns, checked again on every run) through
+        rules, see Rule. collect() reads whatever is new.
+    """
+
+    chunk_size = 1 << 20
+    mmap_threshold = 16 << 20
+
+    def __init__(self, paths, rules, offsets=None, from_beginning=False):
+        if isinstance(paths, (str, type(u""))):
+            paths = [paths]
+        self.paths = paths
+        self.rules = rules
+        self.offsets = Offsets(offsets)
+        self.from_beginning = from_beginning
+        self.files = {} # {path: File}
+        self._rotated = {} # {(device, inode): File} renamed away during a run
+        self._started = False
+
+    def register(self, interval=None, timeout=None):
+        """Runs collect in the background, as the collector of the rules' metrics."""
+        metrics = []
+        for rule in self.rules:
+            if rule.metric not in metrics:
+                metrics.append(rule.metric)
+        pytheus.collector.Base.register_families(metrics, self.collect, interval, timeout)
+
+    def collect(self):
+        """Reads and parses what was appended since the last run."""
+        paths = set()
+        for pattern in self.paths:
+            paths.update(glob.glob(pattern))
+        for path in sorted(set(self.files) | paths):
+            try:
+                self._follow(path)
+            except (IOError, OSError):
+                logging.warning("Unable to tail %s", path, exc_info=True)
+        # Rotated to a name we don't follow
+        for rotated in self._rotated.values():
+            rotated.close()
+        self._rotated = {}
+        self._started = True
+        self.offsets.keep(self.files)
+        self.offsets.save()
+        return () # Metrics were updated already
+
+    def close(self):
+        """Closes the files followed, saving where we are in them."""
+        for current in list(self.files.values()) + list(self._rotated.values()):
+            current.close()
+        self.files = {}
+        self._rotated = {}
+        self.offsets.save()
+
+    def _renamed(self, path, device, inode):
+        """The File we follow (under another path) that is now at path."""
+        renamed = self._rotated.pop((device, inode), None)
+        if renamed is not None:
+            return renamed
+        for other, known in list(self.files.items()):
+            if other != path and (known.device, known.inode) == (device, inode):
+                # Renamed, its old path will be opened again if recreated
+                del self.files[other]
+                return known
+        return None
+
+    def _open(self, path, first_run):
+        fileobj = open(path, "rb")
+        stat = os.fstat(fileobj.fileno())
+        renamed = self._renamed(path, stat.st_dev, stat.st_ino)
+        if renamed is not None:
+            fileobj.close()
+            renamed.path = path
+            return renamed
+        offset = self.offsets.get(path, stat.st_dev, stat.st_ino)
+        if offset is None:
+            offset = self.offsets.find(stat.st_dev, stat.st_ino)
+        if offset is None or offset > stat.st_size:
+            # Appeared after we started, or rotated while we were down:
+            # read it all, it's new. Only never seen paths start at the end.
+            at_end = first_run and not self.from_beginning and offset is None and \
+                not self.offsets.known(path)
+            offset = stat.st_size if at_end else 0
+        return File(path, fileobj, stat.st_dev, stat.st_ino, offset)
+
+    def _follow(self, path):
+        current = self.files.get(path)
+        try:
+            stat = os.stat(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            stat = None # Rotated away, not recreated yet
+
+        if current is not None and (stat is None or
+                                    (stat.st_dev, stat.st_ino) != (current.device, current.inode)):
+            # Rotated: whatever was written before the rename is still ours,
+            # and what comes next too if the new name is followed as well
+            self._read(current)
+            del self.files[path]
+            self._rotated[(current.device, current.inode)] = current
+            current = None
+        if stat is None:
+            return
+        if current is None:
+            current = self._open(path, not self._started)
+            self.files[path] = current
+        elif current.size() < current.offset:
+            logging.info("%s was truncated, reading it from the start.", path)
+            current.offset = 0
+        self._read(current)
+        self.offsets.set(path, current.device, current.inode, current.offset)
+
+    def _read(self, current):
+        """Parses the complete lines past current.offset, up to the end."""
+        size = current.size()
+        if size - current.offset >= self.mmap_threshold:
+            self._read_mapped(current, size) # Then the rest, below
+        fileobj = current.fileobj
+        fileobj.seek(current.offset)
+        while True:
+            chunk = fileobj.read(self.chunk_size)
+            if not chunk:
+                return
+            end = chunk.rfind(b"\n") + 1
+            if not end:
+                if len(chunk) < self.chunk_size:
+                    return # A line still being written
+                end = len(chunk) # Longer than a chunk, cut it
+            self._feed(chunk, 0, end)
+            current.offset += end
+            fileobj.seek(current.offset)
+
+    def _read_mapped(self, current, size):
+        mapped = mmap.mmap(current.fileobj.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            end = mapped.rfind(b"\n", current.offset, size) + 1
+            if end > current.offset:
+                self._feed(mapped, current.offset, end)
+                current.offset = end
+        finally:
+            mapped.close()
+
+    def _feed(self, buffer, start, end):
+        for rule in self.rules:
+            rule.feed(buffer, start, end)
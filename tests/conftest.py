@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+
+import collections
+
+import pytest
+
+import pytheus.collector
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """An empty collector.Base.decorators, for metrics registered by a test."""
+    decorators = collections.OrderedDict()
+    monkeypatch.setattr(pytheus.collector.Base, "decorators", decorators)
+    return decorators
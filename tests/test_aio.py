@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import asyncio
+import os
+import socket
+import ssl
+import threading
+import time
+
+import pytest
+
+import pytheus.decorators
+import pytheus.exporter
+import pytheus.http.tls
+import pytheus.instrument
+import pytheus.meter
+import pytheus.scheduler
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_async_collectors(loop):
+    async def probe():
+        await asyncio.sleep(0.01)
+        return 1.0, {"target": "db"}
+
+    async def hung():
+        await asyncio.sleep(60)
+
+    def blocking():
+        return 2.0, {}
+
+    def disks():
+        for disk in ("sda", "sdb"):
+            yield 3.0, {"disk": disk}
+
+    up = pytheus.meter.Gauge("up")
+    slow = pytheus.meter.Gauge("slow")
+    sync = pytheus.meter.Gauge("sync")
+    batch = pytheus.meter.Gauge("batch")
+    jobs = {
+        up: pytheus.scheduler.Job(up, probe, interval=0.05),
+        slow: pytheus.scheduler.Job(slow, hung, interval=0.05, timeout=0.05),
+        sync: pytheus.scheduler.Job(sync, blocking, interval=0.05),
+        batch: pytheus.scheduler.Job(batch, disks, interval=0.05),
+    }
+    scheduler = pytheus.scheduler.AsyncBase(loop, jitter=0)
+    scheduler.start(jobs)
+
+    wait_for(lambda: all(jobs[m].collected for m in (up, sync, batch)))
+    wait_for(lambda: jobs[slow].failures >= 2) # Cancelled, then retried
+    scheduler.stop()
+
+    assert 'up{target="db"} 1.0' in up.to_string()
+    assert 'sync 2.0' in sync.to_string()
+    assert 'batch{disk="sdb"} 3.0' in batch.to_string()
+    assert not jobs[slow].collected
+
+
+def test_async_exporter(registry):
+    @pytheus.decorators.gauge("async_metric", interval=0.05)
+    async def collect():
+        return 42.0, {}
+
+    exporter = pytheus.exporter.AsyncBase("127.0.0.1", 0)
+    thread = threading.Thread(target=exporter.start)
+    thread.daemon = True
+    thread.start()
+
+    def scrape():
+        sock = socket.create_connection(("127.0.0.1", exporter.server.port), timeout=5)
+        sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        data = b""
+        while True:
+            chunk = sock.recv(8192)
+            if not chunk:
+                return data.decode("utf-8")
+            data += chunk
+
+    try:
+        wait_for(lambda: "async_metric 42.0" in scrape())
+    finally:
+        exporter.stop()
+        thread.join()
+
+
+def test_tls_session_resumption(registry):
+    certfile = os.path.join(os.path.dirname(__file__), "certs", "server.pem")
+    exporter = pytheus.exporter.AsyncBase("127.0.0.1", 0,
+                                          tls=pytheus.http.tls.Context(certfile))
+    thread = threading.Thread(target=exporter.start)
+    thread.daemon = True
+    thread.start()
+
+    client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+
+    def scrape(session=None):
+        sock = socket.create_connection(("127.0.0.1", exporter.server.port), timeout=5)
+        sock = client.wrap_socket(sock, session=session)
+        try:
+            sock.sendall(b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+            while sock.recv(8192):
+                pass
+            return sock.session, sock.session_reused
+        except ssl.SSLError: # No close_notify
+            return sock.session, sock.session_reused
+        finally:
+            sock.close()
+
+    try:
+        session, reused = scrape()
+        assert not reused
+        assert scrape(session)[1]
+        assert exporter.server.tls.stats()["hits"] >= 1
+    finally:
+        exporter.stop()
+        thread.join()
+
+
+def test_timed_coroutine(registry, monkeypatch):
+    monkeypatch.setattr(pytheus.instrument, "clock", iter([1.0, 3.0, 4.0, 4.5]).__next__)
+    latency = pytheus.decorators.summary("latency_seconds", [0.5], timed=True)
+
+    @latency
+    async def handler(value):
+        await asyncio.sleep(0)
+        if value is None:
+            raise ValueError
+        return value
+
+    async def main():
+        assert await handler(1) == 1
+        with pytest.raises(ValueError):
+            await handler(None)
+
+    asyncio.run(main())
+    series = latency.child.series
+    assert (series.count, series.sum) == (2, 2.5)
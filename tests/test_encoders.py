@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import struct
+
+import pytest
+
+import pytheus.encoders
+import pytheus.http.request
+import pytheus.meter
+
+
+PROMETHEUS_ACCEPT = (
+    "application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;"
+    "encoding=delimited;q=0.7,text/plain;version=0.0.4;q=0.3,*/*;q=0.2")
+
+
+def ranges(accept):
+    raw = "GET /metrics HTTP/1.1\r\nAccept: %s\r\n\r\n" % (accept)
+    return pytheus.http.request.Base(None, None, raw).media_ranges()
+
+
+@pytest.mark.parametrize("accept,expected", [
+    ("", pytheus.encoders.Text),
+    ("*/*", pytheus.encoders.Text),
+    ("text/plain;version=0.0.4", pytheus.encoders.Text),
+    ("application/openmetrics-text;version=1.0.0;q=0.5,text/plain;q=0.4",
+     pytheus.encoders.OpenMetrics),
+    (PROMETHEUS_ACCEPT, pytheus.encoders.Protobuf),
+    ("application/vnd.google.protobuf;encoding=text", pytheus.encoders.Text),
+])
+def test_negotiate(accept, expected):
+    assert type(pytheus.encoders.negotiate(ranges(accept))) is expected
+
+
+def test_openmetrics():
+    c = pytheus.meter.Counter('requests_total', 'Requests "served"')
+    c.labels(path='/').inc(2, exemplar={'trace_id': 'abc'})
+    h = pytheus.meter.Histogram('latency', [1, 10])
+    h.labels().observe(5, exemplar={'trace_id': 'def'})
+    g = pytheus.meter.Gauge('temperature')
+    g.set(float('inf'), room='a\nb')
+
+    out = pytheus.encoders.OpenMetrics().encode([c, h, g]).decode("utf-8").splitlines()
+    assert out[:3] == [
+        '# HELP requests Requests \\"served\\"',
+        '# TYPE requests counter',
+    ] + [out[2]]
+    assert out[2].startswith('requests_total{path="/"} 2.0 # {trace_id="abc"} 2.0 ')
+    assert out[3].startswith('requests_created{path="/"} ')
+    assert out[6:9] == [
+        'latency_bucket{le="1.0"} 0',
+        out[7],
+        'latency_bucket{le="+Inf"} 1',
+    ]
+    assert out[7].startswith('latency_bucket{le="10.0"} 1 # {trace_id="def"} 5 ')
+    assert out[9:11] == ['latency_sum 5', 'latency_count 1']
+    assert out[-2:] == ['temperature{room="a\\nb"} +Inf', '# EOF']
+
+
+def varint(data, position):
+    value = shift = 0
+    while True:
+        byte = bytearray(data[position:position + 1])[0]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def decode(data):
+    """Minimal protobuf decoder: {field: [values]}, messages left as bytes."""
+    fields = {}
+    position = 0
+    while position < len(data):
+        key, position = varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = varint(data, position)
+        elif wire_type == 1:
+            value = struct.unpack("<d", data[position:position + 8])[0]
+            position += 8
+        else:
+            length, position = varint(data, position)
+            value = data[position:position + length]
+            position += length
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def families(data):
+    position = 0
+    while position < len(data):
+        length, position = varint(data, position)
+        yield decode(data[position:position + length])
+        position += length
+
+
+def test_protobuf():
+    c = pytheus.meter.Counter('requests_total')
+    c.labels(path='/').inc(3, exemplar={'trace_id': 'abc'})
+    h = pytheus.meter.Histogram('latency', [1, 10])
+    h.observe_many([0.5, 5, 50])
+
+    counter, histogram = families(pytheus.encoders.Protobuf().encode([c, h]))
+
+    assert counter[1] == [b'requests_total']
+    assert counter[3] == [0]
+    metric = decode(counter[4][0])
+    assert decode(metric[1][0]) == {1: [b'path'], 2: [b'/']}
+    value = decode(metric[3][0])
+    assert value[1] == [3.0]
+    assert decode(decode(value[2][0])[1][0]) == {1: [b'trace_id'], 2: [b'abc']}
+    assert 3 in value # Created timestamp
+
+    assert histogram[3] == [4]
+    value = decode(decode(histogram[4][0])[7][0])
+    assert value[1] == [3]
+    assert value[2] == [55.5]
+    buckets = [decode(bucket) for bucket in value[3]]
+    assert [(b[2][0], b[1][0]) for b in buckets] == [(1.0, 1), (10.0, 2)]
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def test_native_histogram():
+    h = pytheus.meter.Histogram('latency', schema=0)
+    h.observe_many([0, -3, 0.75, 1, 3, 20, 40])
+    empty = pytheus.meter.Histogram('idle')
+    empty.labels()
+
+    histogram, idle = families(pytheus.encoders.Protobuf().encode([h, empty]))
+
+    value = decode(decode(histogram[4][0])[7][0])
+    assert value[1] == [7]
+    assert 3 not in value # No classic buckets
+    assert zigzag(value[5][0]) == 0
+    assert value[6] == [pytheus.meter.ZERO_THRESHOLD]
+    assert value[7] == [1]
+    # Negative: bucket 2 holds 1; positive: 0 holds 2, 2 holds 1, 5 and 6 hold 1 each
+    spans = [decode(span) for span in value[9]]
+    assert [(zigzag(span[1][0]), span[2][0]) for span in spans] == [(2, 1)]
+    assert [zigzag(delta) for delta in value[10]] == [1]
+    spans = [decode(span) for span in value[12]]
+    assert [(zigzag(span[1][0]), span[2][0]) for span in spans] == [(0, 1), (1, 1), (2, 2)]
+    assert [zigzag(delta) for delta in value[13]] == [2, -1, 0, 0]
+
+    value = decode(decode(idle[4][0])[7][0])
+    assert value[12] == [b""]
+
+
+def test_native_histogram_openmetrics():
+    h = pytheus.meter.Histogram('latency', schema=0)
+    h.observe_many([0.75, 1, 3])
+    out = pytheus.encoders.OpenMetrics().encode([h]).decode("utf-8").splitlines()
+    assert out[2:5] == [
+        'latency_bucket{le="1.0"} 2',
+        'latency_bucket{le="4.0"} 3',
+        'latency_bucket{le="+Inf"} 3',
+    ]
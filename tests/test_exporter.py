@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import collections
+import gzip
+import io
+import zlib
+
+import pytest
+
+import pytheus.collector
+import pytheus.exporter
+import pytheus.http.request
+import pytheus.meter
+import pytheus.multiprocess
+
+
+def request(*headers):
+    raw = "\r\n".join(("GET /metrics HTTP/1.1",) + headers) + "\r\n\r\n"
+    return pytheus.http.request.Base(None, None, raw)
+
+
+@pytest.fixture
+def exporter(registry):
+    g = pytheus.meter.Gauge("metric_name")
+    g.set(1.0)
+    pytheus.collector.Base.register(g, lambda: (1.0, {}))
+    registry[g].collected = True
+
+    exp = pytheus.exporter.Base("127.0.0.1", 0)
+    exp.min_compress_size = 0
+    exp.gauge = g
+    yield exp
+    exp.collector.stop()
+    exp.server.sock.close()
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("gzip, deflate", "gzip"),
+    ("deflate", "deflate"),
+    ("gzip;q=0.5, deflate;q=0.8", "deflate"),
+    ("gzip;q=0, identity", None),
+    ("*", "gzip"),
+    ("br", None),
+])
+def test_preferred_encoding(header, expected):
+    req = request("Accept-Encoding: " + header)
+    assert req.preferred_encoding(("gzip", "deflate")) == expected
+
+
+def test_uncompressed(exporter):
+    response = exporter.handle_request(request())
+    assert response.content_encoding is None
+    assert b"metric_name 1.0" in response.content
+
+
+def test_gzip_cached_until_change(exporter):
+    first = exporter.handle_request(request("Accept-Encoding: gzip"))
+    assert first.content_encoding == "gzip"
+    plain = gzip.GzipFile(fileobj=io.BytesIO(first.content)).read()
+    assert b"metric_name 1.0" in plain
+
+    second = exporter.handle_request(request("Accept-Encoding: gzip"))
+    assert second.content is first.content
+
+    exporter.gauge.set(2.0)
+    third = exporter.handle_request(request("Accept-Encoding: deflate"))
+    assert third.content_encoding == "deflate"
+    assert b"metric_name 2.0" in zlib.decompress(third.content)
+    assert b"Content-Encoding: deflate" in third.to_string()
+
+
+def test_compressed_mixed_scrapers(exporter):
+    scrapes = [("Accept-Encoding: gzip",),
+               ("Accept-Encoding: deflate",),
+               ("Accept-Encoding: gzip", "Accept: application/openmetrics-text"),
+               ("Accept-Encoding: deflate", "Accept: application/openmetrics-text")]
+    for headers in scrapes + scrapes:
+        exporter.handle_request(request(*headers))
+    # Every format and encoding compressed once, not evicted by the others
+    assert exporter.compress_misses == 4
+    assert exporter.compress_hits == 4
+
+    exporter.max_compressed = 2
+    exporter.gauge.set(2.0)
+    for headers in scrapes:
+        exporter.handle_request(request(*headers))
+    assert len(exporter._compressed) == 2
+
+def test_multiprocess_compressed(exporter, tmpdir):
+    pytheus.multiprocess.enable(str(tmpdir))
+    try:
+        pytheus.meter.Counter("requests_total").inc(3)
+        gzipped = exporter.handle_request(request("Accept-Encoding: gzip"))
+        deflated = exporter.handle_request(request("Accept-Encoding: deflate"))
+    finally:
+        pytheus.multiprocess.disable()
+
+    assert gzipped.code == deflated.code == 200
+    plain = gzip.GzipFile(fileobj=io.BytesIO(gzipped.content)).read()
+    assert b"requests_total 3.0" in plain
+    assert zlib.decompress(deflated.content) == plain
+
+
+def test_content_negotiation(exporter):
+    response = exporter.handle_request(request())
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+
+    response = exporter.handle_request(request("Accept: application/openmetrics-text"))
+    assert response.content_type.startswith("application/openmetrics-text")
+    assert response.content.endswith(b"# EOF\n")
+
+
+def test_filtered_scrape(exporter):
+    for name in ("http_requests_total", "http_errors_total", "process_cpu"):
+        c = pytheus.meter.Counter(name)
+        c.inc()
+        pytheus.collector.Base.register(c, lambda: (1.0, {}))
+        pytheus.collector.Base.decorators[c].collected = True
+
+    def families(query):
+        raw = "GET /metrics?%s HTTP/1.1\r\n\r\n" % (query)
+        response = exporter.handle_request(pytheus.http.request.Base(None, None, raw))
+        return [line.split()[2].decode("ascii") for line in response.content.splitlines()
+                if line.startswith(b"# TYPE")]
+
+    assert families("name[]=process_cpu&name[]=metric_name") == ["metric_name", "process_cpu"]
+    assert families("name_prefix[]=http_") == ["http_errors_total", "http_requests_total"]
+    assert families("name_regex[]=.*_total&name[]=nope") == ["http_errors_total",
+                                                             "http_requests_total"]
+    assert families("name_regex[]=http_requests|process_cpu") == ["process_cpu"]
+    assert families("name_regex[]=http_requests_.*|process_cpu") == ["http_requests_total",
+                                                                "process_cpu"]
+    assert len(families("")) == 4
+
+    raw = "GET /metrics?name_regex[]=( HTTP/1.1\r\n\r\n"
+    response, keep = exporter.server.build_response(None, None, raw)
+    assert response.code == 400
+
+
+def test_ttl_counts_scrapes(exporter, monkeypatch):
+    monkeypatch.setattr(pytheus.meter, "_limit_counters", collections.OrderedDict())
+    g = pytheus.meter.Gauge("expiring", ttl=3)
+    g.set(1, user="a")
+    pytheus.collector.Base.register(g, lambda: (1.0, {}))
+    pytheus.collector.Base.decorators[g].collected = True
+
+    exporter.handle_request(request()) # Updated since the last scrape
+    exporter.handle_request(request("Accept: application/openmetrics-text"))
+    exporter.handle_request(request("Accept: application/vnd.google.protobuf; "
+                                    "proto=io.prometheus.client.MetricFamily; "
+                                    "encoding=delimited"))
+    assert "user=a" in g.label_metric
+    exporter.handle_request(request())
+    assert "user=a" not in g.label_metric
+
+
+def test_instrumentation(registry):
+    g = pytheus.meter.Gauge("metric_name")
+    g.set(1.0, a="1")
+    g.set(1.0, a="2")
+    pytheus.collector.Base.register(g, lambda: (1.0, {}))
+    job = pytheus.collector.Base.decorators[g]
+    job.collected = True
+    job.last_duration = 0.5
+    job.failures = 2
+
+    exp = pytheus.exporter.Base("127.0.0.1", 0, instrumentation=True)
+    try:
+        exp.handle_request(request())
+        content = exp.handle_request(request()).content
+    finally:
+        exp.collector.stop()
+        exp.server.sock.close()
+
+    assert b'pytheus_family_series{family="metric_name"} 2' in content
+    assert b'pytheus_collector_last_duration_seconds{collector="<lambda>",metric="metric_name"} 0.5' \
+        in content
+    assert b'pytheus_collector_failures_total{collector="<lambda>",metric="metric_name"} 2' in content
+    assert b'pytheus_scrape_duration_seconds_count{format="text"} 1' in content
+    assert b"pytheus_http_connections 0" in content
+
+
+def test_no_instrumentation(exporter):
+    assert exporter.instrumentation is None
+    assert b"pytheus_" not in exporter.handle_request(request()).content
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+import socket
+import threading
+import time
+
+import pytest
+
+import pytheus.http.request
+import pytheus.http.response
+import pytheus.http.server
+
+
+def request(port, raw=b"GET /metrics HTTP/1.0\r\nHost: localhost\r\n\r\n"):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    sock.sendall(raw)
+    data = b""
+    while True:
+        chunk = sock.recv(8192)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+    return data
+
+
+@pytest.fixture(params=pytheus.http.server.MODES)
+def server(request):
+    httpd = pytheus.http.server.Base("127.0.0.1", 0, mode=request.param, workers=4)
+    httpd.poll_interval = 0.1
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.stop()
+    thread.join()
+    httpd.sock.close()
+
+
+def test_serve(server):
+    response = request(server.port)
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert response.endswith(b"<html><h1>Well done!</h1></html>")
+
+
+def test_bad_request(server):
+    assert request(server.port, b"\r\n\r\n").startswith(b"HTTP/1.1 400")
+
+
+def test_concurrent_scrapers(server):
+    results = []
+
+    def scrape():
+        results.append(request(server.port))
+
+    threads = [threading.Thread(target=scrape) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 50
+    assert all(r.startswith(b"HTTP/1.1 200 OK") for r in results)
+    assert server.stats.accepted == 50
+    for _ in range(50): # Closed right after the client saw it
+        if server.stats.open == 0:
+            break
+        time.sleep(0.01)
+    assert server.stats.open == 0
+
+
+def test_slow_client_does_not_stall():
+    httpd = pytheus.http.server.Base("127.0.0.1", 0, mode="select")
+    httpd.poll_interval = 0.1
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    idle = socket.create_connection(("127.0.0.1", httpd.port))
+    idle.sendall(b"GET /metr") # Never finishes its request
+    try:
+        assert request(httpd.port).startswith(b"HTTP/1.1 200 OK")
+    finally:
+        idle.close()
+        httpd.stop()
+        thread.join()
+        httpd.sock.close()
+
+
+def read_response(sock):
+    """Reads exactly one response, relying on its Content-Length."""
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(8192)
+        assert chunk, "Connection closed"
+        data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    length = int([line.split(b":")[1] for line in head.split(b"\r\n")
+                  if line.startswith(b"Content-Length")][0])
+    while len(body) < length:
+        body += sock.recv(8192)
+    return head, body
+
+
+def test_keep_alive(server):
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    try:
+        for _ in range(3):
+            sock.sendall(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            head, body = read_response(sock)
+            assert body == b"<html><h1>Well done!</h1></html>"
+            if server.mode == "blocking":
+                assert b"Connection: close" in head
+                assert sock.recv(8192) == b""
+                return
+            assert b"Connection: keep-alive" in head
+    finally:
+        sock.close()
+
+
+def test_pipelined_partial_requests(server):
+    if server.mode == "blocking":
+        pytest.skip("Always closes after one response")
+    sock = socket.create_connection(("127.0.0.1", server.port), timeout=5)
+    try:
+        raw = b"GET / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\nConnection: close\r\n\r\n"
+        sock.sendall(raw[:10])
+        time.sleep(0.05)
+        sock.sendall(raw[10:])
+        data = b""
+        while True:
+            chunk = sock.recv(8192)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    assert data.count(b"HTTP/1.1 200 OK") == 2
+    assert data.endswith(b"Connection: close\r\n\r\n<html><h1>Well done!</h1></html>")
+
+
+def test_max_requests_and_idle_timeout():
+    httpd = pytheus.http.server.Base("127.0.0.1", 0, mode="select",
+                                     idle_timeout=0.2, max_requests=2)
+    httpd.poll_interval = 0.05
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        sock = socket.create_connection(("127.0.0.1", httpd.port), timeout=5)
+        sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert b"Connection: keep-alive" in read_response(sock)[0]
+        sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert b"Connection: close" in read_response(sock)[0]
+        assert sock.recv(8192) == b""
+        sock.close()
+
+        sock = socket.create_connection(("127.0.0.1", httpd.port), timeout=5)
+        sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        read_response(sock)
+        # Closed by the server once idle for long enough
+        assert sock.recv(8192) == b""
+        sock.close()
+    finally:
+        httpd.stop()
+        thread.join()
+        httpd.sock.close()
+
+
+def test_idle_connections_make_way():
+    httpd = pytheus.http.server.Base("127.0.0.1", 0, mode="threaded",
+                                     workers=1, idle_timeout=30)
+    httpd.poll_interval = 0.1
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        idle = socket.create_connection(("127.0.0.1", httpd.port), timeout=5)
+        idle.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert b"Connection: keep-alive" in read_response(idle)[0]
+        # Holds the only worker, until someone else needs it
+        start = time.time()
+        assert request(httpd.port).startswith(b"HTTP/1.1 200 OK")
+        assert time.time() - start < 5
+        assert idle.recv(8192) == b""
+        idle.close()
+    finally:
+        httpd.stop()
+        thread.join()
+        httpd.sock.close()
+
+
+def test_parser():
+    parser = pytheus.http.request.Parser()
+    assert parser.feed("GET / HTTP/1.1\r\nHo") == []
+    assert parser.feed("st: a\r\n\r\nPOST / HTTP/1.1\r\nContent-Length: 4\r\n\r\nab") == [
+        "GET / HTTP/1.1\r\nHost: a\r\n\r\n",
+    ]
+    assert parser.feed("cdGET") == ["POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\nabcd"]
+    assert parser.buffer == "GET"
+
+    with pytest.raises(pytheus.http.request.RequestTooLargeError):
+        parser.feed("x" * (parser.max_head_size + 1))
+    body = "POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (parser.max_body_size + 1)
+    with pytest.raises(pytheus.http.request.RequestTooLargeError):
+        pytheus.http.request.Parser().feed(body)
+
+
+def test_request_keep_alive():
+    def keep_alive(raw):
+        return pytheus.http.request.Base(None, None, raw).keep_alive
+
+    assert keep_alive("GET / HTTP/1.1\r\n\r\n")
+    assert not keep_alive("GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert not keep_alive("GET / HTTP/1.0\r\n\r\n")
+    assert keep_alive("GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\n")
+
+
+def test_file_response(tmpdir):
+    snapshot = tmpdir.join("metrics.prom")
+    snapshot.write("metric_name 1.0\n" * 10000)
+
+    def handler(request):
+        response = pytheus.http.response.Base(200)
+        response.file = open(str(snapshot), "rb")
+        return response
+
+    for mode in pytheus.http.server.MODES:
+        httpd = pytheus.http.server.Base("127.0.0.1", 0, response_handler=handler, mode=mode)
+        httpd.poll_interval = 0.1
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            response = request(httpd.port)
+        finally:
+            httpd.stop()
+            thread.join()
+            httpd.sock.close()
+        assert b"Content-Length: 160000\r\n" in response
+        assert response.endswith(b"\r\n\r\n" + b"metric_name 1.0\n" * 10000)
+
+
+def test_consume():
+    consume = pytheus.http.server.consume
+    left = consume([b"head", b"body"], 6)
+    assert [bytes(buf) for buf in left] == [b"dy"]
+    assert consume([b"head", b"body"], 8) == []
+    assert consume([b"head", b"", b"body"], 4) == [b"body"]
+
+
+def test_invalid_mode():
+    with pytest.raises(pytheus.http.server.InvalidModeError):
+        pytheus.http.server.Base("127.0.0.1", 0, mode="forking")
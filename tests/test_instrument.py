@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import pytest
+
+import pytheus.decorators
+import pytheus.instrument
+import pytheus.meter
+
+
+def test_timed(registry, monkeypatch):
+    ticks = iter([1.0, 1.5, 2.0, 2.25])
+    monkeypatch.setattr(pytheus.instrument, "clock", lambda: next(ticks))
+    latency = pytheus.decorators.histogram("latency_seconds", [0.3, 1], timed=True,
+                                           labels={"handler": "index"})
+
+    @latency
+    def index(page):
+        """Serves the index."""
+        return page * 2
+
+    assert index(2) == 4
+    assert index.__doc__ == "Serves the index."
+    with latency.measure():
+        pass
+
+    metric, = registry
+    assert registry[metric].collected
+    out = metric.to_string()
+    assert 'latency_seconds_bucket{handler="index",le="0.3"} 1' in out
+    assert 'latency_seconds_sum{handler="index"} 0.75' in out
+    assert list(ticks) == []
+
+
+def test_count_calls_and_in_progress(registry):
+    calls = pytheus.decorators.counter("calls_total", count_calls=True)
+    running = pytheus.decorators.gauge("running", in_progress=True, labels={"job": "x"})
+    seen = []
+
+    @calls
+    @running
+    def work():
+        seen.append(running.child.series.value)
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        work()
+    with running.measure():
+        seen.append(running.child.series.value)
+
+    assert seen == [1.0, 1.0]
+    assert running.child.series.value == 0.0
+    assert calls.child.series.value == 1.0
+
+
+def test_instrumented_never_scheduled(registry):
+    pytheus.decorators.counter("calls_total", count_calls=True)
+    job, = registry.values()
+    assert job.function is None
+    assert job.name == "calls_total"
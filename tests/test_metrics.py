@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import sys
+import threading
+
 import pytest
 
+import pytheus.encoders
 import pytheus.meter
 
 
@@ -60,12 +64,12 @@ def test_summary():
     expected = [
         "# HELP metric_name this metric's description",
         "# TYPE metric_name summary",
-        'metric_name{hello="world",moarlabel="blah",quantile="0.1"} 0.201',
-        'metric_name{hello="world",moarlabel="blah",quantile="0.5"} 0.9',
+        'metric_name{hello="world",moarlabel="blah",quantile="0.1"} 0.001',
+        'metric_name{hello="world",moarlabel="blah",quantile="0.5"} 0.3',
         'metric_name{hello="world",moarlabel="blah",quantile="1.0"} 2.0',
         'metric_name_sum{hello="world",moarlabel="blah"} 3.101',
         'metric_name_count{hello="world",moarlabel="blah"} 5',
-        'metric_name{differentlabel="samebucket",quantile="0.1"} 0.0',
+        'metric_name{differentlabel="samebucket",quantile="0.1"} 0.3',
         'metric_name{differentlabel="samebucket",quantile="0.5"} 0.3',
         'metric_name{differentlabel="samebucket",quantile="1.0"} 0.6',
         'metric_name_sum{differentlabel="samebucket"} 0.9',
@@ -93,15 +97,15 @@ def test_histogram():
     expected = [
         "# HELP metric_name this metric's description",
         "# TYPE metric_name histogram",
-        'metric_name_bucket{hello="world",moarlabel="blah",le="1"} 0.001',
-        'metric_name_bucket{hello="world",moarlabel="blah",le="10"} 10.001',
-        'metric_name_bucket{hello="world",moarlabel="blah",le="20"} 36.001',
-        'metric_name_bucket{hello="world",moarlabel="blah",le="+Inf"} 4',
-        'metric_name_sum{hello="world",moarlabel="blah"} 36.001',
-        'metric_name_count{hello="world",moarlabel="blah"} 4',
-        'metric_name_bucket{differentlabel="samebucket",le="1"} 0.9',
-        'metric_name_bucket{differentlabel="samebucket",le="10"} 0.9',
-        'metric_name_bucket{differentlabel="samebucket",le="20"} 0.9',
+        'metric_name_bucket{hello="world",moarlabel="blah",le="1"} 1',
+        'metric_name_bucket{hello="world",moarlabel="blah",le="10"} 2',
+        'metric_name_bucket{hello="world",moarlabel="blah",le="20"} 4',
+        'metric_name_bucket{hello="world",moarlabel="blah",le="+Inf"} 5',
+        'metric_name_sum{hello="world",moarlabel="blah"} 66.001',
+        'metric_name_count{hello="world",moarlabel="blah"} 5',
+        'metric_name_bucket{differentlabel="samebucket",le="1"} 2',
+        'metric_name_bucket{differentlabel="samebucket",le="10"} 2',
+        'metric_name_bucket{differentlabel="samebucket",le="20"} 2',
         'metric_name_bucket{differentlabel="samebucket",le="+Inf"} 2',
         'metric_name_sum{differentlabel="samebucket"} 0.9',
         'metric_name_count{differentlabel="samebucket"} 2',
@@ -110,3 +114,347 @@ def test_histogram():
     out = h.to_string().splitlines()
     for line in expected:
         assert line == out.pop(0)
+
+
+def test_exposition_cache():
+    g = pytheus.meter.Gauge('metric_name', "this metric's description")
+    g.set(1.0, hello='world')
+    g.set(2.0, hello='there')
+
+    first = g.to_string()
+    assert g.to_string() is first # Nothing changed, served from cache
+
+    untouched = g.label_metric['hello=there']
+    g.set(3.0, hello='world')
+    assert not untouched.dirty
+    assert g.dirty
+
+    out = g.to_string().splitlines()
+    assert out[2] == 'metric_name{hello="world"} 3.0'
+    assert out[3] == 'metric_name{hello="there"} 2.0'
+    assert not g.dirty
+
+
+def test_render_while_invalidated():
+    # Another thread cleared dirty, it hasn't rendered the fragment yet
+    g = pytheus.meter.Gauge('gauge_name')
+    h = pytheus.meter.Histogram('histogram_name', [1])
+    s = pytheus.meter.Summary('summary_name', [0.5])
+    for metric, update in ((g, g.set), (h, h.observe), (s, s.observe)):
+        update(1)
+        series = metric._lookup({})
+        series.dirty = False
+        assert metric.name in series.to_string()
+
+    # Scrapes rendering while the series are updated
+    c = pytheus.meter.Counter('counter_name')
+    outputs = []
+
+    def scrape():
+        for _ in range(200):
+            outputs.append(c.to_string())
+
+    def update():
+        for i in range(200):
+            c.inc(path=str(i % 20))
+
+    threads = [threading.Thread(target=target) for target in (scrape, scrape, update)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 'counter_name{path="19"} 10.0' in c.to_string()
+    assert all(out.startswith('# HELP counter_name') for out in outputs)
+
+
+def test_summary_bounded_memory():
+    s = pytheus.meter.Summary("metric_name", {0.5: 0.05, 0.9: 0.01, 0.99: 0.001})
+    for i in range(100000):
+        s.observe(i % 1000)
+
+    bucket = s.label_bucket['']
+    assert len(bucket.estimator.samples) < 1000
+    assert abs(bucket.estimator.query(0.5) - 500) <= 50
+    assert abs(bucket.estimator.query(0.9) - 900) <= 10
+    assert abs(bucket.estimator.query(0.99) - 990) <= 1
+    assert 'metric_name_count 100000' in s.to_string()
+
+
+def test_summary_window(mocker):
+    clock = mocker.patch('time.time', return_value=1000.0)
+    s = pytheus.meter.Summary("metric_name", [0.5], max_age=10, age_buckets=2)
+    s.observe(100.0)
+    assert 'metric_name{quantile="0.5"} 100.0' in s.to_string()
+
+    clock.return_value = 1006.0
+    s.observe(1.0)
+    assert 'metric_name{quantile="0.5"} 1.0' in s.to_string()
+
+    clock.return_value = 1100.0 # Way past max_age, nothing left
+    out = s.to_string()
+    assert 'metric_name{quantile="0.5"} nan' in out
+    assert 'metric_name_count 2' in out
+
+
+def test_histogram_observe_many():
+    buckets = [1, 10, 20]
+    one = pytheus.meter.Histogram("metric_name", buckets)
+    many = pytheus.meter.Histogram("metric_name", buckets)
+    values = [0.5, 1, 1.5, 10, 19.9, 20, 21, 300]
+    for value in values:
+        one.observe(value, path='/')
+    many.observe_many(values, path='/')
+
+    assert one.to_string() == many.to_string()
+    assert 'metric_name_bucket{path="/",le="10"} 4' in many.to_string()
+
+    generated = pytheus.meter.Histogram("metric_name", buckets)
+    generated.observe_many((value for value in values), path='/')
+    assert generated.to_string() == one.to_string()
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_histogram_observe_nan(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(pytheus.meter, "numpy", None)
+    elif pytheus.meter.numpy is None:
+        pytest.skip("numpy is not installed")
+    one = pytheus.meter.Histogram("metric_name", [1, 10])
+    many = pytheus.meter.Histogram("metric_name", [1, 10])
+    for value in [0.5, float('nan'), 5]:
+        one.observe(value)
+    many.observe_many([0.5, float('nan'), 5])
+
+    assert one.to_string() == many.to_string()
+    out = many.to_string()
+    assert 'metric_name_bucket{le="1"} 1' in out
+    assert 'metric_name_bucket{le="10"} 2' in out
+    assert 'metric_name_bucket{le="+Inf"} 3' in out
+    assert 'metric_name_count 3' in out
+
+
+def test_child_handles():
+    c = pytheus.meter.Counter('metric_name')
+    child = c.labels(path='/', code='200')
+    assert c.labels(code='200', path='/') is child
+
+    child.inc()
+    child.inc(2)
+    c.inc(path='/', code='200')
+    assert 'metric_name{code="200",path="/"} 4.0' in c.to_string()
+
+    child.inc()
+    assert 'metric_name{code="200",path="/"} 5.0' in c.to_string()
+
+    h = pytheus.meter.Histogram('metric_name', [1, 10])
+    h.labels(path='/').observe(5)
+    assert 'metric_name_bucket{path="/",le="10"} 1' in h.to_string()
+
+    s = pytheus.meter.Summary('metric_name', [0.5])
+    s.labels(path='/').observe(5, exemplar={'trace_id': 'abc'})
+    assert 'metric_name_count{path="/"} 1' in s.to_string()
+
+    with pytest.raises(pytheus.meter.InvalidLabelError):
+        c.labels(**{'0day': 'x'})
+
+
+def test_concurrent_increments():
+    c = pytheus.meter.Counter('metric_name')
+    h = pytheus.meter.Histogram('other_name', [1, 10])
+
+    def work():
+        for i in range(5000):
+            c.inc(kind=str(i % 3))
+            h.observe(i % 20)
+            c.to_string() # Scrapes racing with updates
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(m.value for m in c.label_metric.values()) == 40000
+    assert h.label_bucket[''].count == 40000
+
+
+def limited(kind):
+    counter = pytheus.meter._limit_counters.get(kind)
+    return counter.label_metric if counter else {}
+
+
+def test_max_series_drop():
+    c = pytheus.meter.Counter('dropping_total', max_series=2)
+    for user in ('a', 'b', 'c', 'd'):
+        c.labels(user=user).inc()
+    c.inc(user='e')
+
+    assert len(c.label_metric) == 2
+    assert len(c._children) == 2
+    assert 'user="c"' not in c.to_string()
+    assert limited('dropped')['metric=dropping_total'].value == 3
+
+
+def test_max_series_catchall():
+    h = pytheus.meter.Histogram('catchall', [1], max_series=2, overflow='catchall')
+    h.observe(0.5, user='a')
+    h.observe(0.5, user='b')
+    h.observe(2, user='c')
+
+    # The catch-all is one of the max_series
+    assert sorted(h.label_bucket) == ['user=__overflow__', 'user=a']
+    assert h.label_bucket['user=__overflow__'].count == 2
+
+
+def test_max_series_evict():
+    g = pytheus.meter.Gauge('evicting', max_series=2, overflow='evict')
+    g.set(1, user='a')
+    g.set(1, user='b')
+    g.scraped()
+    g.set(2, user='a') # b is now the least recently updated
+    g.scraped()
+    g.set(1, user='c')
+
+    assert sorted(g.label_metric) == ['user=a', 'user=c']
+    assert 'user="b"' not in g.to_string()
+    assert limited('evicted')['metric=evicting'].value == 1
+
+
+def test_ttl():
+    g = pytheus.meter.Gauge('expiring', ttl=2)
+    g.set(1, user='a')
+    g.set(1, user='b')
+    g.scraped()
+    g.set(2, user='a')
+    g.scraped()
+    for _ in range(3): # Rendering isn't scraping
+        g.to_string()
+    assert sorted(g.label_metric) == ['user=a', 'user=b']
+    g.scraped()
+    assert sorted(g.label_metric) == ['user=a']
+    assert 'user="b"' not in g.to_string()
+    assert limited('expired')['metric=expiring'].value == 1
+
+
+def test_invalid_overflow():
+    with pytest.raises(pytheus.meter.InvalidOverflowError):
+        pytheus.meter.Gauge('invalid', overflow='ignore')
+
+
+def test_columnar():
+    objects = pytheus.meter.Counter('requests_total', 'Requests')
+    columns = pytheus.meter.Counter('requests_total', 'Requests', columnar=True)
+    for counter in (objects, columns):
+        counter.inc(path='/', code='200')
+        counter.labels(code='500', path='/').inc(2.5)
+        counter.inc()
+
+    assert columns.to_string() == objects.to_string()
+    assert len(columns.label_metric) == 3
+    series = columns.label_metric.get('code=500,path=/')
+    assert series.labels == {'code': '500', 'path': '/'}
+    assert series.value == 2.5
+
+    with pytest.raises(pytheus.meter.InvalidLabelError):
+        columns.inc(**{'not-valid': 'x'})
+
+
+def test_columnar_slot_reuse():
+    g = pytheus.meter.Gauge('reused', max_series=1, overflow='evict', columnar=True)
+    old = g.labels(user='a')
+    old.set(1)
+    g.set(2, user='b') # Evicts a, b takes over its slot
+    old.set(3)
+
+    assert g.label_metric.slots == {'user=b': 0}
+    assert g.to_string().splitlines()[2:] == ['reused{user="b"} 2.0']
+
+    # Evicted, then admitted again under the same key: a new series
+    stale = g.labels()
+    stale.set(4)
+    g.set(5, user='c')
+    g.set(6)
+    stale.set(7)
+    assert g.to_string().splitlines()[2:] == ['reused 6.0']
+
+
+def test_measure_many():
+    g = pytheus.meter.Gauge('disk_free_bytes')
+    c = pytheus.meter.Counter('queue_messages_total')
+    h = pytheus.meter.Histogram('latency', [1, 10])
+    samples = [(1.0, {'disk': 'sda'}), (2.0, {'disk': 'sdb'}), (3.0, {'disk': 'sda'})]
+
+    g.measure_many(samples)
+    c.measure_many(samples)
+    h.measure_many(samples)
+    h.measure_many([(20, None)])
+
+    assert g.label_metric['disk=sda'].value == 3.0
+    assert c.label_metric['disk=sda'].value == 4.0
+    assert h.label_bucket['disk=sda'].count == 2
+    assert h.label_bucket[''].counts.tolist() == [0, 0, 1]
+
+
+@pytest.mark.parametrize("schema", [-4, -1, 0, 3, 8])
+def test_exponential_buckets(schema):
+    for value in [1e-9, 0.001, 0.3, 1, 2, 3.5, 1e6]:
+        index = pytheus.meter.exponential_index(value, schema)
+        assert pytheus.meter.exponential_bound(index - 1, schema) < value
+        assert value <= pytheus.meter.exponential_bound(index, schema)
+
+
+def test_exponential_histogram():
+    h = pytheus.meter.Histogram('latency', schema=0)
+    h.observe_many([0, -3, 0.75, 1, 3, float('nan')], path='/')
+    series = h._lookup({'path': '/'})
+
+    assert series.positive == {0: 2, 2: 1}
+    assert series.negative == {2: 1}
+    assert series.zero_count == 1
+    assert series.count == 6
+    assert h.to_string().splitlines()[2:] == [
+        'latency_bucket{path="/",le="-2.0"} 1',
+        'latency_bucket{path="/",le="%s"} 2' % (pytheus.meter.ZERO_THRESHOLD),
+        'latency_bucket{path="/",le="1.0"} 4',
+        'latency_bucket{path="/",le="4.0"} 5',
+        'latency_bucket{path="/",le="+Inf"} 6',
+        'latency_sum{path="/"} nan',
+        'latency_count{path="/"} 6',
+    ]
+
+
+def test_exponential_histogram_reduces_resolution():
+    h = pytheus.meter.Histogram('latency', max_buckets=10)
+    h.observe_many([1.1 ** i for i in range(100)])
+    series = h._lookup({})
+
+    assert len(series.positive) <= 10
+    assert series.schema < 3
+    assert sum(series.positive.values()) == 100
+    assert h.to_string().splitlines()[-3] == 'latency_bucket{le="+Inf"} 100'
+
+    with pytest.raises(pytheus.meter.InvalidSchemaError):
+        pytheus.meter.Histogram('latency', schema=9)
+
+
+def test_exponential_histogram_largest_values():
+    h = pytheus.meter.Histogram('latency', schema=0)
+    h.observe_many([1, sys.float_info.max, -sys.float_info.max])
+    assert pytheus.meter.exponential_bound(1024, 0) == float('inf')
+    lines = h.to_string().splitlines()[2:-2]
+    assert lines[0].endswith('e+307"} 1') # -2^1023
+    assert lines[1:] == ['latency_bucket{le="1.0"} 2', 'latency_bucket{le="+Inf"} 3']
+    assert pytheus.encoders.Protobuf().encode([h])
+
+
+def test_exponential_histogram_infinities():
+    h = pytheus.meter.Histogram('latency', schema=0)
+    h.observe_many([float('-inf'), 1, float('inf')])
+    series = h._lookup({})
+
+    assert sum(series.negative.values()) == 1
+    assert sum(series.positive.values()) == 1
+    lines = h.to_string().splitlines()[2:-2]
+    assert lines[0].endswith('e+307"} 1') # -Inf is below every bound
+    assert lines[1:] == ['latency_bucket{le="1.0"} 2', 'latency_bucket{le="+Inf"} 3']
+    assert pytheus.encoders.Protobuf().encode([h])
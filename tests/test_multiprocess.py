@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import contextlib
+import os
+
+import pytest
+
+import pytheus.collector
+import pytheus.meter
+import pytheus.multiprocess
+
+
+@pytest.fixture
+def directory(tmpdir):
+    pytheus.multiprocess.enable(str(tmpdir))
+    yield str(tmpdir)
+    pytheus.multiprocess.disable()
+
+
+def fork(function, workers=3):
+    """Runs function in several child processes, returns their pids."""
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0: # pragma: nocover
+            try:
+                function()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return pids
+
+
+@contextlib.contextmanager
+def running(function, workers=3):
+    """Same as fork, the processes stay alive until the block exits."""
+    done, release = os.pipe()
+    started, ready = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0: # pragma: nocover
+            try:
+                function()
+                os.write(ready, b"x")
+                os.close(release)
+                os.read(done, 1) # Until the parent closes it
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    try:
+        for _ in pids:
+            os.read(started, 1)
+        yield pids
+    finally:
+        for fd in (done, release, started, ready):
+            os.close(fd)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+
+def test_counter_merged(directory):
+    c = pytheus.meter.Counter('requests_total', 'requests')
+    c.inc(5, path='/') # In the parent, must not be counted again by children
+
+    fork(lambda: c.labels(path='/').inc(2))
+
+    out = pytheus.multiprocess.Collector().to_string().splitlines()
+    assert out == [
+        '# HELP requests_total requests',
+        '# TYPE requests_total counter',
+        'requests_total{path="/"} 11.0',
+    ]
+
+
+def test_histogram_merged(directory):
+    h = pytheus.meter.Histogram('latency', [1, 10])
+
+    def work():
+        h.observe(0.5)
+        h.observe_many([5, 50])
+
+    fork(work)
+
+    out = pytheus.multiprocess.Collector().to_string().splitlines()
+    assert out[2:] == [
+        'latency_bucket{le="1"} 3',
+        'latency_bucket{le="10"} 6',
+        'latency_bucket{le="+Inf"} 9',
+        'latency_count 9',
+        'latency_sum 166.5',
+    ]
+
+
+@pytest.mark.parametrize("mode,expected", [
+    ("sum", ['memory 6.0']),
+    ("livesum", []), # Dead by then
+    ("max", ['memory 3.0']),
+    ("min", ['memory 1.0']),
+])
+def test_gauge_modes(directory, mode, expected):
+    g = pytheus.meter.Gauge('memory', multiprocess_mode=mode)
+    for value in [1.0, 2.0, 3.0]:
+        fork(lambda: g.set(value), workers=1)
+
+    assert pytheus.multiprocess.Collector().to_string().splitlines()[2:] == expected
+
+
+def test_live_gauges(directory):
+    total = pytheus.meter.Gauge('memory', multiprocess_mode='livesum')
+    each = pytheus.meter.Gauge('threads', multiprocess_mode='liveall')
+
+    def work():
+        total.set(10)
+        each.set(2)
+
+    with running(work) as pids:
+        out = pytheus.multiprocess.Collector().to_string()
+        assert 'memory 30.0' in out
+        for pid in pids:
+            assert 'threads{pid="%i"} 2.0' % (pid) in out
+    assert pytheus.multiprocess.Collector().to_string() == ''
+
+
+def test_file_growth(directory, monkeypatch):
+    monkeypatch.setattr(pytheus.multiprocess.MmapedDict, "initial_size", 64)
+    c = pytheus.meter.Counter('requests_total')
+    for i in range(100):
+        c.inc(path='/%i' % (i))
+    store = pytheus.multiprocess._files["counter"]
+    assert store.capacity >= store.used > 64
+
+    collector = pytheus.multiprocess.Collector()
+    collector.max_keys = 10
+    assert collector.to_string().count('requests_total{') == 100
+    assert len(collector._keys) <= 10
+
+
+def test_gauge_all(directory):
+    g = pytheus.meter.Gauge('memory')
+    pids = fork(lambda: g.set(1.0), workers=2)
+
+    out = pytheus.multiprocess.Collector().to_string()
+    for pid in pids:
+        assert 'memory{pid="%i"} 1.0' % (pid) in out
+
+
+def test_compact_dead_processes(directory):
+    c = pytheus.meter.Counter('requests_total')
+    g = pytheus.meter.Gauge('memory', multiprocess_mode='livesum')
+
+    def work():
+        c.inc()
+        g.set(10)
+
+    with running(work) as pids:
+        before = pytheus.multiprocess.Collector().to_string()
+    assert 'memory 30.0' in before
+
+    pytheus.multiprocess.mark_process_dead(pids[0])
+    pytheus.multiprocess.cleanup()
+
+    assert sorted(os.listdir(directory)) == ['.compact.lock', 'counter_aggregate.db']
+    after = pytheus.multiprocess.Collector().to_string()
+    assert 'requests_total 3.0' in after
+    assert 'memory' not in after
+
+
+def test_compact_all_mode(directory):
+    g = pytheus.meter.Gauge('memory')
+    pids = fork(lambda: g.set(1.0), workers=2)
+    pytheus.multiprocess.cleanup()
+
+    assert sorted(os.listdir(directory)) == ['.compact.lock', 'gauge_all_aggregate.db']
+    out = pytheus.multiprocess.Collector().to_string()
+    for pid in pids:
+        assert 'memory{pid="%i"} 1.0' % (pid) in out
+
+
+def test_read_while_growing(directory):
+    c = pytheus.meter.Counter('requests_total')
+    for i in range(10):
+        c.inc(path='/%i' % (i))
+    store = pytheus.multiprocess._files["counter"]
+    # Mapped before its writer grew it: the header counts more than we see
+    with open(store.path, "rb") as fd:
+        data = fd.read(store.used - 20)
+    with open(os.path.join(directory, "counter_1.db"), "wb") as fd:
+        fd.write(data)
+
+    reader = pytheus.multiprocess.MmapedDict(os.path.join(directory, "counter_1.db"),
+                                             readonly=True)
+    assert len(list(reader.entries())) == 9
+    reader.close()
+
+
+def test_selected_families(directory):
+    pytheus.meter.Counter('requests_total').inc()
+    pytheus.meter.Gauge('memory', multiprocess_mode='sum').set(1)
+
+    selector = pytheus.collector.Selector(names=['memory'])
+    out = pytheus.multiprocess.Collector().to_string(selector)
+    assert 'memory 1.0' in out
+    assert 'requests_total' not in out
+
+
+def test_invalid_gauge_mode():
+    with pytest.raises(pytheus.multiprocess.InvalidModeError):
+        pytheus.meter.Gauge('memory', multiprocess_mode='average')
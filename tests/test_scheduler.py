@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+import pytest
+
+import pytheus.collector
+import pytheus.decorators
+import pytheus.meter
+import pytheus.scheduler
+
+
+@pytest.fixture
+def scheduler():
+    sched = pytheus.scheduler.Base(workers=2, jitter=0)
+    yield sched
+    sched.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_runs_at_interval(scheduler):
+    calls = []
+
+    def collect():
+        calls.append(time.time())
+        return len(calls), {}
+
+    g = pytheus.meter.Gauge('metric_name')
+    job = pytheus.scheduler.Job(g, collect, interval=0.1)
+    scheduler.start({g: job})
+
+    wait_for(lambda: len(calls) >= 3)
+    assert job.collected
+    assert job.last_success is not None
+    assert calls[2] - calls[1] >= 0.09
+    assert 'metric_name' in g.to_string()
+
+
+def test_hung_collector_is_abandoned(scheduler):
+    release = threading.Event()
+    fast_calls = []
+
+    def hung():
+        release.wait()
+        return 1, {}
+
+    def fast():
+        fast_calls.append(1)
+        return 1, {}
+
+    slow_metric = pytheus.meter.Gauge('slow')
+    fast_metric = pytheus.meter.Counter('fast')
+    slow = pytheus.scheduler.Job(slow_metric, hung, interval=0.05, timeout=0.1)
+    quick = pytheus.scheduler.Job(fast_metric, fast, interval=0.05)
+    scheduler.start({slow_metric: slow, fast_metric: quick})
+
+    wait_for(lambda: slow.timed_out)
+    assert slow.failures == 1
+    # Both workers aren't stuck: the hung one got replaced
+    calls = len(fast_calls)
+    wait_for(lambda: len(fast_calls) > calls + 3)
+
+    assert not slow.collected
+    release.set()
+    # Rescheduled once the hung call finally returned
+    wait_for(lambda: slow.collected)
+    assert slow.failures == 1
+
+
+def test_repeated_timeouts(scheduler):
+    scheduler.max_spares = 1
+    release = threading.Event()
+
+    def hung():
+        release.wait()
+        return 1, {}
+
+    jobs = dict((metric, pytheus.scheduler.Job(metric, hung, interval=0.05, timeout=0.1))
+                for metric in [pytheus.meter.Gauge('hung_%i' % (i)) for i in range(3)])
+    scheduler.start(jobs)
+
+    # Two on the workers, the third on the only spare
+    wait_for(lambda: scheduler.abandoned == 3)
+    assert scheduler._spares == 1
+    assert all(job.timed_out for job in jobs.values())
+
+    release.set()
+    wait_for(lambda: all(job.collected for job in jobs.values()))
+    assert scheduler._spares <= 1
+
+
+def forty_two():
+    return 42.0, {}
+
+
+def test_process_job_registered_after_start(scheduler):
+    jobs = {}
+    scheduler.start(jobs)
+    assert scheduler.pool is None
+
+    g = pytheus.meter.Gauge('answer')
+    job = pytheus.scheduler.Job(g, forty_two, interval=0.05, process=True)
+    jobs[g] = job
+    wait_for(lambda: job.collected, timeout=10)
+    assert 'answer 42.0' in g.to_string()
+
+
+def test_failures_counted(scheduler):
+    def broken():
+        raise ValueError("nope")
+
+    g = pytheus.meter.Gauge('metric_name')
+    job = pytheus.scheduler.Job(g, broken, interval=0.05)
+    scheduler.start({g: job})
+
+    wait_for(lambda: job.failures >= 2)
+    assert not job.collected
+
+
+def test_generator_collector(scheduler):
+    g = pytheus.meter.Gauge('queue_depth')
+    seen = []
+
+    def queues():
+        for i in range(1000):
+            if i == 500:
+                # Consumed as it goes, the first half is already in
+                seen.append(len(g.label_metric))
+            yield float(i), {'queue': str(i)}
+
+    job = pytheus.scheduler.Job(g, queues, interval=10)
+    scheduler.start({g: job})
+
+    wait_for(lambda: job.collected)
+    assert seen == [500]
+    assert len(g.label_metric) == 1000
+    assert 'queue_depth{queue="999"} 999.0' in g.to_string()
+
+
+def test_multi_family_collector(scheduler, registry):
+    threads = pytheus.meter.Gauge('mysql_threads')
+    queries = pytheus.meter.Counter('mysql_queries_total')
+    latency = pytheus.meter.Histogram('mysql_query_seconds', [0.1, 1])
+    fetches = []
+
+    @pytheus.decorators.collector(threads, queries, latency, interval=10)
+    def status():
+        fetches.append(1)
+        return {
+            'mysql_threads': (4.0, {}),
+            'mysql_queries_total': [(10.0, {'kind': 'select'}), (2.0, {'kind': 'insert'})],
+            'mysql_query_seconds': [(0.5, {}), (2, {})],
+        }
+
+    job, = set(registry.values())
+    scheduler.start(registry)
+    wait_for(lambda: job.collected)
+
+    assert fetches == [1]
+    assert list(registry) == [threads, queries, latency]
+    assert 'mysql_threads 4.0' in threads.to_string()
+    assert 'mysql_queries_total{kind="insert"} 2.0' in queries.to_string()
+    assert latency.label_bucket[''].count == 2
+
+    job.metric.measure_many([('mysql_threads', 5.0, {}), ('mysql_queries_total', 1, None)])
+    assert 'mysql_threads 5.0' in threads.to_string()
+    with pytest.raises(pytheus.collector.UnknownFamilyError):
+        job.metric.measure_many({'nope': (1.0, {})})
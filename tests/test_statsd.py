@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import socket
+import time
+
+import pytest
+
+import pytheus.meter
+import pytheus.statsd
+
+
+@pytest.fixture
+def ingest(registry):
+    server = pytheus.statsd.Base("127.0.0.1", 0)
+    yield server
+    server.close()
+
+
+def value(metric, **labels):
+    return metric._lookup(labels).value
+
+
+def test_counters_and_gauges(ingest, registry):
+    ingest.feed([b"hits:1|c\nhits:2|c|@0.5\nhits:1:1|c",
+                 b"temperature:20|g\ntemperature:+2|g\nqueue:-3|g"])
+    hits = ingest.metrics["hits"]
+    assert value(hits) == 7
+    assert value(ingest.metrics["temperature"]) == 22
+    assert value(ingest.metrics["queue"]) == -3
+    assert hits in registry
+    assert ingest.stats.packets == 2
+    assert ingest.stats.lines == 6
+
+
+def test_timers(ingest):
+    ingest.feed([b"api.latency:100|ms|#route:/,code:200\napi.latency:2000|ms|#route:/,code:200"])
+    histogram = ingest.metrics["api_latency"]
+    bucket = histogram._lookup({"route": "/", "code": "200"})
+    assert bucket.count == 2
+    assert bucket.sum == 2.1
+    assert 'api_latency_bucket{code="200",route="/",le="0.1"} 1' in histogram.to_string()
+
+
+def test_summary_timers(registry):
+    ingest = pytheus.statsd.Base("127.0.0.1", 0, timer="summary")
+    ingest.feed([b"size:5|h|@0.25"])
+    bucket = ingest.metrics["size"]._lookup({})
+    assert isinstance(ingest.metrics["size"], pytheus.meter.Summary)
+    assert bucket.count == 4
+    ingest.close()
+
+
+def test_mappings(registry):
+    requests = pytheus.meter.Counter("requests_total")
+    latency = pytheus.meter.Summary("request_seconds", [0.5])
+    ingest = pytheus.statsd.Base("127.0.0.1", 0, auto=False, mappings=[
+        pytheus.statsd.Mapping("api.*.*.requests", requests,
+                               labels={"service": "$1", "code": "$2", "tier": "web"}),
+        pytheus.statsd.Mapping("api.*.latency", latency, labels={"service": "$1"}, scale=1),
+    ])
+    ingest.feed([b"api.users.200.requests:1|c|#dc:eu\napi.users.latency:3|ms\nother:1|c"])
+    assert value(requests, service="users", code="200", tier="web", dc="eu") == 1
+    assert latency._lookup({"service": "users"}).sum == 3
+    assert ingest.stats.unmapped == 1
+
+    ingest.feed([b"api.users.200.requests:5|g\napi.users.200.requests:250|ms"])
+    assert value(requests, service="users", code="200", tier="web", dc="eu") == 1
+    assert ingest.stats.invalid == 2
+    assert requests in registry and latency in registry
+    ingest.close()
+
+
+def test_cached_lines(ingest):
+    ingest.feed([b"hits:1|c|#a:b"])
+    targets = dict(ingest._targets)
+    ingest.feed([b"hits:1|c|#a:b"] * 10)
+    assert ingest._targets == targets
+    assert value(ingest.metrics["hits"], a="b") == 11
+
+    ingest.max_cache = 1
+    ingest.feed([b"hits:1|c|#a:c\nhits:1|c|#a:b"])
+    assert value(ingest.metrics["hits"], a="b") == 12
+
+    # Tags taking unbounded values, all under the same name
+    ingest.max_cache = 50
+    for batch in range(50):
+        ingest.feed([b"hits:1|c|#user:%d" % (batch * 10 + i) for i in range(10)])
+    assert sum(len(lines) for lines in ingest._cache.values()) <= 50
+    assert len(ingest._targets) <= 50 + 10 # Those of the last batch are kept
+    assert value(ingest.metrics["hits"], user="499") == 1
+
+
+def test_invalid_lines(ingest):
+    ingest.feed([b"nope\nhits:x|c\nhits:1|s\nhits:1|c|@2\n:1|c\nhits:1|c"])
+    assert ingest.stats.invalid == 5
+    ingest.feed([b"hits:1|g"]) # Already a counter
+    assert ingest.stats.invalid == 6
+    assert value(ingest.metrics["hits"]) == 1
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_udp_and_unix(registry, tmpdir):
+    path = str(tmpdir.join("statsd.sock"))
+    ingest = pytheus.statsd.Base("127.0.0.1", 0, path=path)
+    ingest.poll_interval = 0.1
+    thread = ingest.start()
+    try:
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for _ in range(10):
+            udp.sendto(b"hits:1|c", ("127.0.0.1", ingest.port))
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        unix.sendto(b"hits:5|c", path)
+        wait_for(lambda: "hits" in ingest.metrics and value(ingest.metrics["hits"]) == 15)
+        udp.close()
+        unix.close()
+    finally:
+        ingest.stop()
+        thread.join()
+        ingest.close()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import os
+
+import pytest
+
+import pytheus.meter
+import pytheus.tail
+
+
+@pytest.fixture
+def log(tmpdir):
+    return str(tmpdir.join("access.log"))
+
+
+def append(path, text):
+    with open(path, "ab") as fd:
+        fd.write(text.encode("utf-8"))
+
+
+def codes(metric):
+    return dict((series.labels["code"], series.value) for series in metric._series())
+
+
+@pytest.fixture
+def tail():
+    """Makes tailers (from the beginning by default), closed afterwards."""
+    tailers = []
+
+    def make(log, rules, **options):
+        options.setdefault("from_beginning", True)
+        tailers.append(pytheus.tail.Base(log, rules, **options))
+        return tailers[-1]
+
+    yield make
+    for tailer in tailers:
+        tailer.close()
+
+
+def test_counts_matches_by_label(log, tail):
+    requests = pytheus.meter.Counter("requests_total")
+    append(log, "GET / 200\nGET /a 404\nGET /b 200\n")
+    tailer = tail(log, [pytheus.tail.Rule(r" (?P<code>\d{3})$", requests, labels=["code"])])
+
+    assert tailer.collect() == ()
+    assert codes(requests) == {"200": 2, "404": 1}
+
+
+def test_reads_only_what_was_appended(log, tail):
+    requests = pytheus.meter.Counter("requests_total")
+    append(log, "GET / 200\n")
+    tailer = tail(log, [pytheus.tail.Rule(r" (?P<code>\d{3})$", requests, labels=["code"])])
+    tailer.collect()
+    tailer.collect()
+    assert codes(requests) == {"200": 1}
+
+    append(log, "GET / 200\nGET / 5") # The last line isn't complete yet
+    tailer.collect()
+    assert codes(requests) == {"200": 2}
+    append(log, "00\n")
+    tailer.collect()
+    assert codes(requests) == {"200": 2, "500": 1}
+
+
+def test_starts_at_the_end(log, tail):
+    requests = pytheus.meter.Counter("requests_total")
+    append(log, "GET / 200\n")
+    tailer = tail(log, [pytheus.tail.Rule(r"200", requests)], from_beginning=False)
+    tailer.collect()
+    assert list(requests._series()) == []
+    append(log, "GET / 200\n")
+    tailer.collect()
+    assert requests._lookup({}).value == 1
+
+
+def test_rotation(log, tail):
+    requests = pytheus.meter.Counter("requests_total")
+    tailer = tail(log, [pytheus.tail.Rule(r"200", requests)])
+    append(log, "GET / 200\n")
+    tailer.collect()
+
+    append(log, "GET / 200\n") # Written before the rename, not read yet
+    os.rename(log, log + ".1")
+    tailer.collect() # Not recreated yet
+    assert requests._lookup({}).value == 2
+
+    append(log, "GET / 200\nGET / 200\n")
+    tailer.collect()
+    assert requests._lookup({}).value == 4
+
+
+def test_rotation_within_the_glob(log, tmpdir, tail):
+    offsets = str(tmpdir.join("offsets.json"))
+    requests = pytheus.meter.Counter("requests_total")
+    rules = [pytheus.tail.Rule(r"200", requests)]
+    tailer = tail(log + "*", rules, offsets=offsets)
+    append(log, "GET / 200\n" * 5)
+    tailer.collect()
+
+    os.rename(log, log + ".1")
+    append(log + ".1", "GET / 200\n") # Still written to after the rename
+    append(log, "GET / 200\n")
+    tailer.collect()
+    assert requests._lookup({}).value == 7
+    assert sorted(tailer.files) == [log, log + ".1"]
+
+    # Rotated again while we were down
+    os.rename(log + ".1", log + ".2")
+    os.rename(log, log + ".1")
+    append(log, "GET / 200\n")
+    tail(log + "*", rules, offsets=offsets).collect()
+    assert requests._lookup({}).value == 8
+
+
+def test_truncation(log, tail):
+    requests = pytheus.meter.Counter("requests_total")
+    tailer = tail(log, [pytheus.tail.Rule(r"200", requests)])
+    append(log, "GET / 200\nGET / 200\n")
+    tailer.collect()
+
+    with open(log, "wb") as fd:
+        fd.write(b"200\n")
+    tailer.collect()
+    assert requests._lookup({}).value == 3
+
+
+def test_offsets_survive_a_restart(log, tmpdir, tail):
+    offsets = str(tmpdir.join("offsets.json"))
+    requests = pytheus.meter.Counter("requests_total")
+    rules = [pytheus.tail.Rule(r"200", requests)]
+    append(log, "GET / 200\n")
+    tail(log, rules, offsets=offsets).collect()
+
+    append(log, "GET / 200\n")
+    tailer = tail(log, rules, offsets=offsets, from_beginning=False)
+    tailer.collect()
+    assert requests._lookup({}).value == 2
+
+
+def test_restart_across_a_rotation(log, tmpdir, tail):
+    offsets = str(tmpdir.join("offsets.json"))
+    append(log, "GET / 200\nGET / 200\n")
+    before = tail(log, [pytheus.tail.Rule(r"200", pytheus.meter.Counter("c"))],
+                  offsets=offsets)
+    before.collect()
+    before.close()
+
+    # Rotated while we were down, the new file is read from its start
+    os.rename(log, log + ".1")
+    append(log, "GET / 200\n" * 3)
+    requests = pytheus.meter.Counter("requests_total")
+    tailer = tail(log, [pytheus.tail.Rule(r"200", requests)],
+                  offsets=offsets, from_beginning=False)
+    tailer.collect()
+    assert requests._lookup({}).value == 3
+    append(log, "GET / 200\n")
+    tailer.collect()
+    assert requests._lookup({}).value == 4
+
+
+def test_values(log, tail):
+    latency = pytheus.meter.Histogram("latency_seconds", [0.1, 1])
+    size = pytheus.meter.Counter("bytes_total")
+    last = pytheus.meter.Gauge("last_bytes")
+    append(log, "GET / 0.05 100\nGET / 0.5 200\nGET / 5 300\n")
+    tail(log, [
+        pytheus.tail.Rule(r" (?P<value>[\d.]+) \d+$", latency),
+        pytheus.tail.Rule(r" (?P<value>\d+)$", size),
+        pytheus.tail.Rule(r" (?P<value>\d+)$", last),
+    ]).collect()
+
+    assert size._lookup({}).value == 600
+    assert last._lookup({}).value == 300
+    bucket = latency._lookup({})
+    assert bucket.count == 3
+    assert bucket.sum == 5.55
+    assert 'latency_seconds_bucket{le="0.1"} 1' in latency.to_string()
+
+
+def test_summary(log, tail):
+    latency = pytheus.meter.Summary("latency_seconds", [0.5])
+    append(log, "".join("rt=%d\n" % (i) for i in range(1, 101)))
+    tail(log, [pytheus.tail.Rule(r"rt=(?P<value>\d+)", latency)]).collect()
+    bucket = latency._lookup({})
+    assert bucket.count == 100
+    assert bucket.sum == 5050
+
+
+def test_mapped(log, tail):
+    requests = pytheus.meter.Counter("requests_total")
+    tailer = tail(log, [pytheus.tail.Rule(r" (?P<code>\d{3})$", requests, labels=["code"])])
+    tailer.mmap_threshold = 64
+    tailer.chunk_size = 16
+    append(log, "GET / 200\n" * 20 + "GET / 404\nGET / 5")
+    tailer.collect()
+    assert codes(requests) == {"200": 20, "404": 1}
+    assert tailer.files[log].offset == 210
+
+
+def test_invalid_rules():
+    with pytest.raises(pytheus.tail.InvalidRuleError):
+        pytheus.tail.Rule(r"(?P<value>\d+)", pytheus.meter.Counter("c"), labels=["code"])
+    with pytest.raises(pytheus.tail.InvalidRuleError):
+        pytheus.tail.Rule(r"\d+", pytheus.meter.Summary("s", [0.5]))
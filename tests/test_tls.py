@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import socket
+import ssl
+import threading
+import time
+
+import pytest
+
+import pytheus.http.server
+import pytheus.http.tls
+
+
+CERTS = os.path.join(os.path.dirname(__file__), "certs")
+
+
+def cert(name):
+    return os.path.join(CERTS, name)
+
+
+def client_context(certfile=None):
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.verify_mode = ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile)
+    return context
+
+
+def scrape(port, context):
+    """Returns (the server certificate, the response)."""
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    sock = context.wrap_socket(sock)
+    try:
+        sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        # Closed without a close_notify, only read what's announced
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = sock.recv(8192)
+            if not chunk:
+                break
+            data += chunk
+        length = int(data.split(b"Content-Length: ")[1].split(b"\r\n")[0]) if data else 0
+        while len(data.partition(b"\r\n\r\n")[2]) < length:
+            data += sock.recv(8192)
+        return sock.getpeercert(True), data
+    finally:
+        sock.close()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(tls, mode="select"):
+        httpd = pytheus.http.server.Base("127.0.0.1", 0, mode=mode, tls=tls)
+        httpd.poll_interval = 0.1
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append((httpd, thread))
+        return httpd
+
+    yield start
+    for httpd, thread in servers:
+        httpd.stop()
+        thread.join()
+        httpd.sock.close()
+
+
+@pytest.mark.parametrize("mode", pytheus.http.server.MODES)
+def test_https(serve, mode):
+    httpd = serve(pytheus.http.tls.Context(cert("server.pem")), mode)
+    for _ in range(3):
+        _, response = scrape(httpd.port, client_context())
+        assert response.startswith(b"HTTP/1.1 200 OK")
+    assert httpd.tls.stats()["accept_good"] == 3
+
+
+def test_certfile_builds_context(serve):
+    httpd = pytheus.http.server.Base("127.0.0.1", 0, certfile=cert("server.pem"))
+    try:
+        assert isinstance(httpd.tls, pytheus.http.tls.Context)
+    finally:
+        httpd.sock.close()
+
+
+def test_client_certificate_required(serve):
+    tls = pytheus.http.tls.Context(cert("server.pem"), cafile=cert("client.pem"),
+                                   verify_client=True)
+    httpd = serve(tls)
+
+    _, response = scrape(httpd.port, client_context(cert("client.pem")))
+    assert response.startswith(b"HTTP/1.1 200 OK")
+
+    # With TLS 1.3 the rejection may only show up once we read
+    with pytest.raises((ssl.SSLError, socket.error)):
+        _, response = scrape(httpd.port, client_context())
+        assert not response
+        raise socket.error("Closed without a response")
+
+
+def test_certificate_reload(serve, tmpdir):
+    path = str(tmpdir.join("server.pem"))
+    shutil.copy(cert("server.pem"), path)
+    tls = pytheus.http.tls.Context(path, reload_interval=0.1)
+    httpd = serve(tls)
+    before, _ = scrape(httpd.port, client_context())
+
+    # Half written: ignored, the current certificate keeps being served
+    with open(path, "w") as pem:
+        pem.write("-----BEGIN CERTIFICATE-----\n")
+    os.utime(path, (time.time() + 1, time.time() + 1))
+    time.sleep(0.2)
+    assert scrape(httpd.port, client_context())[0] == before
+
+    shutil.copy(cert("server2.pem"), path)
+    os.utime(path, (time.time() + 2, time.time() + 2))
+    time.sleep(0.2)
+    after, response = scrape(httpd.port, client_context())
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert after != before
+
+
+def test_reload_replaces_the_context(tmpdir):
+    cafile = str(tmpdir.join("ca.pem"))
+    shutil.copy(cert("client.pem"), cafile)
+    tls = pytheus.http.tls.Context(cert("server.pem"), cafile=cafile)
+    before = tls.context
+
+    shutil.copy(cert("server2.pem"), cafile) # The client CA is no longer trusted
+    assert tls.reload()
+    assert tls.context is not before
+    assert tls.context.cert_store_stats()["x509"] == 1
+
+
+def test_server_context_follows_reloads(tmpdir):
+    path = str(tmpdir.join("server.pem"))
+    shutil.copy(cert("server.pem"), path)
+    tls = pytheus.http.tls.Context(path)
+    context = tls.server_context()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+
+    def handshake():
+        server = threading.Thread(target=lambda: context.wrap_socket(
+            listener.accept()[0], server_side=True).close())
+        server.start()
+        sock = client_context().wrap_socket(socket.create_connection(listener.getsockname()))
+        peer = sock.getpeercert(True)
+        sock.close()
+        server.join()
+        return peer
+
+    before = handshake()
+    shutil.copy(cert("server2.pem"), path)
+    assert tls.reload()
+    assert handshake() != before
+    listener.close()
+
+
+def test_no_session_tickets():
+    tls = pytheus.http.tls.Context(cert("server.pem"), session_tickets=False)
+    assert tls.context.options & pytheus.http.tls.OP_NO_TICKET